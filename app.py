@@ -1,7 +1,12 @@
+import logging
+
+#: Logging setup, before the imports so their loggers are configured as well
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.DEBUG)
+
 from controller import Controller
 from time import sleep
 
 controller = Controller()
 
 while True:
-    sleep(10)
\ No newline at end of file
+    sleep(10)
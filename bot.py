@@ -1,94 +1,277 @@
+import os
+import time
+import asyncio
 import logging
-from time import strftime
-from typing import Callable
+import secrets
+import sqlite3
+import threading
+from urllib.parse import urlparse
+from datetime import timedelta
+from typing import Callable, Coroutine, Dict, List, Set, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor
 from telegram import CallbackQuery, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CallbackContext, CommandHandler, CallbackQueryHandler
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, CallbackContext, CallbackQueryHandler, MessageHandler, filters
 
 import utils
+import metrics
 import config as cfg
+import profiles
+from clip import Clip
 from user import User
 from role import Role
 from payload import Payload
+from registry import Authorizer, CommandRegistry
+from broadcast import Broadcaster, DeliveryStats
+from conversations import ConversationStore
+from catalog import Catalog, Entry, Page, parse_date_range
+from schedule import Schedule, parse_rule
+from spool import ALERT, VIDEO, Delivery, Spool
+from storage import Storage
 from userservice import UserDict, UserService
+from webhook import WebhookServer
+
+BOT_REQUESTS = metrics.counter('surveillance_bot_requests', 'Bot API requests by method and result', ('method', 'result'))
+BOT_REQUEST_LATENCY = metrics.histogram('surveillance_bot_request_seconds', 'Duration of successful Bot API requests', ('method',))
+ALERT_DELIVERY = metrics.histogram('surveillance_alert_delivery_seconds', 'Time from spooling an alert until it was delivered to every due recipient')
+CLIP_DELIVERY = metrics.histogram('surveillance_clip_delivery_seconds', 'Time from spooling a video until it was uploaded')
+
+#: Max length of a telegram message
+MAX_MESSAGE_LENGTH = 4096
+
+UNAUTHORIZED = metrics.counter('surveillance_unauthorized_requests', 'Commands and button presses of unauthorized chats, by whether they were answered', ('result',))
+
+#: Commands of the bot, with the role they require
+registry = CommandRegistry()
 
 class SurveillanceBot:
     
     def __init__(self, pause_unpause_callback: Callable):
-        ''' Inits and starts bot '''
+        ''' Inits and starts bot
+
+            #: The bot runs on its own asyncio event loop in a dedicated thread
+            #: Alerts and videos are spooled to disk and sent by a task on that loop (alert, send_surveillance_video)
+        '''
         
+        #: Sends to several users at once, within telegrams rate limits
+        self.broadcaster = Broadcaster()
+
+        #: Pending deliveries, the sender is woken up whenever something is spooled or a delivery finished
+        self.spool = Spool(cfg.SPOOL_PATH)
+        self._spooled: asyncio.Event = None
+
+        #: SQLite commits may block for a while on an sd card, handlers await them in this thread instead,
+        #: a single one, so they are made in the order they were requested
+        self.database = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bot-database')
+
+        #: Cursors (chat_id, kind) currently delivered, and the tasks delivering them
+        self._sending: Set[Tuple[int, str]] = set()
+        self._delivering: Set[asyncio.Task] = set()
+
+        #: file_id of every uploaded video by (item, path), recent items only
+        self._file_ids: Dict[Tuple[int, str], str] = {}
+
+        #: Open inline keyboards, abandoned ones expire
+        self.conversations = ConversationStore()
+
+        #: Every recorded clip, for /videos
+        self.catalog = Catalog(cfg.CATALOG_PATH)
+
+        #: Running transcodes by the path of the downscaled copy
+        self.downscale = profiles.downscale_profile()
+        self._transcodes: Dict[str, Future] = {}
+
+        self.loop = asyncio.new_event_loop()
+        self._stopped: asyncio.Event = None
+        self._startup_error: BaseException = None
+
         self._setup(pause_unpause_callback)
-        self.CALLBACK_ABORT = 'ABORT'
+
+        #: Arms and disarms the surveillance by the windows set with /schedule
+        self.schedule = Schedule(cfg.SCHEDULE_PATH, self._scheduled).start()
+
+        self.CALLBACK_ABORT = 'x'
+        self.CALLBACK_NEWER = 'n'
+        self.CALLBACK_OLDER = 'o'
         
     def _setup(self, pause_unpause_callback: Callable):
 
         #: Init logger
         self.logger = logging.getLogger(__name__)
 
-        #: Setup updater and dispatcher
-        self.updater = Updater(token=cfg.TELEGRAM_API_TOKEN)
-        self.dispatcher = self.updater.dispatcher
+        #: Setup application, updates are handled concurrently
+        #: Sends wait for a free connection instead of failing when all BOT_SEND_WORKERS connections are busy
+        builder = Application.builder().token(cfg.TELEGRAM_API_TOKEN).concurrent_updates(True).connection_pool_size(cfg.BOT_SEND_WORKERS).pool_timeout(30)
+        if cfg.TELEGRAM_API_URL:
+            builder = builder.base_url(cfg.TELEGRAM_API_URL)
+        self.application: Application = builder.build()
 
         #: Setup user service, UserService.__init__ already creates owner token
-        self.userservice: UserService = UserService()
+        #: With a database, users and tokens survive restarts
+        self.userservice: UserService = UserService(Storage() if cfg.DATABASE_PATH else None)
+
+        #: Checks the role required by a command, with cached roles
+        self.authorizer: Authorizer = Authorizer(self.userservice)
         
         #: Save callback
         self.pause_unpause_callback = pause_unpause_callback
         
-        #: Register activate-command-handler
-        open_activate_command_handler = CommandHandler('activate', self.open_activate_command_callback)
-        self.dispatcher.add_handler(open_activate_command_handler)
-        
-        #: Register leave-command-handler
-        open_leave_command_handler = CommandHandler('leave', self.open_leave_command_callback)
-        self.dispatcher.add_handler(open_leave_command_handler)
-        
-        #: Register users-command-handler
-        mod_show_users_with_roles_command_handler = CommandHandler('users', self.mod_show_users_with_roles_command_callback)
-        self.dispatcher.add_handler(mod_show_users_with_roles_command_handler)
+        #: Register the commands of the dispatch table, authorized before their handlers are called
+        self.application.add_handler(MessageHandler(filters.COMMAND, self._dispatch_command))
 
-        #: Register banned-command-handler
-        mod_show_banned_with_roles_command_handler = CommandHandler('banned', self.mod_show_banned_with_roles_command_callback)
-        self.dispatcher.add_handler(mod_show_banned_with_roles_command_handler)
-        
-        #: Register token-command-handler
-        admin_create_token_command_handler = CommandHandler('token', self.admin_create_token_command_callback)
-        self.dispatcher.add_handler(admin_create_token_command_handler)
+        #: Register handler for query callbacks
+        self.application.add_handler(CallbackQueryHandler(self.button))
 
-        #: Register cleartokens-command-handler
-        admin_clear_tokens_command_handler = CommandHandler('cleartokens', self.admin_clear_tokens_command_callback)
-        self.dispatcher.add_handler(admin_clear_tokens_command_handler)
-        
-        #: Register pause-command-handler
-        admin_pause_command_handler = CommandHandler('pause', self.admin_pause_command_callback)
-        self.dispatcher.add_handler(admin_pause_command_handler)
+        #: Register error handler
+        self.application.add_error_handler(self.error_handler)
         
-        #: Register unpause-command-handler
-        admin_unpause_command_handler = CommandHandler('unpause', self.admin_unpause_command_callback)
-        self.dispatcher.add_handler(admin_unpause_command_handler)
+        #: Start the event loop thread, returns once the bot is running
+        self.webhook: WebhookServer = None
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), name='bot', daemon=True)
+        self.thread.start()
+        started.wait()
+
+        if self._startup_error:
+            raise self._startup_error
+
+    def _run(self, started: threading.Event) -> None:
+        ''' Bot thread: runs the event loop until stop() is called
+        '''
 
-        #: Register ban-command-handler
-        admin_ban_user_command_handler = CommandHandler('ban', self.admin_ban_user_command_callback)
-        self.dispatcher.add_handler(admin_ban_user_command_handler)
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve(started))
 
-        #: Register unban-command-handler
-        admin_unban_user_command_handler = CommandHandler('unban', self.admin_unban_user_command_callback)
-        self.dispatcher.add_handler(admin_unban_user_command_handler)
-        
-        #: Register clear-command-handler
-        owner_clear_all_command_handler = CommandHandler('clear', self.owner_clear_all_command_callback)
-        self.dispatcher.add_handler(owner_clear_all_command_handler)
+    async def _serve(self, started: threading.Event) -> None:
+        ''' Starts the application, waits for stop() and shuts it down
 
-        #: Register handler for query callbacks
-        self.dispatcher.add_handler(CallbackQueryHandler(self.button))
+            #: Until telegram is reachable, e.g. when the network comes up after the power, the start is retried
+            #: with a backoff up to BOT_CONNECT_BACKOFF_MAX seconds
+        '''
 
-        #: Register error handler
-        self.dispatcher.add_error_handler(self.error_handler)
-        
-        #: Start
-        self.updater.start_polling()
+        self._stopped = asyncio.Event()
+        self._spooled = asyncio.Event()
+        delay = 1.0
+
+        try:
+            while True:
+                try:
+                    await self.application.initialize()
+                    break
+                except NetworkError as e:
+                    self.logger.warning('Telegram not reachable, retrying in {:.0f} s: {}'.format(delay, e))
+
+                #: Stopped while waiting for the network
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), delay)
+                    return
+                except asyncio.TimeoutError:
+                    delay = min(delay * 2, cfg.BOT_CONNECT_BACKOFF_MAX)
+
+            await self.application.start()
+
+            #: Start, updates are pushed by telegram in webhook mode, otherwise long polling fetches them
+            if not (cfg.TELEGRAM_WEBHOOK_URL and await self._start_webhook(cfg.TELEGRAM_WEBHOOK_URL)):
+                await self.application.updater.start_polling()
+
+        except BaseException as e:
+            self._startup_error = e
+            return
+
+        finally:
+            started.set()
+
+        #: Deliveries left over from the last run are sent right away
+        sender = asyncio.create_task(self._send_spooled())
+        sweeper = asyncio.create_task(self._expire_keyboards())
+
+        await self._stopped.wait()
+
+        #: Interrupted deliveries stay in the spool for the next start
+        for task in (sender, sweeper, *self._delivering):
+            task.cancel()
+        await asyncio.gather(sender, sweeper, *self._delivering, return_exceptions=True)
 
+        if self.webhook:
+            self.webhook.stop()
+        if self.application.updater.running:
+            await self.application.updater.stop()
+        await self.application.stop()
+        await self.application.shutdown()
 
-    def open_activate_command_callback(self, update: Update, context: CallbackContext) -> None:
+    async def _start_webhook(self, url: str) -> bool:
+        ''' Starts the webhook listener and registers it at telegram
+
+            #: return -> whether or not the webhook is active, if not polling has to be used
+        '''
+
+        secret_token: str = cfg.TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+        try:
+            self.webhook = WebhookServer(self._process_webhook_update, secret_token, urlparse(url).path or '/',
+                                         cfg.TELEGRAM_WEBHOOK_LISTEN, cfg.TELEGRAM_WEBHOOK_PORT, cfg.TELEGRAM_WEBHOOK_CERT, cfg.TELEGRAM_WEBHOOK_KEY).start()
+
+            if cfg.TELEGRAM_WEBHOOK_CERT:
+                with open(cfg.TELEGRAM_WEBHOOK_CERT, 'rb') as certificate:
+                    registered = await self.application.bot.set_webhook(url, certificate=certificate, secret_token=secret_token)
+            else:
+                registered = await self.application.bot.set_webhook(url, secret_token=secret_token)
+
+            if not registered:
+                raise TelegramError('setWebhook returned false')
+
+        except (OSError, TelegramError) as e:
+            self.logger.warning('Webhook {} could not be registered, falling back to polling: {}'.format(url, e))
+
+            if self.webhook:
+                self.webhook.stop()
+                self.webhook = None
+
+            return False
+
+        self.logger.debug('Webhook registered: {}'.format(url))
+        return True
+
+    def _process_webhook_update(self, data: dict) -> None:
+        ''' Hands an update received by the webhook (in a listener thread) to the application
+        '''
+
+        try:
+            update: Update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            self.logger.warning('Invalid update received by the webhook: {}'.format(e))
+            return
+
+        self.loop.call_soon_threadsafe(self.application.update_queue.put_nowait, update)
+
+    def stop(self) -> None:
+        ''' Stops receiving updates and waits for the bot thread
+        '''
+
+        if self._stopped:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        self.thread.join()
+        self.schedule.stop()
+        self.schedule.close()
+        self.database.shutdown(wait=True)
+        self.spool.close()
+        self.catalog.close()
+
+    def _submit(self, coroutine: Coroutine) -> Future:
+        ''' Runs a coroutine on the bot's event loop, callable from any thread
+        '''
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _blocking(self, function: Callable, *args):
+        ''' Awaits a blocking call, e.g. a database commit, without stalling the event loop
+        '''
+
+        return await self.loop.run_in_executor(self.database, function, *args)
+
+
+    @registry.command('activate', Role.OPEN)
+    async def open_activate_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /activate command - OPEN
             
             Checks if the entered token is valid.
@@ -96,18 +279,12 @@ class SurveillanceBot:
         '''
         
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.OPEN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
-        
+
         #: catch missing arg error
         if not context.args:
             
             #: inform user
-            self._send_text_msg(chat_id, text='No token provided.')
+            await self._send_text_msg(chat_id, text='No token provided.')
             return
         
         #: activate token
@@ -115,74 +292,60 @@ class SurveillanceBot:
 
         #: user exists if activation was successful
         if user:
-            self._send_text_msg(chat_id, text='Registered succesfully as {}!'.format(user.role.name.lower()))
+            await self._send_text_msg(chat_id, text='Registered succesfully as {}!'.format(user.role.name.lower()))
 
         #: otherwise token was invalid
         else:
-            self._send_text_msg(chat_id, text='Invalid token.')
+            await self._send_text_msg(chat_id, text='Invalid token.')
 
         
-    def open_leave_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('leave', Role.OPEN)
+    async def open_leave_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' #TODO
         '''
         
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.OPEN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
-        
+
         if self.userservice.is_owner(chat_id):
             
             #: inform user: owner cant leave
-            self._send_text_msg(chat_id, text='You cant leave as the owner.')
+            await self._send_text_msg(chat_id, text='You cant leave as the owner.')
             return
 
         if self.userservice.remove_user(chat_id):
 
             #: if userservice return True, user was removed
-            self._send_text_msg(chat_id, text='You are no longer registered.')
+            await self._send_text_msg(chat_id, text='You are no longer registered.')
 
         else:
             #: else, user was not registered
-            self._send_text_msg(chat_id, text='You are not registered.')
+            await self._send_text_msg(chat_id, text='You are not registered.')
             
 
-    def mod_show_users_with_roles_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('users', Role.MOD)
+    async def mod_show_users_with_roles_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /users command - MOD
 
             Shows current users to the admin
         '''
         
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.MOD
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
-        
-        context.bot.send_message(chat_id=update.effective_chat.id, text=self.userservice.users_as_str())
+
+        await context.bot.send_message(chat_id=chat_id, text=self.userservice.users_as_str())
     
-    def mod_show_banned_with_roles_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('banned', Role.MOD)
+    async def mod_show_banned_with_roles_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /banned command - MOD
 
             Shows current users to the admin
         '''
         
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.MOD
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
-        
-        context.bot.send_message(chat_id=update.effective_chat.id, text=self.userservice.banned_as_str())
+
+        await context.bot.send_message(chat_id=chat_id, text=self.userservice.banned_as_str())
             
-    def admin_create_token_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('token', Role.ADMIN, route='t')
+    async def admin_create_token_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /token command - ADMIN
             Allows admins to create register-token
             
@@ -191,12 +354,6 @@ class SurveillanceBot:
 
         chat_id: int = update.effective_chat.id
         query: CallbackQuery = update.callback_query
-        
-        ### Check authorization ###
-        req_role: Role = Role.ADMIN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
 
         #: Start process
         if not query:
@@ -205,40 +362,39 @@ class SurveillanceBot:
             user_role: Role = self.userservice.get_role_of(chat_id)
 
             #: build role option keyboard
-            keyboard = [[InlineKeyboardButton(role.name.capitalize(), callback_data=role.value),] for role in Role if role > Role.OPEN and role < user_role]
+            keyboard = [[InlineKeyboardButton(role.name.capitalize(), callback_data=registry.encode('token', role.value)),] for role in Role if role > Role.OPEN and role < user_role]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
             #: Send query for role options
-            message: Message = update.message.reply_text("Choose the authority level for the token:", reply_markup=reply_markup)
+            message: Message = await update.message.reply_text("Choose the authority level for the token:", reply_markup=reply_markup)
 
             #: save payload
-            payload_dict = { message.message_id: Payload(self.admin_create_token_command_callback, None, 1) }
-            context.bot_data.update(payload_dict)
+            self.conversations.put(chat_id, message.message_id, Payload('token', None, 1))
 
 
         #: If query exists, handle user selection based on stage
         else:
             
             #: get payload regarding message
-            payload: Payload = context.bot_data[query.message.message_id]
+            payload: Payload = self.conversations.get(chat_id, query.message.message_id)
 
             #: handle first user selection
             if payload.stage == 1:
                 
                 #: build days of validity option keyboard
                 keyboard = [
-                    [InlineKeyboardButton(1, callback_data=1), InlineKeyboardButton(3, callback_data=3)],
-                    [InlineKeyboardButton(5, callback_data=5), InlineKeyboardButton(10, callback_data=10)]
+                    [InlineKeyboardButton(1, callback_data=registry.encode('token', 1)), InlineKeyboardButton(3, callback_data=registry.encode('token', 3))],
+                    [InlineKeyboardButton(5, callback_data=registry.encode('token', 5)), InlineKeyboardButton(10, callback_data=registry.encode('token', 10))]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
                 #: update stage and save user selection for later in payload data
                 payload.stage = 2
-                payload.data = int(query.data)
+                payload.data = int(context.args[0])
 
                 #: update query with days of validity options
-                query.edit_message_text(text="Choose days of validity:")
-                query.edit_message_reply_markup(reply_markup=reply_markup)
+                await query.edit_message_text(text="Choose days of validity:")
+                await query.edit_message_reply_markup(reply_markup=reply_markup)
                 
                 return
 
@@ -246,104 +402,263 @@ class SurveillanceBot:
             if payload.stage == 2:
                 
                 #: build token based on seletions
-                token = self.userservice.generate_token(Role(payload.data), int(query.data))
+                token = self.userservice.generate_token(Role(payload.data), int(context.args[0]))
 
                 self.logger.debug('New {} token created'.format(token.role.name))
                 
                 #: inform user with new token
-                query.edit_message_text('{} token is valid until {}'.format(token.role.name.capitalize(), token.valid_until.strftime('%y/%m/%d, %H:%M')))
-                self._send_text_msg(chat_id, token.value)
+                await query.edit_message_text('{} token is valid until {}'.format(token.role.name.capitalize(), token.valid_until.strftime('%y/%m/%d, %H:%M')))
+                await self._send_text_msg(chat_id, token.value)
                 
-                #: remove payload from context
-                del context.bot_data[query.message.message_id]
+                #: remove payload
+                self.conversations.pop(chat_id, query.message.message_id)
                 
                 return 
 
-    def admin_clear_tokens_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('cleartokens', Role.ADMIN)
+    async def admin_clear_tokens_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /clear command - ADMIN
         '''
 
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.ADMIN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
 
         self.userservice.clear_tokens()
         
-    def admin_pause_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('pause', Role.ADMIN)
+    async def admin_pause_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /pause command - ADMIN
         '''
 
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.ADMIN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
 
         if self.pause_unpause_callback(True):
-            self._send_text_msg(chat_id, 'Surveillance deactivated.')
+            await self._send_text_msg(chat_id, 'Surveillance deactivated.')
             
         else:
-            self._send_text_msg(chat_id, 'Surveillance already inactive.')
+            await self._send_text_msg(chat_id, 'Surveillance already inactive.')
         
-    def admin_unpause_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('unpause', Role.ADMIN)
+    async def admin_unpause_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /unpause command - ADMIN
         '''
 
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.ADMIN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
 
         if self.pause_unpause_callback(False):
-            self._send_text_msg(chat_id, 'Surveillance activated.')
+            await self._send_text_msg(chat_id, 'Surveillance activated.')
             
         else:
-            self._send_text_msg(chat_id, 'Surveillance already active.')
-        
+            await self._send_text_msg(chat_id, 'Surveillance already active.')
 
-    def admin_ban_user_command_callback(self, update: Update, context: CallbackContext) -> None:
-        ''' Callback for the /ban command - ADMIN
+    @registry.command('schedule', Role.ADMIN)
+    async def admin_schedule_command_callback(self, update: Update, context: CallbackContext) -> None:
+        ''' Callback for the /schedule command - ADMIN
+
+            Lists, adds and removes the windows in which the surveillance is armed or disarmed
+            /pause and /unpause still work in between, until the next scheduled change
         '''
 
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.ADMIN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
+
+        args: List[str] = context.args or []
+
+        #: List rules and the next change
+        if not args:
+            if not self.schedule.rules:
+                await self._send_text_msg(chat_id, 'No schedule, surveillance is only changed by /pause and /unpause.')
+                return
+
+            text = '\n'.join(self.schedule.describe(rule) for rule in self.schedule.rules)
+            transition = self.schedule.transition
+            if transition:
+                text += '\n\nNext: {} at {}.'.format('arm' if transition[1] else 'disarm', transition[0].astimezone(self.schedule.zone).strftime('%a %Y-%m-%d %H:%M %Z'))
+            await self._send_text_msg(chat_id, text)
             return
-        
-        self._admin_ban_unban_user_helper(update, context, self.admin_ban_user_command_callback, self.userservice.users, self.userservice.banned, 'banned')
+
+        if args[0] == 'remove' and len(args) == 2 and args[1].isdigit():
+            if self.schedule.remove(int(args[1])):
+                await self._send_text_msg(chat_id, 'Removed.')
+            else:
+                await self._send_text_msg(chat_id, 'No such rule.')
+            return
+
+        if args == ['clear']:
+            self.schedule.clear()
+            await self._send_text_msg(chat_id, 'Schedule cleared.')
+            return
+
+        try:
+            armed, rule = parse_rule(args, self.schedule.zone)
+        except ValueError:
+            await self._send_text_msg(chat_id, 'Usage: /schedule [arm|disarm <DAYS> <HH:MM-HH:MM>] [arm|disarm <START> <END>] [remove <ID>] [clear]')
+            return
+
+        if len(rule) == 3:
+            added = self.schedule.add_window(armed, *rule)
+        else:
+            added = self.schedule.add_once(armed, *rule)
+
+        await self._send_text_msg(chat_id, 'Added: {}'.format(self.schedule.describe(added)))
+
+    def _scheduled(self, armed: bool) -> None:
+        ''' Callback of the schedule, runs in its thread
+        '''
+
+        if self.pause_unpause_callback(not armed):
+            self.alert('Surveillance {} by schedule.'.format('activated' if armed else 'deactivated'), Role.ADMIN)
         
 
-    def admin_unban_user_command_callback(self, update: Update, context: CallbackContext) -> None:
-        ''' Callback for the /unban command - ADMIN
+    @registry.command('videos', Role.ADMIN, route='v')
+    async def admin_videos_command_callback(self, update: Update, context: CallbackContext) -> None:
+        ''' Callback for the /videos command - ADMIN
+
+            Lists recorded clips page by page, newest first, optionally of certain days
+            A selected clip is sent by its file_id or uploaded again
         '''
 
         chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role = Role.ADMIN
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
+        query: CallbackQuery = update.callback_query
+
+        #: Start process
+        if not query:
+
+            try:
+                since, until = parse_date_range(context.args or [])
+            except ValueError:
+                await self._send_text_msg(chat_id, 'Usage: /videos [YYYY-MM-DD [YYYY-MM-DD]]')
+                return
+
+            page: Page = await self._blocking(self.catalog.page, since, until)
+            if not page.entries:
+                await self._send_text_msg(chat_id, 'No videos found.')
+                return
+
+            #: send first page
+            message: Message = await update.message.reply_text(self._videos_title(page), reply_markup=self._videos_keyboard(page))
+
+            #: save payload, the current page is needed to turn it
+            self.conversations.put(chat_id, message.message_id, Payload('videos', page))
+
+            return
+
+        #: get payload regarding message
+        payload: Payload = self.conversations.get(chat_id, query.message.message_id)
+        page: Page = payload.data
+
+        #: Close the list
+        if context.args[0] == self.CALLBACK_ABORT:
+            await query.edit_message_text('Closed.')
+            self.conversations.pop(chat_id, query.message.message_id)
+            return
+
+        #: Turn the page
+        if context.args[0] in (self.CALLBACK_NEWER, self.CALLBACK_OLDER):
+            if context.args[0] == self.CALLBACK_NEWER:
+                turned: Page = await self._blocking(lambda: self.catalog.page(page.since, page.until, after=page.first))
+            else:
+                turned = await self._blocking(lambda: self.catalog.page(page.since, page.until, before=page.last))
+
+            #: The clips around the page may have been deleted meanwhile
+            if turned.entries:
+                payload.data = turned
+                await query.edit_message_text(self._videos_title(turned), reply_markup=self._videos_keyboard(turned))
+            return
+
+        entry: Entry = await self._blocking(self.catalog.get, int(context.args[0]))
+        if not entry:
+            await self._send_text_msg(chat_id, 'Video not found.')
+            return
+
+        await self._send_catalog_video(chat_id, entry)
+
+    def _videos_title(self, page: Page) -> str:
+        if page.since:
+            return 'Videos from {} to {}, newest first:'.format(page.since.isoformat(), (page.until - timedelta(days=1)).isoformat())
+        return 'Videos, newest first:'
+
+    def _videos_keyboard(self, page: Page) -> InlineKeyboardMarkup:
+        ''' One button per clip, then the buttons to turn the page and to close the list
+        '''
+
+        keyboard = [[InlineKeyboardButton('{}  {:.0f} s  {:.1f} MB  {}'.format(entry.started.strftime('%y/%m/%d, %H:%M:%S'), entry.duration or 0,
+                                                                             (entry.size or 0) / 1e6, 'deleted' if entry.deleted else entry.status), callback_data=registry.encode('videos', entry.id))]
+                    for entry in page.entries]
+
+        navigation = []
+        if page.has_newer:
+            navigation.append(InlineKeyboardButton('< Newer', callback_data=registry.encode('videos', self.CALLBACK_NEWER)))
+        if page.has_older:
+            navigation.append(InlineKeyboardButton('Older >', callback_data=registry.encode('videos', self.CALLBACK_OLDER)))
+        navigation.append(InlineKeyboardButton('[ CLOSE ]', callback_data=registry.encode('videos', self.CALLBACK_ABORT)))
+        keyboard.append(navigation)
+
+        return InlineKeyboardMarkup(keyboard)
+
+    async def _send_catalog_video(self, chat_id: int, entry: Entry) -> None:
+        ''' Sends a clip of the catalog, by file_id if it was uploaded before, else by uploading the file
+        '''
+
+        caption: str = entry.clip.caption
+
+        if entry.file_id:
+            try:
+                await self._send_media(chat_id, entry.file_id, caption)
+                return
+            except TelegramError as e:
+                self.logger.warning('Sending video {} by file_id failed: {}'.format(entry.id, e))
+
+        if entry.deleted or not os.path.exists(entry.path):
+            await self._send_text_msg(chat_id, 'The video was deleted.')
+            return
+
+        file_id: str = await self._upload_file(chat_id, caption, entry.path)
+        if file_id:
+            await self._blocking(self.catalog.uploaded, entry.path, file_id)
+        else:
+            await self._send_text_msg(chat_id, 'The video could not be sent, try again later.')
+
+    @registry.command('queue', Role.ADMIN)
+    async def admin_queue_command_callback(self, update: Update, context: CallbackContext) -> None:
+        ''' Callback for the /queue command - ADMIN
+
+            Shows the deliveries waiting in the spool
+        '''
+
+        chat_id: int = update.effective_chat.id
+
+        stats: dict = await self._blocking(self.spool.stats)
+        if not stats['items']:
+            await self._send_text_msg(chat_id, 'Nothing queued, everything was delivered.')
             return
 
-        self._admin_ban_unban_user_helper(update, context, self.admin_unban_user_command_callback, self.userservice.banned, self.userservice.users, 'unbanned')
+        text = '{} alerts and {} videos pending for {} recipients.\nOldest: {:.0f} s ago, {} deliveries retrying'.format(
+            stats['alerts'], stats['videos'], stats['recipients'], stats['oldest'], stats['retrying'])
+        if stats['next_attempt']:
+            text += ', next attempt in {:.0f} s'.format(stats['next_attempt'])
+
+        await self._send_text_msg(chat_id, text + '.')
 
-    def _admin_ban_unban_user_helper(self, update: Update, context: CallbackContext, callback: Callable, from_dict: UserDict, to_dict: UserDict, action_name: str) -> None:
+
+    @registry.command('ban', Role.ADMIN, route='b')
+    async def admin_ban_user_command_callback(self, update: Update, context: CallbackContext) -> None:
+        ''' Callback for the /ban command - ADMIN
+        '''
+
+        await self._admin_ban_unban_user_helper(update, context, 'ban', self.userservice.users, self.userservice.ban_user, 'banned')
+        
+
+    @registry.command('unban', Role.ADMIN, route='u')
+    async def admin_unban_user_command_callback(self, update: Update, context: CallbackContext) -> None:
+        ''' Callback for the /unban command - ADMIN
+        '''
+
+        await self._admin_ban_unban_user_helper(update, context, 'unban', self.userservice.banned, self.userservice.unban_user, 'unbanned')
+
+    async def _admin_ban_unban_user_helper(self, update: Update, context: CallbackContext, command: str, from_dict: UserDict, move: Callable[[int], bool], action_name: str) -> None:
         ''' Helper function
             
             #: Implements the usecase of banning and unbanning users
-            #: The order in which the dictionaries are passed, determines origin and destination 
+            #: from_dict is the origin, move the userservice method moving a user to the destination
             #: InlineKeyboard if build from users in origin dict which have a less powerful role than the caller
         '''
 
@@ -354,7 +669,7 @@ class SurveillanceBot:
         user_role: Role = self.userservice.get_role_of(chat_id)
 
         if not from_dict.with_lower_role(user_role):
-            self._send_text_msg(chat_id, 'No options available.')
+            await self._send_text_msg(chat_id, 'No options available.')
             return
         
         #: Start process
@@ -364,150 +679,444 @@ class SurveillanceBot:
             role: Role = self.userservice.users[chat_id].role
         
             #: build ban-unban-user option keyboard
-            keyboard = [[InlineKeyboardButton(user.name, callback_data=user.chat_id)] for user in from_dict.with_lower_role(role).values()]
-            keyboard.append([InlineKeyboardButton('[ ABORT ]', callback_data=self.CALLBACK_ABORT)])
+            keyboard = [[InlineKeyboardButton(user.name, callback_data=registry.encode(command, user.chat_id))] for user in from_dict.with_lower_role(role).values()]
+            keyboard.append([InlineKeyboardButton('[ ABORT ]', callback_data=registry.encode(command, self.CALLBACK_ABORT))])
 
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             #: send query
-            message: Message = update.message.reply_text("Select the user to be {}:".format(action_name), reply_markup=reply_markup)
+            message: Message = await update.message.reply_text("Select the user to be {}:".format(action_name), reply_markup=reply_markup)
             
             #: save payload
-            payload_dict = { message.message_id: Payload(callback) }
-            context.bot_data.update(payload_dict)
+            self.conversations.put(chat_id, message.message_id, Payload(command))
             
         #: If query exists, handle user selection
         else:
 
             #: Abort if selected
-            if query.data == self.CALLBACK_ABORT:
-                update.message.reply_text("Action aborted.")
+            if context.args[0] == self.CALLBACK_ABORT:
+                await query.message.reply_text("Action aborted.")
             
-            #: If user not in from_dict, he cant be moved, abort
-            elif query.data not in from_dict:
-                update.message.reply_text("User not found, aborting.")
+            #: If user not in from_dict, he cant be moved, abort (callback data arrives as string)
+            elif int(context.args[0]) not in from_dict:
+                await query.message.reply_text("User not found, aborting.")
                 self.logger.debug("User not found - action aborted")
                 
             else:
                 
-                # TODO use userservice, required method references or other logic
-                user_to_move: User = from_dict.pop(query.data)
-                to_dict[user_to_move.chat_id] = user_to_move
+                #: move through the userservice, so the change is persisted
+                user_to_move: User = from_dict[int(context.args[0])]
+                move(user_to_move.chat_id)
                 
                 #: inform user with new token
-                query.edit_message_text('{} was {}.'.format(user_to_move.name, action_name))
+                await query.edit_message_text('{} was {}.'.format(user_to_move.name, action_name))
             
-            #: remove payload from context
-            del context.bot_data[query.message.message_id]
+            #: remove payload
+            self.conversations.pop(chat_id, query.message.message_id)
         
         
-    def owner_clear_all_command_callback(self, update: Update, context: CallbackContext) -> None:
+    @registry.command('clear', Role.OWNER)
+    async def owner_clear_all_command_callback(self, update: Update, context: CallbackContext) -> None:
         ''' Callback for the /clear command - OWNER
 
             Clears all users and admins except the owner
         '''
 
-        chat_id: int = update.effective_chat.id
-        
-        ### Check authorization ###
-        req_role: Role = Role.OWNER
-        if not self._is_authorized(chat_id, req_role):
-            self._send_text_msg(chat_id, 'Unauthorized!')
-            return
-        
         #: Clear users, banned users and tokens
         self.userservice.clear()
 
 
-    def button(self, update: Update, context: CallbackContext) -> None:
-        ''' Parses the CallbackQuery and updates the message text.
+    @registry.command('stats', Role.OWNER)
+    async def owner_stats_command_callback(self, update: Update, context: CallbackContext) -> None:
+        ''' Callback for the /stats command - OWNER
+
+            Sends the collected metrics, latencies as estimated percentiles
+        '''
+
+        chat_id: int = update.effective_chat.id
+
+        #: Cut off at the max message length
+        await self._send_text_msg(chat_id, metrics.REGISTRY.summary()[:MAX_MESSAGE_LENGTH] or 'No metrics yet.')
+
+
+    async def _dispatch_command(self, update: Update, context: CallbackContext) -> None:
+        ''' Looks up a command in the dispatch table and calls its handler if the chat is authorized
+        '''
+
+        message: Message = update.effective_message
+        words: List[str] = message.text.split()
+        name, _, username = words[0][1:].partition('@')
+
+        #: Commands addressed to other bots in groups are ignored, as are unknown ones
+        command = registry.commands.get(name.lower())
+        if not command or (username and username != context.bot.username):
+            return
+
+        if not await self._authorize(update.effective_chat.id, command.role):
+            return
+
+        context.args = words[1:]
+        await command.handler(self, update, context)
+
+    async def button(self, update: Update, context: CallbackContext) -> None:
+        ''' Routes the CallbackQuery to the command of the keyboard, the arguments of the button as context.args
         '''
         
         query: CallbackQuery = update.callback_query
-        message_id: int = query.message.message_id
+        command, args = registry.decode(query.data)
 
         # CallbackQueries need to be answered, even if no notification to the user is needed
         # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
-        query.answer()
+        await query.answer()
+
+        if not command or not await self._authorize(query.message.chat_id, command.role):
+            return
 
-        #: abort if no handler is filed
-        if message_id not in context.bot_data:
-            #TODO handle error
+        #: The keyboard expired or is left over from before a restart
+        payload: Payload = self.conversations.get(query.message.chat_id, query.message.message_id)
+        if payload is None or payload.command != command.name:
+            await query.edit_message_text('Expired.')
             return
 
-        #: delegate query data to filed handler method
-        context.bot_data[message_id].callback(update, context)
+        context.args = args
+        await command.handler(self, update, context)
+
+    async def _expire_keyboards(self) -> None:
+        ''' Edits the keyboards of abandoned conversations to expired, a batch per sweep interval
+        '''
+
+        while True:
+            await asyncio.sleep(cfg.CONVERSATION_SWEEP_INTERVAL)
+
+            message_ids: Dict[int, List[int]] = {}
+            for payload in self.conversations.sweep(cfg.CONVERSATION_EXPIRE_BATCH):
+                message_ids.setdefault(payload.chat_id, []).append(payload.message_id)
+
+            if message_ids:
+                await self.broadcaster.broadcast(message_ids, lambda chat_id: self._edit_expired(chat_id, message_ids[chat_id]))
+
+    async def _edit_expired(self, chat_id: int, message_ids: List[int]) -> None:
+        for message_id in message_ids:
+            try:
+                await self.application.bot.edit_message_text('Expired.', chat_id=chat_id, message_id=message_id)
+
+            #: The message was deleted meanwhile
+            except BadRequest as e:
+                self.logger.debug('Keyboard {} in {} not edited: {}'.format(message_id, chat_id, e))
 
     
-    def alert(self, msg: str, req_role: Role = Role.OPEN) -> None:
+    def alert(self, msg: str, req_role: Role = Role.OPEN, photo: str = None) -> Union[int, None]:
         ''' Method to inform specified user group with custom message
+
+            #: photo - path of an image sent with the message as caption
+            #: returns once the alert is spooled, with the id of the spooled item
         '''
         
-        self._send_text_msg_to_lst(self.userservice.get_users().with_min_role(req_role), msg)
+        return self._spool(ALERT, self.userservice.get_users().with_min_role(req_role), msg, photo)
         
-    def send_surveillance_video(self, video_path: str) -> None:
+    def send_surveillance_video(self, clip: Clip) -> Union[int, None]:
         ''' Sends the recorded surveillance video to every admin-user
+
+            #: returns once the video is spooled, with the id of the spooled item
+        '''
+
+        if not clip:
+            return None
+
+        if clip.downscaled and self.downscale:
+            self._transcodes[profiles.downscaled_path(clip.path, self.downscale)] = clip.downscaled
+
+        return self._spool(VIDEO, self.userservice.get_users().with_min_role(Role.ADMIN), clip.caption, clip.path)
+
+    def pending_files(self) -> Set[str]:
+        ''' Paths of spooled photos and videos and the downscaled copies, which are not delivered to everyone yet
+        '''
+
+        paths: Set[str] = self.spool.pending_paths()
+        if self.downscale:
+            paths |= {profiles.downscaled_path(path, self.downscale) for path in paths}
+
+        return paths
+
+    def _spool(self, kind: str, chat_ids: List[int], text: str, path: str = None) -> Union[int, None]:
+        ''' Spools an item and wakes the sender, callable from any thread
         '''
-        
-        if not video_path:
-            return
 
-        #: Iterate admins and send video to each
-        for chat_id in self.userservice.get_users().with_min_role(Role.ADMIN):
-            self.updater.bot.send_video(chat_id=chat_id, video=open(video_path, 'rb'), supports_streaming=True,  caption=utils.basename(video_path))
+        try:
+            item: int = self.spool.enqueue(kind, chat_ids, text, path)
+        except sqlite3.Error:
+            self.logger.exception('Spooling {} failed'.format(kind))
+            return None
 
-    def _is_authorized(self, chat_id: int, req_role: Role) -> bool:
-        ''' Check if user with given chat_id is authorized for command
+        if item and self._spooled:
+            self.loop.call_soon_threadsafe(self._spooled.set)
 
-            #: chat_id                     - telegram chat_id
+        return item
+
+    async def _send_spooled(self) -> None:
+        ''' Sender task: delivers every due item in its own task
+
+            #: A cursor that is being delivered is skipped, the next item of that recipient and kind waits for it
+            #: Sleeps until something is spooled, a delivery finished or the next retry is due
+        '''
+
+        while True:
+            self._spooled.clear()
+
+            items: Dict[int, List[Delivery]] = {}
+            for delivery in await self._blocking(self.spool.due, set(self._sending)):
+                if (delivery.chat_id, delivery.kind) not in self._sending:
+                    self._sending.add((delivery.chat_id, delivery.kind))
+                    items.setdefault(delivery.item, []).append(delivery)
+
+            for deliveries in items.values():
+                task = asyncio.create_task(self._deliver_spooled(deliveries))
+                self._delivering.add(task)
+                task.add_done_callback(self._delivering.discard)
+
+            timeout: float = await self._blocking(self.spool.next_attempt, set(self._sending))
+            try:
+                await asyncio.wait_for(self._spooled.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver_spooled(self, deliveries: List[Delivery]) -> None:
+        ''' Delivers one item to its due recipients, failed deliveries are retried by the spool
+        '''
+
+        first: Delivery = deliveries[0]
+        chat_ids: List[int] = [delivery.chat_id for delivery in deliveries]
+
+        #: The cursors stay busy until the results are recorded, otherwise the sender could pick them up again as due
+        try:
+            try:
+                #: Without its photo, an alert is still sent as text
+                if first.kind == ALERT and first.path and os.path.exists(first.path):
+                    failed: List[int] = await self._deliver_file(chat_ids, first, first.path)
+                    ALERT_DELIVERY.observe(time.time() - first.created)
+                elif first.kind == ALERT:
+                    failed = (await self._send_text_msg_to_lst(chat_ids, first.text)).failed
+                    ALERT_DELIVERY.observe(time.time() - first.created)
+                else:
+                    failed = await self._send_spooled_video(first, chat_ids)
+
+            except Exception:
+                self.logger.exception('Delivering {} {} failed'.format(first.kind, first.item))
+                failed = chat_ids
+
+            for delivery in deliveries:
+                if delivery.chat_id in failed:
+                    if not await self._blocking(self.spool.failed, delivery) and delivery.kind == VIDEO:
+                        await self._blocking(self.catalog.failed, delivery.path)
+                else:
+                    await self._blocking(self.spool.delivered, delivery)
+
+        finally:
+            self._sending.difference_update((delivery.chat_id, delivery.kind) for delivery in deliveries)
+
+        self._spooled.set()
+
+    async def _send_spooled_video(self, delivery: Delivery, chat_ids: List[int]) -> List[int]:
+        ''' #: Admins in LOW_BANDWIDTH_CHAT_IDS receive the downscaled copy, if there is one
+            #: Everyone receives the copy if the original is too large to be uploaded
+
+            #: return -> chat_ids the video could not be sent to
+        '''
+
+        #: A deleted video can not be sent anymore, retrying would not help
+        if not os.path.exists(delivery.path):
+            self.logger.warning('Spooled video {} does not exist anymore'.format(delivery.path))
+            return []
+
+        recipients: List[int] = chat_ids
+        low_bandwidth: List[int] = []
+
+        if self.downscale:
+            if os.path.getsize(delivery.path) > profiles.TELEGRAM_UPLOAD_LIMIT:
+                recipients, low_bandwidth = [], recipients
+            else:
+                low_bandwidth = [chat_id for chat_id in recipients if chat_id in cfg.LOW_BANDWIDTH_CHAT_IDS]
+                recipients = [chat_id for chat_id in recipients if chat_id not in low_bandwidth]
+
+        #: The original does not wait for the transcoding
+        failed, failed_downscaled = await asyncio.gather(self._deliver_file(recipients, delivery, delivery.path), self._deliver_downscaled(low_bandwidth, delivery))
+        return failed + failed_downscaled
+
+    async def _deliver_downscaled(self, recipients: List[int], delivery: Delivery) -> List[int]:
+        ''' Waits for the downscaled copy and sends it, falls back to the original if there is none
+        '''
+
+        if not recipients:
+            return []
+
+        path: str = profiles.downscaled_path(delivery.path, self.downscale)
+
+        transcode: Future = self._transcodes.get(path)
+        if transcode:
+            try:
+                await asyncio.wrap_future(transcode)
+            except Exception as e:
+                self.logger.warning('Downscaling {} failed: {}, sending the original'.format(delivery.path, e))
+            self._transcodes.pop(path, None)
+
+        return await self._deliver_file(recipients, delivery, path if os.path.exists(path) else delivery.path)
+
+    async def _deliver_file(self, recipients: List[int], delivery: Delivery, path: str) -> List[int]:
+        ''' #: The file is uploaded once, every other recipient receives it by its telegram file_id
+            #: If an upload fails, the next recipient is tried for the upload
+            #: Alerts carry a photo, everything else is a video
+
+            #: return -> chat_ids the file could not be sent to
+        '''
+
+        photo: bool = delivery.kind == ALERT
+        recipients = list(recipients)
+        failed: List[int] = []
+        file_id: str = self._file_ids.get((delivery.item, path))
+
+        #: Upload until one upload succeeded
+        while recipients and not file_id:
+            chat_id: int = recipients.pop(0)
+            file_id = await self._upload_file(chat_id, delivery.text, path, photo)
+
+            if not file_id:
+                failed.append(chat_id)
+
+        if not file_id:
+            return failed
+
+        if (delivery.item, path) not in self._file_ids:
+            self._file_ids[(delivery.item, path)] = file_id
+
+            if delivery.kind == VIDEO:
+                CLIP_DELIVERY.observe(time.time() - delivery.created)
+                if path == delivery.path:
+                    await self._blocking(self.catalog.delivered, path, file_id)
+
+            #: Retries only need the file_ids of recent items
+            while len(self._file_ids) > cfg.SPOOL_BATCH:
+                del self._file_ids[next(iter(self._file_ids))]
+
+        #: Send to the remaining recipients by file_id at the same time
+        stats: DeliveryStats = await self.broadcaster.broadcast(recipients, lambda chat_id: self._send_by_file_id(chat_id, file_id, delivery.text, path, photo))
+        return failed + stats.failed
+
+    async def _send_media(self, chat_id: int, media, caption: str, photo: bool = False) -> Message:
+        ''' Sends a video or a photo, media is an open file or a telegram file_id
+        '''
+
+        if photo:
+            return await self._api_call('send_photo', chat_id=chat_id, photo=media, caption=caption)
+        return await self._api_call('send_video', chat_id=chat_id, video=media, supports_streaming=True, caption=caption)
+
+    async def _upload_file(self, chat_id: int, caption: str, path: str, photo: bool = False) -> Union[str, None]:
+        ''' Uploads the video (or photo) at path to chat_id
+
+            #: return -> telegram file_id of the uploaded file, None if the upload failed
+        '''
+
+        try:
+            with open(path, 'rb') as media:
+                message: Message = await self._send_media(chat_id, media, caption, photo)
+
+            #: Photos come in several sizes, the last one is the largest
+            attachment = message.effective_attachment
+            return (attachment[-1] if photo else attachment).file_id
+
+        except (TelegramError, OSError) as e:
+            self.logger.warning('Upload of {} to {} failed: {}'.format(utils.basename(path), chat_id, e))
+            return None
+
+    async def _send_by_file_id(self, chat_id: int, file_id: str, caption: str, path: str, photo: bool = False) -> None:
+        ''' Sends an already uploaded video (or photo), falls back to uploading it again
+        '''
+
+        try:
+            await self._send_media(chat_id, file_id, caption, photo)
+
+        #: Rate limits are handled by the broadcaster
+        except RetryAfter:
+            raise
+
+        except TelegramError as e:
+            self.logger.warning('Sending {} to {} by file_id failed: {}, uploading instead'.format(utils.basename(path), chat_id, e))
+            if not await self._upload_file(chat_id, caption, path, photo):
+                raise
+
+    async def _authorize(self, chat_id: int, req_role: Role) -> bool:
+        ''' Check if user with given chat_id is authorized for command, answers unauthorized chats within the rate limit
+
+            #: chat_id  - telegram chat_id
             #: req_role - required role level to execute command
         '''
-        
-        #: Banned chat_ids are never authorized
-        if self.userservice.is_banned(chat_id):
-            return False
-        
-        #: Command authorization level must be open, or the user has to be registered and own the required access rights
-        return req_role is Role.OPEN or self.userservice.user_has_role(chat_id, req_role)
+
+        #: Until the stored users are loaded the check waits for them, outside of the event loop
+        if self.userservice.loaded:
+            authorized: bool = self.authorizer.is_authorized(chat_id, req_role)
+        else:
+            authorized = await self.loop.run_in_executor(None, self.authorizer.is_authorized, chat_id, req_role)
+
+        if authorized:
+            return True
+
+        if self.authorizer.may_reply(chat_id):
+            UNAUTHORIZED.labels('answered').inc()
+            await self._send_text_msg(chat_id, 'Unauthorized!')
+        else:
+            UNAUTHORIZED.labels('dropped').inc()
+
+        return False
     
-    def _send_text_msg_to_lst(self, lst: UserDict, text: str) -> None:
-        ''' Sends message to list of chat_ids
+    async def _send_text_msg_to_lst(self, lst: UserDict, text: str) -> DeliveryStats:
+        ''' Sends message to list of chat_ids concurrently
 
             #: lst  - list of chat_ids
             #: text - message text
         '''
         
-        #: Iterate over given list and send message to each user
-        for user in lst: 
-            self.updater.bot.send_message(chat_id=user, text=text)
+        return await self.broadcaster.broadcast(lst, lambda chat_id: self._api_call('send_message', chat_id=chat_id, text=text))
     
-    def _send_text_msg(self, chat_id: int, text: str) -> Message:
+    async def _send_text_msg(self, chat_id: int, text: str) -> Message:
         ''' Sends message to chat_id
 
             #: chat_id  - telegram chat_id
             #: text     - message text
         '''
-        return self.updater.bot.send_message(chat_id=chat_id, text=text)
+        return await self._api_call('send_message', chat_id=chat_id, text=text)
 
-    def error_handler(self, update: Update, context: CallbackContext) -> None:
-        ''' #TODO
+    async def _api_call(self, method: str, **kwargs):
+        ''' Calls a Bot API method, counts and times it
+
+            #: method - name of the telegram.Bot method, e.g. 'send_message'
         '''
 
-        #: Log the error 
-        self.logger.error(msg='Exception while handling an update:', exc_info=context.error)
-        self.logger.debug('Refreshing bot ...')
+        started = time.monotonic()
+        try:
+            result = await getattr(self.application.bot, method)(**kwargs)
 
-        #: Inform owner
-        message: Message = self._send_text_msg(self.userservice.owner.chat_id, 'Refreshing bot ...')
+        except RetryAfter:
+            BOT_REQUESTS.labels(method, 'rate_limited').inc()
+            raise
 
-        #: Rebuild updater and dispatcher
-        self._setup()
+        except TelegramError:
+            BOT_REQUESTS.labels(method, 'failed').inc()
+            raise
 
-        self.logger.debug('Bot refreshed')
+        BOT_REQUESTS.labels(method, 'ok').inc()
+        BOT_REQUEST_LATENCY.labels(method).observe(time.monotonic() - started)
 
-        #: Update message, refreshing done
-        message.edit_text('Bot refreshed.')
+        return result
 
+    async def error_handler(self, update: object, context: CallbackContext) -> None:
+        ''' Logs errors raised by handlers and informs the owner
 
+            #: The application keeps running, a failing handler only affects its own update
+        '''
 
+        #: Log the error 
+        self.logger.error(msg='Exception while handling an update:', exc_info=context.error)
 
+        #: Inform owner
+        owner: User = self.userservice.owner
+        if owner:
+            await self._send_text_msg(owner.chat_id, 'Error while handling an update: {}'.format(context.error))
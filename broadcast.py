@@ -0,0 +1,201 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterable, List
+
+from telegram.error import RetryAfter, TelegramError
+
+import config as cfg
+
+
+class TokenBucket():
+    ''' Thread-safe token bucket
+
+        #: rate     - tokens added per second
+        #: capacity - max tokens, allows short bursts
+    '''
+
+    def __init__(self, rate: float, capacity: float = 1, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        ''' Takes a token, possibly in advance
+
+            #: return -> seconds to wait until the taken token is actually available
+        '''
+
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self) -> None:
+        ''' Blocks until a token is available
+        '''
+
+        time.sleep(self.reserve())
+
+    def try_acquire(self) -> bool:
+        ''' Takes a token only if one is available right away
+        '''
+
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+    def is_full(self) -> bool:
+        ''' Whether the bucket refilled completely, it then behaves like a new one
+        '''
+
+        with self._lock:
+            return self.tokens + (self.clock() - self.updated) * self.rate >= self.capacity
+
+
+@dataclass
+class DeliveryStats():
+    ''' Result of a broadcast
+    '''
+
+    recipients: int = 0
+    delivered: int = 0
+    retries: int = 0
+    failed: List[int] = field(default_factory=list)
+    duration: float = 0.0
+
+    def __str__(self):
+        return '{}/{} delivered, {} retries, {} failed in {:.2f} s'.format(self.delivered, self.recipients, self.retries, len(self.failed), self.duration)
+
+
+class Broadcaster():
+    ''' Sends to many chats concurrently within telegrams rate limits
+
+        #: Every send takes a token from the chat's and from the global bucket,
+        #: at most concurrency sends are in flight at once
+        #: Buckets of chats are kept by last use, idle ones that refilled are dropped
+        #: RetryAfter is retried after the requested time, up to max_retries times
+    '''
+
+    def __init__(self, concurrency: int = cfg.BOT_SEND_WORKERS, global_rate: float = cfg.BROADCAST_GLOBAL_RATE, per_chat_rate: float = cfg.BROADCAST_PER_CHAT_RATE, max_retries: int = cfg.BROADCAST_MAX_RETRIES):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.concurrency = concurrency
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        #: Created on the event loop by the first send, on Python < 3.10 it would bind to the loop of the creating thread
+        self._semaphore: asyncio.Semaphore = None
+
+    async def broadcast(self, chat_ids: Iterable[int], send: Callable[[int], Awaitable]) -> DeliveryStats:
+        ''' Awaits send for every chat_id concurrently
+
+            #: return -> DeliveryStats once every send finished
+        '''
+
+        chat_ids = list(chat_ids)
+        stats = DeliveryStats(recipients=len(chat_ids))
+        started = time.monotonic()
+
+        for chat_id, (retries, delivered) in zip(chat_ids, await asyncio.gather(*(self._deliver(chat_id, send) for chat_id in chat_ids))):
+            stats.retries += retries
+
+            if delivered:
+                stats.delivered += 1
+            else:
+                stats.failed.append(chat_id)
+
+        stats.duration = time.monotonic() - started
+        if chat_ids:
+            self.logger.debug('Broadcast finished: {}'.format(stats))
+
+        return stats
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+            self.chat_buckets.move_to_end(chat_id)
+
+            #: The least recently used buckets come first, a full one is the same as a new one
+            while len(self.chat_buckets) > 1:
+                oldest = next(iter(self.chat_buckets.values()))
+                if not oldest.is_full():
+                    break
+                self.chat_buckets.popitem(last=False)
+
+            return bucket
+
+    async def _deliver(self, chat_id: int, send: Callable[[int], Awaitable]) -> tuple:
+        ''' Sends to one chat within the rate limits
+
+            #: Waiting for tokens does not take up one of the concurrent sends
+            #: return -> (number of retries, whether or not the send succeeded)
+        '''
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+            await asyncio.sleep(self.global_bucket.reserve())
+
+            try:
+                async with self._semaphore:
+                    await send(chat_id)
+                return (attempt, True)
+
+            except RetryAfter as e:
+                self.logger.debug('Rate limited sending to {}, retry in {} s'.format(chat_id, e.retry_after))
+                await asyncio.sleep(float(e.retry_after))
+
+            except TelegramError as e:
+                self.logger.warning('Sending to {} failed: {}'.format(chat_id, e))
+                return (attempt, False)
+
+        return (self.max_retries, False)
+
+
+if __name__ == '__main__':
+
+    from simulation.botapi import FakeBot
+
+    async def benchmark():
+
+        #: Benchmark: sequential sends against the broadcaster, fake api with 50 ms latency per request
+        for recipients in (1, 50, 500):
+            bot = FakeBot(latency=0.05)
+
+            started = time.monotonic()
+            for chat_id in range(recipients):
+                await bot.send_message(chat_id=chat_id, text='Motion detected')
+            sequential = time.monotonic() - started
+
+            stats = await Broadcaster().broadcast(range(recipients), lambda chat_id: bot.send_message(chat_id=chat_id, text='Motion detected'))
+
+            print('{:4} recipients: sequential {:6.2f} s | broadcast {}'.format(recipients, sequential, stats))
+
+    asyncio.run(benchmark())
@@ -1,87 +1,288 @@
-from picamera import PiCamera
+import io
+import time
 import logging
 import string
+from datetime import datetime
+from concurrent.futures import Future
+from typing import List, Tuple, Union
 
 import config as cfg
+import metrics
 import utils
+import profiles
+from clip import Clip
+from converter import Converter
+from profiles import EncodingProfile
+
+CONVERSIONS = metrics.counter('surveillance_conversions', 'Finished conversions by result', ('result',))
+SNAPSHOT_LATENCY = metrics.histogram('surveillance_snapshot_seconds', 'Time to capture a still frame')
 
 
 class Camera():
-    ''' #TODO
+    ''' Wrapper around the PiCamera recording api
+
+        #: With CAMERA_CONTINUOUS_CAPTURE the encoder permanently writes into a ring buffer,
+        #: recordings then start with the buffered seconds before the trigger (pre-roll)
+        #: Conversion runs in the background, stop_recording does not wait for it
     '''
-    
-    def __init__(self):
-        ''' #TODO
+
+    def __init__(self, cam = None, circular_io = None, converter: Converter = None):
+        ''' Inits the camera, cam and circular_io allow to replace the PiCamera backend
         '''
-        
+
         #: PiCam setup
-        self.cam = PiCamera()
-        self.cam.resolution = (1280, 720)
-        
+        if cam is None:
+            from picamera import PiCamera, PiCameraCircularIO
+            cam, circular_io = PiCamera(), PiCameraCircularIO
+
+        #: Encoder settings, the optional downscale profile is applied after the conversion
+        self.profile: EncodingProfile = profiles.active_profile()
+        self.downscale: EncodingProfile = profiles.downscale_profile()
+
+        self.cam = cam
+        self.cam.resolution = self.profile.resolution
+        self.cam.framerate = self.profile.framerate
+
         #: init logger
         self.logger = logging.getLogger(__name__)
-        
+
         #: init variables
         self.is_recording = False
         self.rec_extension = cfg.CAMERA_RECORDING_FORMAT
         self.convert_extension = cfg.CAMERA_CONVERTING_FORMAT
         self.video_dir = '{path}/{directory}'.format(path = cfg.FILE_PATH, directory = cfg.VIDEO_DIR)
+        self.continuous = cfg.CAMERA_CONTINUOUS_CAPTURE
+        self.stream = None
+        self.clip: Clip = None
 
-    def start_recording(self) -> None:
-        ''' #TODO
+        #: Recording outputs of the current clip in playback order
+        self.outputs: List[Union[str, io.BytesIO]] = []
+
+        #: Background conversion, in-process muxing records into memory instead of .h264 files
+        self.converter = converter or Converter()
+
+        #: Optionally the motion vectors of the encoder are analysed, see motion.py
+        self.motion = None
+        if cfg.MOTION_VECTORS:
+            from motion import MotionVectorAnalysis
+            self.motion = MotionVectorAnalysis(self.profile.resolution, self.profile.framerate)
+
+        if self.continuous:
+            self._start_continuous_capture(circular_io)
+
+    def _start_continuous_capture(self, circular_io) -> None:
+        ''' Starts the encoder writing into a bounded ring buffer
+        '''
+
+        #: Size for the pre-roll plus two groups of pictures (keyframe wait and alignment), capped by the memory budget
+        size = min(cfg.CAMERA_PRE_ROLL_BUFFER_BYTES, self.profile.bytes_per_second * (cfg.CAMERA_PRE_ROLL_SECONDS + 2))
+
+        self.stream = circular_io(self.cam, size=size)
+
+        self.cam.start_recording(self.stream, **self._encoder_options())
+        self.logger.debug('continuous capture started [profile: {}, {} kbps, buffer: {} bytes]'.format(self.profile.name, self.profile.bitrate // 1000, size))
+
+    def start_recording(self, incident: str = None) -> None:
+        ''' Starts a new recording, which is the first segment of a new incident
+
+            #: In continuous mode, the encoder output is split into the video file
+            #: and the buffered pre-roll is flushed into a separate file
+            #: incident names the incident, by default the current time
         '''
-        
+
         #: Only start if camera is currently not active
         if not self.is_recording:
-            
-            #: Set video name
-            self.video_name = utils.timestring()
-            
-            #: Start PiCamera recording
+
+            #: Set video name, the first segment is named after the incident
+            self.video_name = incident or utils.timestring()
+            self.clip = Clip(self._get_video_path(self.video_name, self.convert_extension), self.video_name, 0, datetime.now())
             self.is_recording = True
-            self.cam.start_recording(self._get_video_path(self.video_name, self.rec_extension))
+            self.segment_started = time.monotonic()
+            self.outputs = self._new_outputs(self.video_name, self.continuous)
+
+            if self.continuous:
+
+                #: Redirect live frames first, so no frame is lost between pre-roll and recording
+                #: The split waits for the next keyframe and copy_to starts at the first keyframe in the window,
+                #: so the window is extended by the wait and one group of pictures
+                self.cam.split_recording(self.outputs[1])
+                self.stream.copy_to(self.outputs[0], seconds=cfg.CAMERA_PRE_ROLL_SECONDS + time.monotonic() - self.segment_started + 1)
+                self.stream.clear()
+
+            else:
+
+                #: Start PiCamera recording
+                self.cam.start_recording(self.outputs[0], **self._encoder_options())
+
             self.logger.debug('recording started: {}'.format(self.video_name + self.rec_extension))
-        
-    def stop_recording(self) -> str:
-        ''' #TODO
+
+    def _encoder_options(self) -> dict:
+        ''' Encoder settings of the profile, the motion vectors go to the analysis
+
+            #: Splits only switch the video output, the motion output stays
+        '''
+
+        options = self.profile.encoder_options()
+        if self.motion:
+            options['motion_output'] = self.motion
+
+        return options
+
+    def snapshot(self) -> Union[str, None]:
+        ''' Captures a still frame as JPEG
+
+            #: The frame is taken from the video port, a running recording is not interrupted
+            #: return -> path of the JPEG, None if capturing failed
+        '''
+
+        path = self._get_video_path(utils.timestring() + '-snapshot', '.jpg')
+
+        try:
+            with SNAPSHOT_LATENCY.time():
+                self.cam.capture(path, format='jpeg', use_video_port=True, quality=cfg.CAMERA_SNAPSHOT_QUALITY)
+        except Exception as e:
+            self.logger.warning('Snapshot failed: {}'.format(e))
+            return None
+
+        return path
+
+    def start_analysis(self, output, resolution: Tuple[int, int], splitter_port: int) -> None:
+        ''' Streams unencoded YUV frames at the given resolution into output, next to the recording
+
+            #: The GPU scales the frames, output.write receives one frame per call
+        '''
+
+        self.cam.start_recording(output, format='yuv', resize=resolution, splitter_port=splitter_port)
+        self.logger.debug('analysis started [{}x{}, splitter port {}]'.format(*resolution, splitter_port))
+
+    def rollover(self) -> Union[Future, None]:
+        ''' Finishes the current segment without stopping the encoder
+
+            #: The output is split at the next keyframe, so consecutive segments are contiguous
+            #: return -> future resolving to the clip of the finished segment, None if not recording
+        '''
+
+        if not self.is_recording:
+            return None
+
+        #: save clip and outputs of the finished segment
+        clip, outputs = self.clip, self.outputs
+
+        #: Next segment of the same incident
+        self.video_name = '{}-{}'.format(clip.incident, clip.segment + 1)
+        self.clip = Clip(self._get_video_path(self.video_name, self.convert_extension), clip.incident, clip.segment + 1, datetime.now())
+        self.outputs = self._new_outputs(self.video_name, False)
+
+        self.cam.split_recording(self.outputs[0])
+        clip.duration = self._segment_duration()
+
+        self.logger.debug('recording split: {} -> {}'.format(clip.name, self.video_name + self.rec_extension))
+        return self._convert(clip, outputs)
+
+    def stop_recording(self) -> Union[Future, None]:
+        ''' Stops the current recording and queues its conversion
+
+            #: return -> future resolving to the clip of the converted video, None if not recording
         '''
 
         if self.is_recording:
-            
-            #: save name in case a new video with different name starts during conversion
-            self.converting_name = self.video_name
 
-            #: Stop PiCamera recording
-            self.cam.stop_recording()
-            self.logger.debug('recording stopped: {}'.format(self.converting_name + self.convert_extension))
+            #: save clip and outputs in case a new video starts during conversion
+            clip, outputs = self.clip, self.outputs
+
+            #: Stop PiCamera recording, or hand the encoder back to the ring buffer
+            if self.continuous:
+                self.cam.split_recording(self.stream)
+            else:
+                self.cam.stop_recording()
+
+            clip.duration = self._segment_duration()
+
+            self.logger.debug('recording stopped: {}'.format(clip.name))
             self.is_recording = False
-            self._convert()
-            return self._get_video_path(self.converting_name, self.convert_extension)
-        
+            return self._convert(clip, outputs)
+
         return None
-    
+
+    def _segment_duration(self) -> float:
+        ''' Gets the live recording time of the current segment and starts timing the next one
+        '''
+
+        now = time.monotonic()
+        duration, self.segment_started = now - self.segment_started, now
+        return duration
+
+    def _new_outputs(self, name: str, pre_roll: bool) -> List[Union[str, io.BytesIO]]:
+        ''' Creates the recording outputs of a clip in playback order
+
+            #: return -> pre-roll output (if requested) and recording output
+            #:           as file paths, or as in-memory streams for the in-process muxer
+        '''
+
+        if self.converter.in_process:
+            return [io.BytesIO() for _ in range(2 if pre_roll else 1)]
+
+        outputs = [self._get_video_path(name, self.rec_extension)]
+        if pre_roll:
+            outputs.insert(0, self._get_pre_roll_path(name))
+
+        return outputs
+
     def _get_video_path(self, name: str, extension: str) -> str:
         ''' #TODO
         '''
 
         return '{folder}/{name}{extension}'.format(folder = self.video_dir, name = name, extension = extension)
-        
-    def _convert(self) -> None:
-        ''' Converts video captured by PiCamera in known format and deletes old video
+
+    def _get_pre_roll_path(self, name: str) -> str:
+        ''' Gets the path of the pre-roll file belonging to the video with given name
+        '''
+
+        return self._get_video_path(name + '-pre', self.rec_extension)
+
+    def _convert(self, clip: Clip, outputs: List[Union[str, io.BytesIO]]) -> Future:
+        ''' Queues the conversion of the captured video into the known format
+
+            #: The pre-roll and the recording are concatenated into one video
+            #: The converter deletes the .h264 files afterwards
+            #: With a downscale profile, the downscaled copy is queued once the video is converted
+            #: With motion vectors, the activity timeline of the clip is attached once it is converted
+
+            #: return -> future resolving to the clip once the conversion is done
         '''
-        
-        #: Get current filename, and filename after converting
-        before = self._get_video_path(self.converting_name, self.rec_extension)
-        after  = self._get_video_path(self.converting_name, self.convert_extension)
-        
-        #: Convert command (with semicolon to concatenate)
-        convert = 'MP4Box -add {before} {after};'.format(before = before, after = after)
-        
-        #: Delete command
-        delete = ' rm {file}'.format(file=before)
-        
-        #: Execute both
-        utils.shell_cmd(convert + delete)
-        self.logger.debug('convert and delete video')
-        
-        
+
+        clip.stopped = time.monotonic()
+
+        #: The first segment starts with the pre-roll
+        started = clip.stopped - clip.duration
+        if self.continuous and not clip.segment:
+            started -= cfg.CAMERA_PRE_ROLL_SECONDS
+
+        #: In-memory recordings are joined and muxed without touching the disk
+        if self.converter.in_process:
+            source = b''.join(output.getvalue() for output in outputs)
+        else:
+            source = outputs
+
+        conversion = self.converter.submit(source, clip.path, self.profile.framerate)
+
+        #: Resolve to the clip instead of the bare path
+        converted: Future = Future()
+
+        def done(conversion: Future) -> None:
+            if conversion.exception():
+                CONVERSIONS.labels('failed').inc()
+                converted.set_exception(conversion.exception())
+            else:
+                CONVERSIONS.labels('ok').inc()
+                if self.motion:
+                    clip.activity = self.motion.timeline(started, clip.stopped)
+                if self.downscale:
+                    clip.downscaled = self.converter.transcode(clip.path, profiles.downscaled_path(clip.path, self.downscale), self.downscale)
+                converted.set_result(clip)
+
+        conversion.add_done_callback(done)
+
+        return converted
+
+
@@ -0,0 +1,260 @@
+import os
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from typing import List, NamedTuple, Tuple, Union
+
+import config as cfg
+from clip import Clip
+
+#: Delivery status of a clip
+PENDING = 'pending'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+
+class Entry(NamedTuple):
+    ''' Recorded clip as listed by /videos
+    '''
+
+    id: int
+    path: str
+    incident: str
+    segment: int
+    started: datetime
+    duration: float
+    size: int
+    file_id: Union[str, None]
+    status: str
+    deleted: bool
+
+    @property
+    def clip(self) -> Clip:
+        return Clip(self.path, self.incident, self.segment, self.started, self.duration)
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        ''' Position in the catalog, clips are ordered by start time and id
+        '''
+
+        return (self.started.isoformat(), self.id)
+
+
+class Page(NamedTuple):
+    ''' Clips of one page, newest first, within the date filter since (inclusive) to until (exclusive)
+    '''
+
+    entries: List[Entry]
+    since: Union[date, None]
+    until: Union[date, None]
+    has_newer: bool
+    has_older: bool
+
+    @property
+    def first(self) -> Tuple[str, int]:
+        return self.entries[0].key
+
+    @property
+    def last(self) -> Tuple[str, int]:
+        return self.entries[-1].key
+
+
+class Catalog():
+    ''' Index of all recorded clips with their delivery status
+
+        #: Clips are added when their conversion is done, uploads and evictions update them
+        #: Pages are read by keyset pagination on (started, id), so a page costs the same
+        #: no matter how many clips there are and how far back it is
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS clips (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            path     TEXT UNIQUE NOT NULL,
+            incident TEXT NOT NULL,
+            segment  INTEGER NOT NULL DEFAULT 0,
+            started  TEXT NOT NULL,
+            duration REAL,
+            size     INTEGER,
+            file_id  TEXT,
+            status   TEXT NOT NULL DEFAULT 'pending',
+            deleted  INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS clips_started ON clips (started, id);
+    '''
+
+    _COLUMNS = 'id, path, incident, segment, started, duration, size, file_id, status, deleted'
+
+    def __init__(self, path: str = cfg.CATALOG_PATH, page_size: int = cfg.VIDEOS_PAGE_SIZE):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.page_size = page_size
+
+        #: Without a path the catalog only lives in memory
+        self._connection = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, clip: Clip) -> int:
+        ''' Adds a converted clip
+
+            #: return -> id of the clip
+        '''
+
+        try:
+            size = os.path.getsize(clip.path)
+        except OSError:
+            size = None
+
+        started = clip.started or datetime.now()
+
+        with self._lock, self._connection:
+            return self._connection.execute('INSERT OR REPLACE INTO clips (path, incident, segment, started, duration, size) VALUES (?, ?, ?, ?, ?, ?)',
+                                            (clip.path, clip.incident, clip.segment, started.isoformat(), clip.duration, size)).lastrowid
+
+    def delivered(self, path: str, file_id: str) -> None:
+        ''' Marks a clip as uploaded and remembers its file_id for later retrieval
+        '''
+
+        self._execute('UPDATE clips SET status = ?, file_id = ? WHERE path = ?', (DELIVERED, file_id, path))
+
+    def failed(self, path: str) -> None:
+        ''' Marks a clip as given up by the spool, unless it reached someone
+        '''
+
+        self._execute('UPDATE clips SET status = ? WHERE path = ? AND status = ?', (FAILED, path, PENDING))
+
+    def uploaded(self, path: str, file_id: str) -> None:
+        ''' Remembers the file_id of a clip uploaded again
+        '''
+
+        self._execute('UPDATE clips SET file_id = ? WHERE path = ?', (file_id, path))
+
+    def deleted(self, path: str) -> None:
+        ''' Marks the file of a clip as deleted, clips without a file_id can not be retrieved anymore and are removed
+        '''
+
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM clips WHERE path = ? AND file_id IS NULL', (path,))
+            self._connection.execute('UPDATE clips SET deleted = 1 WHERE path = ?', (path,))
+
+    def get(self, id: int) -> Union[Entry, None]:
+        with self._lock:
+            row = self._connection.execute('SELECT {} FROM clips WHERE id = ?'.format(self._COLUMNS), (id,)).fetchone()
+
+        return self._entry(row) if row else None
+
+    def page(self, since: date = None, until: date = None, before: Tuple[str, int] = None, after: Tuple[str, int] = None) -> Page:
+        ''' Gets a page of clips, newest first
+
+            #: before - key of a clip, the page holds the next older clips
+            #: after  - key of a clip, the page holds the next newer clips
+            #: Without either, the page holds the newest clips
+        '''
+
+        conditions, params = [], []
+        if since:
+            conditions.append('started >= ?')
+            params.append(since.isoformat())
+        if until:
+            conditions.append('started < ?')
+            params.append(until.isoformat())
+
+        if after:
+            conditions.append('(started, id) > (?, ?)')
+            params += after
+            order = 'ASC'
+        else:
+            if before:
+                conditions.append('(started, id) < (?, ?)')
+                params += before
+            order = 'DESC'
+
+        sql = 'SELECT {} FROM clips {} ORDER BY started {order}, id {order} LIMIT ?'.format(
+            self._COLUMNS, 'WHERE ' + ' AND '.join(conditions) if conditions else '', order=order)
+
+        #: One more than a page tells whether there are more
+        with self._lock:
+            rows = self._connection.execute(sql, params + [self.page_size + 1]).fetchall()
+
+        more = len(rows) > self.page_size
+        entries = [self._entry(row) for row in rows[:self.page_size]]
+
+        if after:
+            entries.reverse()
+            return Page(entries, since, until, has_newer=more, has_older=True)
+
+        return Page(entries, since, until, has_newer=bool(before), has_older=more)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(sql, params)
+
+    @staticmethod
+    def _entry(row: tuple) -> Entry:
+        id, path, incident, segment, started, duration, size, file_id, status, deleted = row
+        return Entry(id, path, incident, segment, datetime.fromisoformat(started), duration, size, file_id, status, bool(deleted))
+
+
+def parse_date_range(args: List[str], today: date = None) -> Tuple[Union[date, None], Union[date, None]]:
+    ''' Date filter of /videos
+
+        #: []                       -> no filter
+        #: ['2022-05-01']            -> that day
+        #: ['2022-05-01', '2022-05-07'] -> both days and every day between
+        #: 'today' and 'yesterday' are understood as well
+        #: return -> since (inclusive) and until (exclusive), raises ValueError for anything else
+    '''
+
+    today = today or date.today()
+    named = {'today': today, 'yesterday': today - timedelta(days=1)}
+
+    days = [named[arg.lower()] if arg.lower() in named else date.fromisoformat(arg) for arg in args]
+
+    if not days:
+        return (None, None)
+    if len(days) > 2:
+        raise ValueError('At most two dates')
+
+    since, until = min(days), max(days)
+    return (since, until + timedelta(days=1))
+
+
+if __name__ == '__main__':
+
+    import time
+
+    #: Benchmark: first and last page of 100000 clips, keyset pagination compared to OFFSET
+    catalog = Catalog(None, page_size=8)
+    started = datetime(2022, 1, 1)
+
+    with catalog._connection:
+        catalog._connection.executemany('INSERT INTO clips (path, incident, started, duration, size) VALUES (?, ?, ?, ?, ?)',
+                                        (('/videos/{}.mp4'.format(n), str(n), (started + timedelta(minutes=n)).isoformat(), 30.0, 10 ** 7) for n in range(100000)))
+
+    page = catalog.page()
+    pages = 1
+    measured = time.perf_counter()
+    while page.has_older:
+        page = catalog.page(before=page.last)
+        pages += 1
+    keyset = (time.perf_counter() - measured) / pages
+
+    measured = time.perf_counter()
+    for offset in range(0, 100000, 8 * 100):
+        catalog._connection.execute('SELECT {} FROM clips ORDER BY started DESC, id DESC LIMIT 9 OFFSET ?'.format(catalog._COLUMNS), (offset,)).fetchall()
+    offset = (time.perf_counter() - measured) / len(range(0, 100000, 8 * 100))
+
+    print('{} pages | keyset: {:.3f} ms per page | offset: {:.3f} ms per page (average over the whole catalog)'.format(pages, keyset * 1000, offset * 1000))
+
+    since, until = parse_date_range(['2022-01-02'])
+    print('2022-01-02: {} clips on the first page, older pages: {}'.format(len(catalog.page(since, until).entries), catalog.page(since, until).has_older))
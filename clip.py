@@ -0,0 +1,49 @@
+from datetime import datetime
+from dataclasses import dataclass
+from concurrent.futures import Future
+from typing import List
+
+import utils
+
+@dataclass
+class Clip():
+    ''' Metadata of a recorded video
+
+        #: Consecutive segments of one continuous recording share the incident id
+    '''
+
+    path: str
+    incident: str
+    segment: int = 0
+    started: datetime = None
+    duration: float = 0.0
+
+    #: monotonic time the recording of the clip ended
+    stopped: float = None
+
+    #: future resolving to the path of the downscaled copy, None without CAMERA_DOWNSCALE_PROFILE
+    downscaled: Future = None
+
+    #: activity of the picture per second from 0 to 1, None without MOTION_VECTORS
+    activity: List[float] = None
+
+    @property
+    def name(self) -> str:
+        return utils.basename(self.path)
+
+    @property
+    def caption(self) -> str:
+        caption = self.name
+        if self.segment:
+            caption = '{} [incident {}, part {}]'.format(self.name, self.incident, self.segment + 1)
+
+        #: Timeline of the activity in the picture below the name
+        if self.activity:
+            caption += '\n' + utils.sparkline(self.activity)
+
+        return caption
+
+if __name__ == '__main__':
+
+    print(Clip('/videos/2022-05-01-CEST-12-00-00-1.mp4', '2022-05-01-CEST-12-00-00', 1).caption)
+    print(Clip('/videos/2022-05-01-CEST-12-00-00.mp4', '2022-05-01-CEST-12-00-00', activity=[0, 0, 0.2, 0.8, 1, 1, 0.5, 0.1]).caption)
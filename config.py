@@ -27,37 +27,259 @@ import os
 TELEGRAM_API_TOKEN='<TELEGRAM_API_TOKEN>'
 OWNER_ACTIVATION_TOKEN='<OWNER_ACTIVATION_TOKEN>'
 
+#: Bot API endpoint, the token is appended (None -> https://api.telegram.org/bot)
+#: Allows using a local Bot API server, or the fake server of the simulation package
+TELEGRAM_API_URL=None
+
+#: Max seconds between attempts to reach telegram at the start, the bot keeps trying until the network is up
+BOT_CONNECT_BACKOFF_MAX=60
+
+#: Public https url telegram pushes updates to, e.g. 'https://example.org/telegram' (None -> long polling)
+#: The webhook listens on TELEGRAM_WEBHOOK_LISTEN:TELEGRAM_WEBHOOK_PORT at the path of the url,
+#: either behind a reverse proxy terminating tls, or with tls itself if a certificate and key are given
+#: A self-signed certificate is uploaded to telegram when the webhook is registered
+#: If the webhook can not be registered, the bot falls back to long polling
+TELEGRAM_WEBHOOK_URL=None
+TELEGRAM_WEBHOOK_LISTEN='127.0.0.1'
+TELEGRAM_WEBHOOK_PORT=8443
+TELEGRAM_WEBHOOK_CERT=None
+TELEGRAM_WEBHOOK_KEY=None
+
+#: Secret telegram sends with every update, requests without it are rejected (None -> random per start)
+TELEGRAM_WEBHOOK_SECRET=None
+
+#: Whether motion is detected right after the start, as soon as camera and sensor are ready, without waiting for /unpause
+#: Alerts are queued until the bot reached telegram, e.g. when the network comes back later than the power
+SURVEILLANCE_ACTIVE_ON_START=False
+
 #: GPIO-Pin for motion-detection
 #: Attention: GPIO 4 -> Pin 7 
 #: Research `Raspberry Pi Zero Pinout` for more information
 SENSOR_PIN=4
 
+#: Seconds a sensor level has to be stable before it counts, shorter pulses are treated as bouncing
+SENSOR_DEBOUNCE=0.02
+
+#: Motion end is only reported if no motion starts again within this time in seconds
+#: The sensor itself already stays on for around 2 seconds, 0 keeps that behaviour
+SENSOR_HOLD_TIME=0.0
+
+#: Number of sensor edges that can be queued for the dispatcher
+SENSOR_EVENT_BUFFER=1024
+
 #: Adjust buffer to keep video going without motion
 #: The motion sensor stays on for around 2 seconds after the last movement
-#: Every step is roughly 1 second
-#: BUFFER_TIME_STEPS=2 would therefore result in around 4 seconds buffer time
-#: meaning that the recording will be stopped if for 4 seconds no motion is detected
+#: The buffer time is BUFFER_TIME_STEPS * BUFFER_TIME_STEP_LENGTH seconds, both may be fractions
+#: The recording stops once the sensor reported no motion for the buffer time, with the defaults 2 seconds
+#: after the sensor went off, which is around 4 seconds after the last movement
 BUFFER_TIME_STEPS=2
+BUFFER_TIME_STEP_LENGTH=1.0
 
 #: Set a max video length since long videos may cause problems while sending
-#: This is no exact time, because its done using time.sleep()
-#: The rest of the program also takes time
-#: MAX_VIDEO_LENGTH=30 results in videos with around 33 to 36 seconds
+#: The recording is stopped exactly at this deadline, measured from the start of the recording
+#: With CAMERA_CONTINUOUS_CAPTURE the pre-roll comes on top
 MAX_VIDEO_LENGTH=30
 
+#: Split recordings at MAX_VIDEO_LENGTH instead of stopping and restarting them
+#: Segments are contiguous (no footage is lost) and are sent while the next one records,
+#: there is only one alert per incident
+CAMERA_SEGMENTED_RECORDING=True
+
 #: Path to current directory
 FILE_PATH=os.path.abspath(__file__).rsplit('/', 1)[0]
 
+#: SQLite database keeping users, banned users, tokens and the owner across restarts (None to disable)
+DATABASE_PATH='{}/{}'.format(FILE_PATH, 'bot.db')
+
+#: Changes are written in the background, once per flush interval in seconds
+#: After a crash, at most the changes of the last interval are lost
+DATABASE_FLUSH_INTERVAL=0.5
+DATABASE_BATCH=1000
+
 #: Name of directory in which the videos will be saved
 VIDEO_DIR='videos'
 
+#: Videos are deleted oldest first once they take more than VIDEO_QUOTA_BYTES,
+#: are older than VIDEO_MAX_AGE seconds (None to keep them) or less than VIDEO_MIN_FREE_BYTES are left on the disk
+#: Videos that were not delivered to everyone yet are kept
+VIDEO_QUOTA_BYTES=8 * 1000 ** 3
+VIDEO_MAX_AGE=30 * 24 * 3600
+VIDEO_MIN_FREE_BYTES=1000 ** 3
+
+#: Seconds between checks of the max age, new videos are checked right away
+RETENTION_INTERVAL=600
+
+#: SQLite catalog of all recorded clips, listed by /videos (None keeps it in memory only)
+CATALOG_PATH='{}/{}'.format(FILE_PATH, 'catalog.db')
+
+#: Clips per page of /videos
+VIDEOS_PAGE_SIZE=8
+
+#: Roles of this many chats are cached for the authorization of commands, changes drop a chat from the cache
+AUTH_CACHE_SIZE=1000
+
+#: Unauthorized chats are answered at most UNAUTHORIZED_REPLY_RATE times per second each, after a burst of UNAUTHORIZED_REPLY_BURST,
+#: and at most UNAUTHORIZED_REPLY_GLOBAL_RATE times per second altogether, other commands of them are dropped silently
+UNAUTHORIZED_REPLY_RATE=1 / 60
+UNAUTHORIZED_REPLY_BURST=3
+UNAUTHORIZED_REPLY_GLOBAL_RATE=1
+
+#: Seconds an inline keyboard (/token, /ban, /unban, /videos) stays usable after it was last used
+#: At most CONVERSATION_MAX_ENTRIES keyboards are open at once, the least recently used ones expire first
+CONVERSATION_TTL=600
+CONVERSATION_MAX_ENTRIES=1000
+
+#: Every sweep interval in seconds, up to CONVERSATION_EXPIRE_BATCH expired keyboards are edited to expired
+CONVERSATION_SWEEP_INTERVAL=30
+CONVERSATION_EXPIRE_BATCH=20
+
+#: SQLite database of the arm and disarm windows set with /schedule (None keeps them in memory only)
+SCHEDULE_PATH='{}/{}'.format(FILE_PATH, 'schedule.db')
+
+#: Time zone the schedule times are in, an IANA name like 'Europe/Berlin' (None -> time zone of the system)
+SCHEDULE_TIMEZONE=None
+
 #: PiCamera records in .h264
 CAMERA_RECORDING_FORMAT='.h264'
 
 #: But .mp4 is causing less problems with compatibility
 CAMERA_CONVERTING_FORMAT='.mp4'
 
+#: Keep the encoder running into an in-memory ring buffer at all times
+#: On motion, the buffered seconds before the trigger are flushed into the clip
+#: Otherwise the encoder is only started after motion was detected and the first seconds are lost
+CAMERA_CONTINUOUS_CAPTURE=True
+
+#: Seconds of footage before the trigger that are added to every clip
+#: The clip starts at a keyframe, so up to one additional second may be included
+CAMERA_PRE_ROLL_SECONDS=3
+
+#: Memory budget of the ring buffer in bytes
+#: At the 17 Mbps of the 'high' profile, one second of video needs roughly 2 MB
+#: If the budget is too small for CAMERA_PRE_ROLL_SECONDS, the pre-roll gets shorter
+CAMERA_PRE_ROLL_BUFFER_BYTES=8 * 1024 * 1024
+
+#: Encoding profile of the recordings (see profiles.py, python3 profiles.py compares them)
+#: 'high'     -> 1280x720, 30 fps, 17 Mbps
+#: 'balanced' -> 1280x720, 25 fps, 4 Mbps
+#: 'low'      -> 854x480, 20 fps, 1.5 Mbps
+#: 'mobile'   -> 640x360, 15 fps, 600 kbps
+CAMERA_PROFILE='high'
+
+#: Max size of a clip in bytes, None to record at the bitrate of the profile
+#: The bitrate is lowered until the longest clip (MAX_VIDEO_LENGTH plus pre-roll) fits
+#: Bots can not upload files larger than 50 MB, at 17 Mbps a clip of 30 s is already 64 MB
+CAMERA_TARGET_CLIP_BYTES=45 * 1000 * 1000
+
+#: Profile of an additional downscaled copy of every clip, None to disable
+#: The copy is sent to LOW_BANDWIDTH_CHAT_IDS and to everyone if the original is too large to upload
+#: Transcoding re-encodes the clip with ffmpeg, which takes a while on the Pi
+CAMERA_DOWNSCALE_PROFILE=None
+
+#: Send a still frame with the motion alert, taken from the video port while the recording goes on
+CAMERA_SNAPSHOT=True
+
+#: JPEG quality of the still frame (1 - 100)
+CAMERA_SNAPSHOT_QUALITY=85
+
+#: Confirm radar motion with the camera before alerting and sending the video
+#: Low resolution frames of a splitter port are compared with a background model, see verification.py
+#: The recording starts on the radar trigger, alert and video follow once the camera confirmed the motion
+#: Recordings of incidents that end without confirmation are deleted
+MOTION_VERIFICATION=False
+
+#: Size of the analysed frames (width a multiple of 32, height of 16) and splitter port (0 is used by snapshots, 1 by the recording)
+VERIFY_RESOLUTION=(160, 96)
+VERIFY_SPLITTER_PORT=2
+
+#: Analysed frames per second, the others are skipped
+VERIFY_FRAMERATE=10
+
+#: Motion is confirmed after VERIFY_FRAMES frames in a row in which more than VERIFY_THRESHOLD of the pixels moved
+VERIFY_THRESHOLD=0.005
+VERIFY_FRAMES=3
+
+#: A pixel moved if it changed by more than VERIFY_PIXEL_THRESHOLD (0 - 255) since the last frame
+#: and deviates from the background by more than that and by more than VERIFY_DEVIATIONS standard deviations
+VERIFY_PIXEL_THRESHOLD=12
+VERIFY_DEVIATIONS=3
+
+#: Share of every frame learned into the background
+VERIFY_LEARNING_RATE=0.05
+
+#: Analyse the motion vectors the H.264 encoder computes for every frame, see motion.py
+#: If the radar and the picture disagree, the picture adjusts the end of the recording:
+#: after the radar went off, a moving picture keeps the recording going for up to MOTION_VECTORS_EXTEND seconds,
+#: while the radar stays on, a still picture ends the recording after MOTION_VECTORS_QUIET_TIME seconds
+#: Video captions get an activity timeline, one bar per second
+MOTION_VECTORS=False
+MOTION_VECTORS_EXTEND=10
+MOTION_VECTORS_QUIET_TIME=15
+
+#: A macroblock moves with a vector longer than MOTION_VECTORS_THRESHOLD
+#: The picture is split into MOTION_VECTORS_REGIONS (columns, rows), it is moving if MOTION_VECTORS_ACTIVE of the macroblocks of any region move
+MOTION_VECTORS_THRESHOLD=4
+MOTION_VECTORS_REGIONS=(4, 3)
+MOTION_VECTORS_ACTIVE=0.05
+
+#: Frames analysed at once, the picture is known to move at most this many frames late
+MOTION_VECTORS_BATCH=10
+
+#: Chat ids of admins on a slow connection, they receive the downscaled copy instead of the original
+LOW_BANDWIDTH_CHAT_IDS=[]
+
+#: Muxer used to convert recordings into the converting format
+#: 'mp4box'    -> MP4Box muxes the recorded .h264 files
+#: 'inprocess' -> recordings are kept in memory and muxed with PyAV (pip install av), no temporary .h264 files
+#:                Keep the memory in mind: a clip is held in memory up to CAMERA_TARGET_CLIP_BYTES, twice while it is
+#:                joined for the muxer, so on a Pi Zero (512 MB) lower CAMERA_TARGET_CLIP_BYTES to around 20 MB
+#:                Without PyAV, or without CAMERA_TARGET_CLIP_BYTES limiting the clips, MP4Box is used
+CONVERTER_MUXER='mp4box'
+
+#: Video encoder ffmpeg uses for the downscaled copy
+#: 'h264_v4l2m2m' is the hardware encoder of the Pi, 'libx264' encodes in software
+CONVERTER_TRANSCODE_CODEC='h264_v4l2m2m'
+
+#: Number of conversions running in parallel
+#: The Pi Zero has a single core, more workers only add contention
+CONVERTER_WORKERS=1
+
+#: Number of messages and videos sent at once, also the number of connections to the Bot API
+BOT_SEND_WORKERS=8
+
+#: Telegram allows around 30 messages per second overall and 1 message per second per chat
+#: Sends above these rates are delayed, RetryAfter responses are retried up to BROADCAST_MAX_RETRIES times
+BROADCAST_GLOBAL_RATE=30
+BROADCAST_PER_CHAT_RATE=1
+BROADCAST_MAX_RETRIES=3
+
+#: Alerts and videos are spooled to disk before they are sent (None keeps the spool in memory only)
+#: Pending deliveries survive restarts and network outages, each recipient receives them in order
+SPOOL_PATH='{}/{}'.format(FILE_PATH, 'spool.db')
+
+#: Failed deliveries are retried after SPOOL_RETRY_BASE seconds, doubled per attempt up to SPOOL_RETRY_MAX
+#: After SPOOL_MAX_ATTEMPTS attempts (2 to 3 hours with these values) a delivery is given up
+SPOOL_RETRY_BASE=2
+SPOOL_RETRY_MAX=600
+SPOOL_MAX_ATTEMPTS=25
+
+#: Max number of spooled items, the oldest are dropped when it is exceeded
+#: Only the next SPOOL_BATCH due deliveries are loaded into memory at once
+SPOOL_MAX_ITEMS=1000
+SPOOL_BATCH=100
+
 #: Length of user activation tokens
 #: With uppercase letters and digits and a length of 12 there are 4738381338321616896 possible tokens
 #: I reduced it to 8, 2821109907456 options should do just fine
 ACTIVATION_TOKEN_LENGTH=8
+
+#: Expired tokens are removed when they are looked up
+#: Additionally a background thread removes them every TOKEN_REAPER_INTERVAL seconds (None to disable)
+#: in batches of TOKEN_REAPER_BATCH tokens, so the token store is never locked for long
+TOKEN_REAPER_INTERVAL=3600
+TOKEN_REAPER_BATCH=100
+
+#: Metrics are always collected, the owner can read them with /stats
+#: With METRICS_PORT set, they are also served in the Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_PORT=None
+METRICS_HOST='127.0.0.1'
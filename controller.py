@@ -1,37 +1,135 @@
+import os
 import time
 import string
 import logging
-from threading import Thread
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+from typing import Callable, Dict, List, Union
 
 import config as cfg
-from camera import Camera
-from rcwl_0516 import RCWL_0516
-from bot import SurveillanceBot
+import metrics
+import utils
+from clip import Clip
+from converter import EmptyRecording
+from rcwl_0516 import GPIOBackend, RCWL_0516
+from retention import Retention
 from role import Role
+from startup import Startup
+
+RECORDINGS = metrics.counter('surveillance_recordings', 'Recordings started')
+RECORDING_ACTIVE = metrics.gauge('surveillance_recording_active', 'Whether or not an incident is being recorded')
+TRIGGER_LATENCY = metrics.histogram('surveillance_trigger_seconds', 'Time from the motion edge until the recording started')
+INCIDENT_LENGTH = metrics.histogram('surveillance_incident_seconds', 'Length of recorded incidents', buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+STOP_LATENCY = metrics.histogram('surveillance_stop_seconds', 'Time to stop a recording and queue its conversion')
 
 class Controller():
     
-    def __init__(self):
-        
-        #: Init bot, camera and motion detector
-        self.bot = SurveillanceBot(self.pause_unpause_callback)
-        self.camera =  Camera()
-        self.rcwl = RCWL_0516(self.motion_state_change_callback)
-        
-        #: Start detecting in dedicated thread
-        Thread(target = self.rcwl.detect).start()
-        
-        self.motion_active = False
-        
-        #: Logging setup
-        logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.DEBUG)
+    def __init__(self, camera: Union['Camera', Callable[[], 'Camera']] = None, gpio: GPIOBackend = None):
+        ''' Inits bot, camera and motion detector
+
+            #: camera and gpio allow replacing the hardware, e.g. with the simulation package,
+            #: camera may also be a function creating it, which is then called in the camera stage
+            #: Camera, sensor and bot start in parallel, motion is detected as soon as camera and sensor are ready,
+            #: alerts and videos are queued until the bot is up
+            #: Returns once every stage finished, the timings are in startup
+        '''
         
         #: Init logger
         self.logger = logging.getLogger(__name__)
+        self.startup = Startup()
         
-        self.surveillance_paused = True
-        self.no_detection_timeframe_start = None #TODO allow to set starttime of a no-detection timeframe
-        self.no_detection_timeframe_end = None #TODO allow to set endtime of a no-detection timeframe
+        #: Set by /pause, /unpause and the schedule of the bot, which wakes up only at its transitions,
+        #: so motion only has to check this flag
+        self.surveillance_paused = not cfg.SURVEILLANCE_ACTIVE_ON_START
+
+        #: Set once the bot is up, calls to it are queued until then
+        self.bot: 'SurveillanceBot' = None
+        self.retention: Retention = None
+        self.bot_lock = Lock()
+        self.deferred: List[Callable[[], None]] = []
+
+        #: Optionally the camera confirms radar triggers, until then alert and clips of the incident are held back
+        self.verifier = None
+        self.verification_lock = Lock()
+        self.incident: str = None
+        self.verdicts: Dict[str, bool] = OrderedDict()
+        self.held: List[Clip] = []
+        
+        #: Motion state, changes are signaled to the recording timer
+        self.motion_active = False
+        self.motion_started = time.monotonic()
+        self.motion_ended = time.monotonic()
+        self.motion_changed = Condition()
+
+        #: Held while a recording thread is running, so flapping edges cant start a second one
+        self.recording_lock = Lock()
+
+        #: Optionally serve the metrics for prometheus
+        if cfg.METRICS_PORT:
+            self.metrics_server = metrics.MetricsServer(cfg.METRICS_PORT, cfg.METRICS_HOST).start()
+
+        #: Init camera, motion detector and bot in parallel
+        self.startup.run('camera', self._start_camera, camera)
+        self.startup.run('sensor', lambda: RCWL_0516(self.motion_state_change_callback, backend = gpio))
+        self.startup.run('bot', self._start_bot)
+
+        #: Start detecting, edges are dispatched by a dedicated thread
+        self.camera, self.rcwl = self.startup.wait('camera', 'sensor')
+        self.rcwl.detect()
+        self.startup.mark('armed')
+
+        self.startup.wait('bot')
+        self.logger.info('Startup finished: {}'.format(self.startup.summary()))
+
+    def _start_camera(self, camera: Union['Camera', Callable[[], 'Camera']]) -> 'Camera':
+        ''' Camera stage, picamera and numpy are only imported here
+        '''
+
+        if camera is None:
+            from camera import Camera
+            camera = Camera()
+        elif callable(camera):
+            camera = camera()
+
+        if cfg.MOTION_VERIFICATION:
+            from verification import MotionVerifier
+            self.verifier = MotionVerifier(self._motion_verified)
+            camera.start_analysis(self.verifier, self.verifier.resolution, cfg.VERIFY_SPLITTER_PORT)
+
+        return camera
+
+    def _start_bot(self) -> 'SurveillanceBot':
+        ''' Bot stage, connects to telegram and sends what was queued meanwhile
+        '''
+
+        from bot import SurveillanceBot
+        bot = SurveillanceBot(self.pause_unpause_callback)
+        self.startup.mark('connected')
+        camera, = self.startup.wait('camera')
+
+        #: Queued calls are made while holding the lock, so later ones can not overtake them
+        with self.bot_lock:
+
+            #: Deletes old videos in the background, videos waiting for delivery are kept
+            self.retention = Retention(camera.video_dir, pinned = bot.pending_files, on_evict = bot.catalog.deleted).start()
+            self.bot = bot
+
+            for call in self.deferred:
+                call()
+            self.deferred = []
+
+        return bot
+
+    def _with_bot(self, call: Callable[[], None]) -> None:
+        ''' Calls call right away if the bot is up, otherwise once it is
+        '''
+
+        with self.bot_lock:
+            if self.bot is None:
+                self.deferred.append(call)
+                return
+
+        call()
         
     def pause_unpause_callback(self, pause_surveillance: bool) -> bool:
         ''' Callback for telegram bot to inform about pausing and unpausing the surveillance
@@ -49,73 +147,268 @@ class Controller():
         return did_change
         
         
-    def motion_state_change_callback(self, is_motion_start):
-        '''
+    def motion_state_change_callback(self, is_motion_start: bool, timestamp: float = None):
+        ''' Callback for the motion sensor, wakes the recording timer
+
+            #: timestamp - monotonic time of the sensor edge
         '''
 
-        #: If motion sensor registered movement ...
-        if is_motion_start:
-            self.motion_active = True
-            
-            #: ... and camera is not yet recording and survaillance is not paused - start recording
-            if not self.camera.is_recording and not self.surveillance_paused:
-                Thread(target = self._start_recording).start()
+        with self.motion_changed:
+            self.motion_active = bool(is_motion_start)
 
-        else:
-            self.motion_active = False
+            if is_motion_start:
+                self.motion_started = timestamp or time.monotonic()
+            else:
+                self.motion_ended = timestamp or time.monotonic()
+
+            self.motion_changed.notify_all()
+
+        #: If motion sensor registered movement and camera is not yet recording and survaillance is not paused - start recording
+        if is_motion_start and not self.camera.is_recording and not self.surveillance_paused and self.recording_lock.acquire(blocking=False):
+            Thread(target = self._start_recording).start()
                     
     
     def _start_recording(self):
-        '''
+        ''' Records until the timer expires
+
+            #: If the max video length was reached, the recording continues with a new segment
+            #: or, without CAMERA_SEGMENTED_RECORDING, with a new recording
         '''
         
-        self.camera.start_recording()
+        RECORDING_ACTIVE.set(1)
+        started = time.monotonic()
+
+        try:
+            self._start_incident()
+            TRIGGER_LATENCY.observe(time.monotonic() - self.motion_started)
+
+            while self._timer():
+
+                #: Continue only if surveillance is not paused
+                if self.surveillance_paused:
+                    break
+
+                #: Gapless: finished segment is converted and sent while the next one records
+                if cfg.CAMERA_SEGMENTED_RECORDING:
+                    self._deliver_when_converted(self.camera.rollover())
+
+                else:
+                    self._stop_recording()
+                    self._start_incident()
+
+            self._stop_recording()
+
+        finally:
+            INCIDENT_LENGTH.observe(time.monotonic() - started)
+            RECORDING_ACTIVE.set(0)
+            self.recording_lock.release()
+
+    def _start_incident(self):
+        ''' Starts a recording and alerts the users, with verification the alert waits for the camera
+        '''
+
+        if self.verifier:
+
+            #: The incident is named before the recording starts, so the verifier can be armed for it right away
+            with self.verification_lock:
+                self.incident = utils.timestring()
+                self.verdicts[self.incident] = False
+                self.verifier.arm(self.incident)
+                self.camera.start_recording(self.incident)
+
+                #: Clips of the last incidents may still be converting
+                while len(self.verdicts) > 16:
+                    self.verdicts.popitem(last = False)
+
+        else:
+
+            #: Alerts are sent in the background, starting the recording waits for a keyframe
+            self._alert()
+            self.camera.start_recording()
+
+        RECORDINGS.inc()
         self.logger.debug('Started recording')
-        self.bot.alert('Motion detected, recording started!', Role.OPEN)
-        self._timer()
 
-        #self.timer_thread = Thread(target = self._timer)
-        #self.timer_thread.start()
+    def _alert(self):
+        ''' Alerts the users, with a snapshot if enabled
+        '''
+
+        #: The snapshot only waits for the next frame, the pre-roll covers the time until the recording starts
+        snapshot = self.camera.snapshot() if cfg.CAMERA_SNAPSHOT else None
+        self._with_bot(lambda: self._send_alert(snapshot))
+
+    def _send_alert(self, snapshot: str = None):
+        self.bot.alert('Motion detected, recording started!', Role.OPEN, photo = snapshot)
+
+        if snapshot:
+            self.retention.add(snapshot)
         
     def _stop_recording(self):
         '''
         '''
         
-        video = self.camera.stop_recording()
+        #: Conversion runs in the background, the video is handed over once it is ready
+        with STOP_LATENCY.time():
+            self._deliver_when_converted(self.camera.stop_recording())
         self.logger.debug('Stopped recording')
 
-        self.bot.send_surveillance_video(video)
-    
-    def _timer(self):
+        if self.verifier:
+            self._end_verification()
+
+    def _motion_verified(self, incident: str):
+        ''' Callback of the verifier, called by the encoder thread
         '''
+
+        Thread(target = self._confirm_incident, args = (incident,)).start()
+
+    def _confirm_incident(self, incident: str):
+        ''' Alerts the users and sends the clips of the incident held back so far
+
+            #: A verdict arriving after its incident ended must not confirm the next one
         '''
-        
-        inactive = 0
-        
-        #: Check every second until max video length
-        for i in range(cfg.MAX_VIDEO_LENGTH):
-            time.sleep(1)
-            
-            #: If motion stopped, increment counter
-            if not self.motion_active:
-                inactive += 1
-                self.logger.debug('recording [{}/{} s] - motion inactive [{}/{}]'.format(i, cfg.MAX_VIDEO_LENGTH, inactive, cfg.BUFFER_TIME_STEPS))
-            #: else reset counter
-            else:
-                self.logger.debug('recording [{}/{} s] - motion active'.format(i, cfg.MAX_VIDEO_LENGTH))
-                inactive = 0
-            
-            #: If motion is inactive for too long, stop video
-            if inactive >= cfg.BUFFER_TIME_STEPS:
-                Thread(target = self._stop_recording).start()
+
+        with self.verification_lock:
+            if incident is None or incident != self.incident or self.verdicts[incident]:
                 return
+
+            self.verdicts[self.incident] = True
+            held, self.held = self.held, []
+
+        self._alert()
+        for clip in held:
+            self._send_clip(clip)
+
+    def _end_verification(self):
+        ''' Decides the incident once its recording stopped, held clips of an unconfirmed incident are deleted
+        '''
+
+        if self.verifier.disarm():
+            self._confirm_incident(self.incident)
+
+        with self.verification_lock:
+            self.incident = None
+            held, self.held = self.held, []
+
+        for clip in held:
+            self._discard(clip)
+
+    def _deliver_when_converted(self, conversion):
+        ''' Hands the clip over to the bot as soon as the conversion is done
+        '''
+
+        if conversion:
+            conversion.add_done_callback(self._deliver_video)
+
+    def _deliver_video(self, conversion):
+        ''' Done-callback of a conversion, hands the video to the bot's event loop without blocking the converter
+        '''
+
+        if isinstance(conversion.exception(), EmptyRecording):
+            self.logger.debug(conversion.exception())
+            return
+
+        if conversion.exception():
+            self.logger.error('Conversion failed', exc_info=conversion.exception())
+            return
+
+        clip = conversion.result()
+
+        if self.verifier:
+            with self.verification_lock:
+                #: An incident dropped from the verdicts was never confirmed as far as is known, its clips are not sent
+                verified = self.verdicts.get(clip.incident, False)
+                if clip.incident not in self.verdicts:
+                    self.logger.warning('Verdict of incident {} is not known anymore, discarding {}'.format(clip.incident, clip.name))
+
+                #: Held back until the camera decided the running incident
+                if not verified and clip.incident == self.incident:
+                    self.held.append(clip)
+                    return
+
+            if not verified:
+                self._discard(clip)
+                return
+
+        self._send_clip(clip)
+
+    def _send_clip(self, clip: Clip):
+        ''' Hands a converted clip to the bot and to the retention, once the bot is up
+        '''
+
+        self._with_bot(lambda: self._hand_over(clip))
+
+    def _hand_over(self, clip: Clip):
+
+        #: Spooled before it is indexed, so it is pinned before it can be evicted
+        self.bot.catalog.add(clip)
+        self.bot.send_surveillance_video(clip)
+        self.retention.add(clip.path)
+
+        if clip.downscaled:
+            clip.downscaled.add_done_callback(lambda transcode: transcode.exception() or self.retention.add(transcode.result()))
+
+    def _discard(self, clip: Clip):
+        ''' Deletes the clip of an incident the camera did not confirm
+        '''
+
+        self.logger.debug('Deleting unconfirmed clip {}'.format(clip.name))
+        self._remove(clip.path)
+
+        if clip.downscaled:
+            clip.downscaled.add_done_callback(lambda transcode: transcode.exception() or self._remove(transcode.result()))
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError as e:
+            self.logger.warning('Could not delete {}: {}'.format(path, e))
+    
+    def _timer(self) -> bool:
+        ''' Blocks until the recording has to be stopped
+
+            #: Sleeps until the next deadline, motion changes wake it up early
+            #: Stops after the buffer time without motion, or at the max video length
+            #: With motion vectors, the picture decides when it disagrees with the radar:
+            #: a still picture ends the motion while the radar is on, a moving picture extends it after the radar went off
+
+            #: return -> whether or not the max video length was reached
+        '''
         
-        #: If the recording oulasts the max lenght, stop
-        if self.camera.is_recording:
-            Thread(target = self._stop_recording).start()
-            
-            #: Start new recording only if surveillance is not paused
-            if not self.surveillance_paused:
-                self._start_recording()
-            
-        
\ No newline at end of file
+        buffer_time = cfg.BUFFER_TIME_STEPS * cfg.BUFFER_TIME_STEP_LENGTH
+        max_deadline = time.monotonic() + cfg.MAX_VIDEO_LENGTH
+        analysis = self.camera.motion
+
+        with self.motion_changed:
+            while True:
+                now = time.monotonic()
+
+                #: If the recording oulasts the max lenght, stop
+                if now >= max_deadline:
+                    self.logger.debug('recording reached max length [{} s]'.format(cfg.MAX_VIDEO_LENGTH))
+                    return True
+
+                deadline = max_deadline
+                active, ended = self.motion_active, self.motion_ended
+
+                if analysis:
+                    last_seen = max(analysis.last_active, self.motion_started)
+
+                    if active and now >= last_seen + cfg.MOTION_VECTORS_QUIET_TIME:
+                        active, ended = False, last_seen
+                    elif active:
+                        deadline = min(deadline, last_seen + cfg.MOTION_VECTORS_QUIET_TIME)
+                    else:
+                        ended = max(ended, min(analysis.last_active, ended + cfg.MOTION_VECTORS_EXTEND))
+
+                #: Without motion, the buffer deadline applies as well
+                if not active:
+                    buffer_deadline = ended + buffer_time
+
+                    #: If motion is inactive for too long, stop video
+                    if now >= buffer_deadline:
+                        self.logger.debug('recording stopped after {:.1f} s - motion inactive for {} s'.format(now - max_deadline + cfg.MAX_VIDEO_LENGTH, buffer_time))
+                        return False
+
+                    deadline = min(deadline, buffer_deadline)
+
+                self.motion_changed.wait(deadline - now)
@@ -0,0 +1,140 @@
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Callable, List, Tuple, Union
+
+import config as cfg
+import metrics
+from payload import Payload
+
+KEYBOARDS_EXPIRED = metrics.counter('surveillance_keyboards_expired', 'Inline keyboards dropped before they were finished, by reason', ('reason',))
+
+
+class ConversationStore():
+    ''' Open inline keyboards by (chat_id, message_id)
+
+        #: An entry expires ttl seconds after it was last used, the least recently used one is evicted
+        #: once there are more than max_entries, so abandoned keyboards do not pile up
+        #: Expired and evicted entries are kept (up to max_entries) until sweep hands them out,
+        #: so their keyboards can be edited to expired
+        #: Entries are ordered by last use, which with one ttl is also the order they expire in,
+        #: every operation is O(1) and a sweep only touches expired entries
+        #: Not thread-safe, the bot only uses it on its event loop
+    '''
+
+    def __init__(self, ttl: float = cfg.CONVERSATION_TTL, max_entries: int = cfg.CONVERSATION_MAX_ENTRIES, clock: Callable[[], float] = time.monotonic):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self._entries: 'OrderedDict[Tuple[int, int], Payload]' = OrderedDict()
+        self._stale: deque = deque(maxlen=max_entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, chat_id: int, message_id: int, payload: Payload) -> Payload:
+        payload.chat_id, payload.message_id = chat_id, message_id
+        payload.expires = self.clock() + self.ttl
+
+        key = (chat_id, message_id)
+        self._entries[key] = payload
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._stale.append(evicted)
+            KEYBOARDS_EXPIRED.labels('evicted').inc()
+
+        return payload
+
+    def get(self, chat_id: int, message_id: int) -> Union[Payload, None]:
+        ''' Payload of the keyboard, None if there is none or it expired, using it extends its ttl
+        '''
+
+        key = (chat_id, message_id)
+        payload: Payload = self._entries.get(key)
+        if payload is None:
+            return None
+
+        now = self.clock()
+        if payload.expires <= now:
+            del self._entries[key]
+            self._stale.append(payload)
+            KEYBOARDS_EXPIRED.labels('ttl').inc()
+            return None
+
+        payload.expires = now + self.ttl
+        self._entries.move_to_end(key)
+        return payload
+
+    def pop(self, chat_id: int, message_id: int) -> Union[Payload, None]:
+        ''' Removes a finished conversation
+        '''
+
+        return self._entries.pop((chat_id, message_id), None)
+
+    def sweep(self, limit: int = None) -> List[Payload]:
+        ''' Drops the expired entries
+
+            #: return -> up to limit expired or evicted entries whose keyboards were not edited yet, oldest first
+        '''
+
+        now = self.clock()
+        while self._entries:
+            key, payload = next(iter(self._entries.items()))
+            if payload.expires > now:
+                break
+
+            del self._entries[key]
+            self._stale.append(payload)
+            KEYBOARDS_EXPIRED.labels('ttl').inc()
+
+        count = len(self._stale) if limit is None else min(limit, len(self._stale))
+        return [self._stale.popleft() for _ in range(count)]
+
+
+if __name__ == '__main__':
+
+    import tracemalloc
+
+    #: Soak: 1M abandoned /ban flows on a virtual clock, one every 10 ms, with a sweep every 30 s
+    #: Memory has to stay flat with the store, with a plain dict (bot_data) it grows with every flow
+    clock = [0.0]
+    store = ConversationStore(ttl=600, max_entries=1000, clock=lambda: clock[0])
+    flows, interval, sweep = 10 ** 6, 0.01, 30
+
+    tracemalloc.start()
+    edited, next_sweep = 0, sweep
+    print('{:>9} {:>10} {:>8} {:>12}'.format('flows', 'open', 'stale', 'memory [kB]'))
+
+    for n in range(1, flows + 1):
+        clock[0] = n * interval
+        store.put(n % 50, n, Payload('ban'))
+
+        if clock[0] >= next_sweep:
+            next_sweep += sweep
+            edited += len(store.sweep(20))
+
+        if n % (flows // 10) == 0:
+            print('{:9} {:10} {:8} {:12.0f}'.format(n, len(store), len(store._stale), tracemalloc.get_traced_memory()[0] / 1024))
+
+    print('{} keyboards edited to expired, the rest were dropped unedited, a click on them is answered with expired'.format(edited))
+
+    bot_data = {}
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    for n in range(flows // 10):
+        bot_data[n] = Payload('ban')
+    print('plain dict: {:.0f} kB after {} flows'.format((tracemalloc.get_traced_memory()[0] - before) / 1024, flows // 10))
+
+    tracemalloc.stop()
+    keys = list(store._entries)
+    started = time.perf_counter()
+    for n in range(flows):
+        store.get(*keys[n % len(keys)])
+    print('get of an open keyboard: {:.2f} us with {} open'.format((time.perf_counter() - started) / flows * 1e6, len(store)))
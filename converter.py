@@ -0,0 +1,254 @@
+import io
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from fractions import Fraction
+from typing import List, Union
+
+import config as cfg
+import metrics
+import utils
+from profiles import EncodingProfile
+
+CONVERSION_QUEUE = metrics.gauge('surveillance_conversion_queue', 'Conversions waiting for a worker')
+CONVERSION_WAIT = metrics.histogram('surveillance_conversion_wait_seconds', 'Time a conversion waited for a worker')
+CONVERSION_MUX = metrics.histogram('surveillance_conversion_mux_seconds', 'Time to mux a recording into the converting format')
+CONVERSION_TRANSCODE = metrics.histogram('surveillance_conversion_transcode_seconds', 'Time to transcode a clip into a downscaled copy',
+                                         buckets=(1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+
+
+class EmptyRecording(RuntimeError):
+    ''' Recording stopped before its first keyframe, there is no video to deliver
+    '''
+
+
+@dataclass
+class ConversionJob():
+    ''' Single conversion of a raw recording into the converting format
+
+        #: source is either a list of .h264 files in playback order or the raw stream bytes
+        #: With a profile, source is a converted clip that is re-encoded into the target
+    '''
+
+    source: Union[List[str], bytes, str]
+    target: str
+    framerate: int = 30
+    profile: EncodingProfile = None
+
+    #: monotonic timestamps for the job metrics
+    submitted: float = field(default_factory=time.monotonic)
+    started: float = None
+    finished: float = None
+
+    @property
+    def wait_time(self) -> float:
+        return self.started - self.submitted
+
+    @property
+    def mux_time(self) -> float:
+        return self.finished - self.started
+
+
+class Converter():
+    ''' Converts recordings in a bounded worker pool
+
+        #: submit() returns immediately with a future resolving to the path of the converted video
+        #: Keeps track of the queue depth and the timings of finished jobs
+    '''
+
+    def __init__(self, workers: int = cfg.CONVERTER_WORKERS, muxer: str = cfg.CONVERTER_MUXER):
+
+        #: init logger
+        self.logger = logging.getLogger(__name__)
+
+        #: Checked here, not at the first conversion, which would lose the recording
+        if muxer == 'inprocess':
+            try:
+                import av
+            except ImportError:
+                self.logger.warning('PyAV is not installed (pip install av), muxing with MP4Box instead')
+                muxer = 'mp4box'
+            else:
+                if cfg.CAMERA_TARGET_CLIP_BYTES is None:
+                    self.logger.warning('Clips are not limited by CAMERA_TARGET_CLIP_BYTES, muxing with MP4Box instead of in memory')
+                    muxer = 'mp4box'
+
+        self.muxer = muxer
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='converter')
+
+        #: metrics
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait_time = 0.0
+        self.total_mux_time = 0.0
+        self.last_job: ConversionJob = None
+
+        CONVERSION_QUEUE.set_function(lambda: self.queued)
+
+    @property
+    def in_process(self) -> bool:
+        return self.muxer == 'inprocess'
+
+    def submit(self, source: Union[List[str], bytes, str], target: str, framerate: int = 30, profile: EncodingProfile = None) -> Future:
+        ''' Queues a conversion
+
+            #: return -> future resolving to the target path
+        '''
+
+        job = ConversionJob(source, target, framerate, profile)
+
+        with self._lock:
+            self.queued += 1
+            depth = self.queued
+
+        self.logger.debug('conversion queued: {} [queue depth: {}]'.format(utils.basename(target), depth))
+        return self.executor.submit(self._run, job)
+
+    def transcode(self, source: str, target: str, profile: EncodingProfile) -> Future:
+        ''' Queues re-encoding a converted clip with the resolution, framerate and bitrate of profile
+
+            #: The source is kept, jobs are queued behind the conversions of new recordings
+            #: return -> future resolving to the target path
+        '''
+
+        return self.submit(source, target, profile.framerate, profile)
+
+    def stats(self) -> dict:
+        ''' Snapshot of the conversion metrics
+        '''
+
+        with self._lock:
+            done = self.completed + self.failed
+            return {
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait_time': self.total_wait_time / done if done else 0.0,
+                'avg_mux_time': self.total_mux_time / done if done else 0.0,
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+
+    def _run(self, job: ConversionJob) -> str:
+        ''' Worker: muxes the job and updates the metrics
+        '''
+
+        job.started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+
+        succeeded = False
+        try:
+            if job.profile:
+                self._transcode(job)
+            elif isinstance(job.source, bytes):
+                self._mux_in_process(job)
+            else:
+                self._mux_mp4box(job)
+            succeeded = True
+            return job.target
+
+        finally:
+            job.finished = time.monotonic()
+            with self._lock:
+                self.active -= 1
+                self.completed += succeeded
+                self.failed += not succeeded
+                self.total_wait_time += job.wait_time
+                self.total_mux_time += job.mux_time
+                self.last_job = job
+
+            CONVERSION_WAIT.observe(job.wait_time)
+            (CONVERSION_TRANSCODE if job.profile else CONVERSION_MUX).observe(job.mux_time)
+
+            self.logger.debug('conversion {}: {} [waited {:.2f} s, muxed in {:.2f} s, queue depth: {}]'.format(
+                'done' if succeeded else 'failed', utils.basename(job.target), job.wait_time, job.mux_time, self.queued))
+
+    def _mux_mp4box(self, job: ConversionJob) -> None:
+        ''' Concatenates the .h264 files into the target with MP4Box and deletes them
+
+            #: If MP4Box fails, the .h264 files are kept, so the recording can still be recovered
+        '''
+
+        #: An empty pre-roll (no keyframe buffered yet) can not be muxed and is left out
+        parts = [part for part in job.source if os.path.getsize(part) > 0]
+
+        #: Stopped before the first keyframe, there is nothing to mux
+        if not parts:
+            for part in job.source:
+                os.remove(part)
+            raise EmptyRecording('Recording {} is empty'.format(utils.basename(job.target)))
+
+        cmd = ['MP4Box', '-add', parts[0]]
+        for part in parts[1:]:
+            cmd += ['-cat', part]
+        cmd.append(job.target)
+
+        returncode = utils.run_cmd(cmd)
+
+        if returncode != 0:
+            self.logger.error('MP4Box exited with {}, keeping the recording in {}'.format(returncode, ', '.join(parts)))
+            raise RuntimeError('MP4Box exited with {}'.format(returncode))
+
+        for part in job.source:
+            os.remove(part)
+
+    def _transcode(self, job: ConversionJob) -> None:
+        ''' Re-encodes the clip with ffmpeg, a failed transcode leaves no partial file behind
+        '''
+
+        width, height = job.profile.resolution
+
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', job.source,
+               '-vf', 'scale={}:{}'.format(width, height), '-r', str(job.profile.framerate),
+               '-c:v', cfg.CONVERTER_TRANSCODE_CODEC, '-b:v', str(job.profile.bitrate),
+               '-maxrate', str(job.profile.bitrate), '-bufsize', str(job.profile.bitrate),
+               '-an', '-movflags', '+faststart', job.target]
+
+        returncode = utils.run_cmd(cmd)
+
+        if returncode != 0:
+            if os.path.exists(job.target):
+                os.remove(job.target)
+            raise RuntimeError('ffmpeg exited with {}'.format(returncode))
+
+    def _mux_in_process(self, job: ConversionJob) -> None:
+        ''' Remuxes the raw H.264 stream into the target with PyAV, without re-encoding
+
+            #: Raw H.264 carries no timestamps, they are derived from the framerate
+        '''
+
+        import av
+
+        with av.open(io.BytesIO(job.source), format='h264') as source, av.open(job.target, 'w', format='mp4') as target:
+            in_stream = source.streams.video[0]
+
+            #: PyAV >= 13 moved stream templates into their own method
+            if hasattr(target, 'add_stream_from_template'):
+                out_stream = target.add_stream_from_template(in_stream)
+            else:
+                out_stream = target.add_stream(template=in_stream)
+
+            time_base = Fraction(1, job.framerate)
+            index = 0
+            for packet in source.demux(in_stream):
+
+                #: skip the empty flush packet at the end of the stream
+                if packet.size == 0:
+                    continue
+
+                packet.pts = packet.dts = index
+                packet.duration = 1
+                packet.time_base = time_base
+                packet.stream = out_stream
+                target.mux(packet)
+                index += 1
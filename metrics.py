@@ -0,0 +1,375 @@
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+
+#: Upper bounds in seconds, from sensor dispatch (ms) up to video delivery (s)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric():
+    ''' Base of all metric types
+
+        #: A metric without labelnames holds its value itself,
+        #: with labelnames every label combination gets its own child created by labels()
+        #: Updates only take the lock of the updated child, reads are never blocked for long
+    '''
+
+    kind = 'untyped'
+
+    #: Appended to the name for the metric family in the exposition, counters end with _total
+    family_suffix = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        #: Label values of a child, by label name
+        self.labelset: Dict[str, str] = {}
+
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], 'Metric'] = {}
+
+    def labels(self, *labelvalues) -> 'Metric':
+        ''' Gets the child for the given label values, creates it on first use
+        '''
+
+        #: Fast path without locking, children are never removed
+        child = self._children.get(labelvalues)
+        if child:
+            return child
+
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+
+        with self._lock:
+            if labelvalues not in self._children:
+                child = self._child()
+                child.labelset = {name: str(value) for name, value in zip(self.labelnames, labelvalues)}
+                self._children[labelvalues] = child
+            return self._children[labelvalues]
+
+    def children(self) -> List['Metric']:
+        ''' Metrics holding values, the metric itself if it has no labels
+        '''
+
+        if not self.labelnames:
+            return [self]
+
+        with self._lock:
+            return list(self._children.values())
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        ''' (name suffix, labels, value) of every exported time series
+        '''
+
+        raise NotImplementedError
+
+    def _child(self) -> 'Metric':
+        return type(self)(self.name, self.documentation)
+
+
+class Counter(Metric):
+    ''' Monotonically increasing value
+
+        #: set_function exports a counter that is already maintained elsewhere,
+        #: which costs nothing on the hot path
+    '''
+
+    kind = 'counter'
+    family_suffix = '_total'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+        self._function: Callable[[], float] = None
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def get(self) -> float:
+        return self._function() if self._function else self.value
+
+    def samples(self):
+        for child in self.children():
+            yield ('', child.labelset, child.get())
+
+
+class Gauge(Counter):
+    ''' Value that can go up and down
+    '''
+
+    kind = 'gauge'
+    family_suffix = ''
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self):
+        for child in self.children():
+            yield ('', child.labelset, child.get())
+
+
+class Histogram(Metric):
+    ''' Distribution of observed values in fixed buckets
+
+        #: Observing is a bisect plus two additions, no samples are stored
+        #: Quantiles are estimated by linear interpolation within a bucket
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self) -> 'Histogram':
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> 'Timer':
+        ''' Context manager observing the duration of its block
+        '''
+
+        return Timer(self)
+
+    def quantile(self, q: float) -> Union[float, None]:
+        ''' Estimated q-quantile, None without observations
+        '''
+
+        with self._lock:
+            counts, count = list(self.counts), self.count
+
+        if not count:
+            return None
+
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+
+                #: Above the largest bucket there is no upper bound
+                if index == len(self.buckets):
+                    return lower
+
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+
+        return self.buckets[-1]
+
+    def samples(self):
+        for child in self.children():
+            labels = child.labelset
+
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield ('_bucket', dict(labels, le=_format_value(bound)), cumulative)
+
+            yield ('_sum', labels, total)
+            yield ('_count', labels, count)
+
+
+class Timer():
+    ''' Observes the duration of a with-block in a histogram
+    '''
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.monotonic() - self.started)
+
+
+class Registry():
+    ''' Collection of all metrics of the process
+    '''
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        ''' Registers a metric, a metric registered twice under the same name is returned instead
+        '''
+
+        with self._lock:
+            existing = self.metrics.get(metric.name)
+            if existing:
+                if type(existing) is not type(metric):
+                    raise ValueError('{} is already registered as {}'.format(metric.name, existing.kind))
+                return existing
+
+            self.metrics[metric.name] = metric
+            return metric
+
+    def exposition(self) -> str:
+        ''' All metrics in the Prometheus text format (version 0.0.4)
+        '''
+
+        #: HELP and TYPE name the family of the samples, e.g. surveillance_x_total of a counter
+        lines = []
+        for metric in list(self.metrics.values()):
+            family = metric.name + metric.family_suffix
+            lines.append('# HELP {} {}'.format(family, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append('# TYPE {} {}'.format(family, metric.kind))
+
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(family, suffix, _format_labels(labels), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        ''' Human readable overview, histograms are reduced to count and estimated percentiles
+        '''
+
+        lines = []
+        for metric in list(self.metrics.values()):
+            for child in metric.children():
+                name = metric.name + _format_labels(child.labelset)
+
+                if isinstance(metric, Histogram):
+                    if child.count:
+                        lines.append('{}: n={} p50={} p90={} p99={}'.format(name, child.count, *(_format_duration(child.quantile(q)) for q in (0.5, 0.9, 0.99))))
+                else:
+                    lines.append('{}: {}'.format(name, _format_value(child.get())))
+
+        return '\n'.join(lines)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_duration(seconds: float) -> str:
+    return '{:.0f}ms'.format(seconds * 1000) if seconds < 1 else '{:.2f}s'.format(seconds)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+#: Default registry, metrics are created once at module level where they are used
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+class MetricsServer():
+    ''' Serves the registry in the Prometheus text format at http://<host>:<port>/metrics
+
+        #: Binds to localhost by default, the metrics are not meant to be public
+    '''
+
+    def __init__(self, port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY):
+        self.logger = logging.getLogger(__name__)
+        self.registry = registry
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+
+    def start(self) -> 'MetricsServer':
+        threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True).start()
+        self.logger.debug('Serving metrics at http://{}:{}/metrics'.format(*self.httpd.server_address[:2]))
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                data = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == '__main__':
+
+    #: Overhead of the hot path operations
+    registry = Registry()
+    plain = registry.register(Counter('bench_counter', 'Counter'))
+    labelled = registry.register(Counter('bench_labelled', 'Labelled counter', ('kind',)))
+    latency = registry.register(Histogram('bench_latency_seconds', 'Histogram'))
+
+    n = 200000
+    def timed():
+        with latency.time():
+            pass
+
+    for label, operation in (('counter.inc()', plain.inc),
+                             ('counter.labels().inc()', lambda: labelled.labels('video').inc()),
+                             ('histogram.observe()', lambda: latency.observe(0.042)),
+                             ('with histogram.time()', timed)):
+        started = time.perf_counter()
+        for _ in range(n):
+            operation()
+        print('{:24} {:6.2f} µs'.format(label, (time.perf_counter() - started) / n * 1e6))
+
+    print()
+    print(registry.exposition())
+    print(registry.summary())
@@ -0,0 +1,169 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+import config as cfg
+import metrics
+
+VECTOR_FRAMES = metrics.counter('surveillance_vector_frames', 'Frames of motion vectors by result', ('result',))
+VECTOR_BATCH_TIME = metrics.histogram('surveillance_vector_batch_seconds', 'Time to analyse one batch of motion vectors',
+                                      buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05))
+IMAGE_ACTIVITY = metrics.gauge('surveillance_image_activity', 'Share of moving macroblocks in the busiest region of the last analysed frame')
+
+#: One vector per macroblock of 16x16 pixels, as written by the encoder
+VECTOR_DTYPE = np.dtype([('x', 'i1'), ('y', 'i1'), ('sad', 'u2')])
+
+
+def vector_shape(resolution: Tuple[int, int]) -> Tuple[int, int]:
+    ''' Macroblock rows and columns of a frame, the encoder adds one column
+    '''
+
+    width, height = resolution
+    return ((height + 15) // 16, (width + 15) // 16 + 1)
+
+
+class MotionVectorAnalysis():
+    ''' Activity of the picture from the motion vectors the H.264 encoder computes for every frame anyway
+
+        #: PiCamera motion_output, receives the vectors of one frame per call
+        #: Frames are collected into batches and analysed by a worker thread in one go,
+        #: write only appends, so the encoder never waits; if the worker falls behind, batches are dropped
+        #: The frame is split into regions, the activity of a frame is the share of moving macroblocks
+        #: in its busiest region, a frame is active above the active share
+    '''
+
+    def __init__(self, resolution: Tuple[int, int], framerate: float, threshold: float = cfg.MOTION_VECTORS_THRESHOLD, regions: Tuple[int, int] = cfg.MOTION_VECTORS_REGIONS,
+                 active: float = cfg.MOTION_VECTORS_ACTIVE, batch: int = cfg.MOTION_VECTORS_BATCH, history: float = 120, clock: Callable[[], float] = time.monotonic):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.threshold = threshold
+        self.active = active
+        self.batch = batch
+        self.clock = clock
+        self.rows, self.columns = vector_shape(resolution)
+        self.frame_bytes = self.rows * self.columns * VECTOR_DTYPE.itemsize
+
+        #: First macroblock of every region, the extra column of the encoder is cut off before
+        region_columns, region_rows = regions
+        self._row_edges = np.linspace(0, self.rows, region_rows + 1).astype(int)[:-1]
+        self._column_edges = np.linspace(0, self.columns - 1, region_columns + 1).astype(int)[:-1]
+        self._region_sizes = np.outer(np.diff(np.append(self._row_edges, self.rows)), np.diff(np.append(self._column_edges, self.columns - 1)))
+
+        #: Monotonic time of the last active frame
+        self.last_active = float('-inf')
+
+        #: (timestamp, activity) of the analysed frames, bounded by history seconds
+        self.timestamps: deque = deque(maxlen=int(history * framerate))
+        self.activities: deque = deque(maxlen=int(history * framerate))
+
+        self._pending: List[Tuple[float, bytes]] = []
+        self._lock = threading.Lock()
+        self._batches = queue.Queue(maxsize=8)
+        threading.Thread(target=self._run, name='motion-vectors', daemon=True).start()
+
+    def write(self, buf) -> int:
+        ''' PiCamera motion_output
+        '''
+
+        with self._lock:
+            self._pending.append((self.clock(), bytes(buf)))
+            if len(self._pending) < self.batch:
+                return len(buf)
+            frames, self._pending = self._pending, []
+
+        try:
+            self._batches.put_nowait(frames)
+        except queue.Full:
+            VECTOR_FRAMES.labels('dropped').inc(len(frames))
+
+        return len(buf)
+
+    def flush(self) -> None:
+        ''' Analyses the frames of the unfinished batch right away
+        '''
+
+        with self._lock:
+            frames, self._pending = self._pending, []
+
+        if frames:
+            self._analyse_frames(frames)
+
+    def analyse(self, vectors: np.ndarray) -> np.ndarray:
+        ''' Analyses a batch of frames
+
+            #: vectors - array of VECTOR_DTYPE with shape (frames, rows, columns)
+            #: return -> share of moving macroblocks per frame and region, shape (frames, region rows, region columns)
+        '''
+
+        x = vectors['x'][:, :, :-1].astype(np.int16)
+        y = vectors['y'][:, :, :-1].astype(np.int16)
+
+        moving = (x * x + y * y) > self.threshold ** 2
+        counts = np.add.reduceat(np.add.reduceat(moving, self._row_edges, axis=1, dtype=np.int32), self._column_edges, axis=2)
+        return counts / self._region_sizes
+
+    def timeline(self, start: float, end: float, step: float = 1.0) -> List[float]:
+        ''' Activity of the frames between start and end (monotonic), the busiest frame of every step
+
+            #: return -> activities relative to twice the active share, from 0 to 1
+        '''
+
+        self.flush()
+
+        with self._lock:
+            timestamps = np.array(self.timestamps)
+            activities = np.array(self.activities)
+
+        steps = max(1, int(np.ceil((end - start) / step)))
+        if not len(timestamps):
+            return [0.0] * steps
+
+        selected = (timestamps >= start) & (timestamps < end)
+        indices = ((timestamps[selected] - start) // step).astype(int)
+
+        levels = np.zeros(steps)
+        np.maximum.at(levels, np.minimum(indices, steps - 1), activities[selected])
+        return list(np.minimum(levels / (2 * self.active), 1.0))
+
+    def _run(self) -> None:
+        ''' Worker thread
+        '''
+
+        while True:
+            frames = self._batches.get()
+            try:
+                self._analyse_frames(frames)
+            except Exception:
+                self.logger.exception('Analysing motion vectors failed')
+            finally:
+                self._batches.task_done()
+
+    def _analyse_frames(self, frames: List[Tuple[float, bytes]]) -> None:
+        started = time.perf_counter()
+
+        #: Partial frames are skipped
+        frames = [(timestamp, buf) for timestamp, buf in frames if len(buf) == self.frame_bytes]
+        if not frames:
+            return
+
+        vectors = np.frombuffer(b''.join(buf for _, buf in frames), VECTOR_DTYPE).reshape(len(frames), self.rows, self.columns)
+        activity = self.analyse(vectors).reshape(len(frames), -1).max(axis=1)
+
+        with self._lock:
+            self.timestamps.extend(timestamp for timestamp, _ in frames)
+            self.activities.extend(activity.tolist())
+
+            active = np.flatnonzero(activity >= self.active)
+            if len(active):
+                self.last_active = max(self.last_active, frames[active[-1]][0])
+
+        IMAGE_ACTIVITY.set(float(activity[-1]))
+        VECTOR_FRAMES.labels('analysed').inc(len(frames))
+        VECTOR_BATCH_TIME.observe(time.perf_counter() - started)
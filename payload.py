@@ -1,9 +1,18 @@
-from dataclasses import dataclass
-from typing import Callable
-
-@dataclass
 class Payload:
+    ''' State of a conversation through an inline keyboard
+
+        #: command is the name of the command whose handler gets the presses on the keyboard,
+        #: chat_id, message_id and expires are set by the ConversationStore
+        #: Slots, since thousands of them may be open at once
+    '''
+
+    __slots__ = ('command', 'data', 'stage', 'chat_id', 'message_id', 'expires')
+
+    def __init__(self, command: str, data: object = None, stage: int = None):
 
-    callback: Callable
-    data: object = None
-    stage: int = None
\ No newline at end of file
+        self.command = command
+        self.data = data
+        self.stage = stage
+        self.chat_id: int = None
+        self.message_id: int = None
+        self.expires: float = None
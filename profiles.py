@@ -0,0 +1,157 @@
+import os
+import logging
+from dataclasses import dataclass, replace
+from typing import Dict, Tuple
+
+import config as cfg
+
+#: Max size of a file uploaded by a bot, larger videos are rejected by the Bot API
+TELEGRAM_UPLOAD_LIMIT = 50 * 1000 * 1000
+
+#: Share of the file taken by the mp4 container (moov atom, sample tables)
+CONTAINER_OVERHEAD = 0.02
+
+#: Below this bitrate (bits per pixel and second) the picture falls apart, see the warning in active_profile
+MIN_BITS_PER_PIXEL = 0.03
+
+
+@dataclass(frozen=True)
+class EncodingProfile():
+    ''' Encoder settings of a recording
+
+        #: quality is the H.264 quantisation of PiCamera (1 best - 40 worst, 0 lets the bitrate decide)
+        #: bitrate is the cap in bits per second, the clip size follows from it
+    '''
+
+    name: str
+    resolution: Tuple[int, int]
+    framerate: int
+    bitrate: int
+    quality: int = 0
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.bitrate // 8
+
+    @property
+    def bits_per_pixel(self) -> float:
+        return self.bitrate / (self.resolution[0] * self.resolution[1] * self.framerate)
+
+    def clip_bytes(self, seconds: float) -> int:
+        ''' Expected size of a clip of the given length including the container
+        '''
+
+        return int(self.bytes_per_second * seconds / (1 - CONTAINER_OVERHEAD))
+
+    def upload_seconds(self, seconds: float, uplink: int) -> float:
+        ''' Time to upload a clip of the given length over an uplink in bits per second
+        '''
+
+        return self.clip_bytes(seconds) * 8 / uplink
+
+    def with_target_size(self, target_bytes: int, seconds: float) -> 'EncodingProfile':
+        ''' Profile with the bitrate capped, so a clip of the given length stays below target_bytes
+
+            #: The encoder has to be bitrate controlled to keep the size, so the quality is dropped
+        '''
+
+        bitrate = int(target_bytes * 8 * (1 - CONTAINER_OVERHEAD) / seconds)
+        if bitrate >= self.bitrate:
+            return self
+
+        return replace(self, bitrate=bitrate, quality=0)
+
+    def encoder_options(self) -> dict:
+        ''' Keyword arguments of PiCamera.start_recording
+
+            #: One keyframe per second, recordings can only be split at keyframes
+        '''
+
+        return {'format': 'h264', 'bitrate': self.bitrate, 'quality': self.quality, 'intra_period': self.framerate}
+
+
+#: Presets by name, high is the resolution and bitrate the camera always recorded in
+PRESETS: Dict[str, EncodingProfile] = {profile.name: profile for profile in (
+    EncodingProfile('high', (1280, 720), 30, 17000000),
+    EncodingProfile('balanced', (1280, 720), 25, 4000000, 25),
+    EncodingProfile('low', (854, 480), 20, 1500000, 28),
+    EncodingProfile('mobile', (640, 360), 15, 600000, 30),
+)}
+
+
+def clip_seconds(max_length: float = None) -> float:
+    ''' Longest clip the camera produces
+
+        #: MAX_VIDEO_LENGTH plus the pre-roll and up to two groups of pictures of keyframe alignment
+    '''
+
+    max_length = cfg.MAX_VIDEO_LENGTH if max_length is None else max_length
+    pre_roll = cfg.CAMERA_PRE_ROLL_SECONDS if cfg.CAMERA_CONTINUOUS_CAPTURE else 0
+    return max_length + pre_roll + 2
+
+
+def get_profile(name: str, target_bytes: int = None) -> EncodingProfile:
+    ''' Gets a preset, with target_bytes its bitrate is capped to keep the longest clip below that size
+    '''
+
+    if name not in PRESETS:
+        raise ValueError('Unknown encoding profile {}, choose one of {}'.format(name, ', '.join(PRESETS)))
+
+    profile = PRESETS[name]
+    if target_bytes:
+        profile = profile.with_target_size(target_bytes, clip_seconds())
+
+    return profile
+
+
+def active_profile() -> EncodingProfile:
+    ''' Profile configured with CAMERA_PROFILE and CAMERA_TARGET_CLIP_BYTES
+    '''
+
+    profile = get_profile(cfg.CAMERA_PROFILE, cfg.CAMERA_TARGET_CLIP_BYTES)
+
+    if profile.bits_per_pixel < MIN_BITS_PER_PIXEL:
+        logging.getLogger(__name__).warning('{} kbps are too little for {}x{} at {} fps, choose a smaller profile or a longer target'.format(
+            profile.bitrate // 1000, *profile.resolution, profile.framerate))
+
+    return profile
+
+
+def downscale_profile() -> EncodingProfile:
+    ''' Profile of the downscaled copy sent to low-bandwidth recipients, None if disabled
+    '''
+
+    if not cfg.CAMERA_DOWNSCALE_PROFILE:
+        return None
+
+    return get_profile(cfg.CAMERA_DOWNSCALE_PROFILE, cfg.CAMERA_TARGET_CLIP_BYTES)
+
+
+def downscaled_path(path: str, profile: EncodingProfile) -> str:
+    ''' Gets the path of the copy of the video at path downscaled to profile
+    '''
+
+    name, extension = os.path.splitext(path)
+    return '{}-{}{}'.format(name, profile.name, extension)
+
+
+if __name__ == '__main__':
+
+    #: Bytes per clip and upload time of every preset at MAX_VIDEO_LENGTH
+    seconds = clip_seconds()
+    uplinks = ((' 1 Mbit', 1000000), (' 5 Mbit', 5000000), ('20 Mbit', 20000000))
+
+    print('Longest clip: {:.0f} s, target size: {}'.format(seconds, cfg.CAMERA_TARGET_CLIP_BYTES or 'none'))
+    print()
+    print('{:10} {:>10} {:>4} {:>8} {:>8} {:>9}'.format('profile', 'resolution', 'fps', 'kbps', 'MB/clip', 'bits/px') +
+          ''.join(' {:>10}'.format(name + ' s') for name, _ in uplinks) + ' {:>6}'.format('fits'))
+
+    for name, preset in PRESETS.items():
+        capped = get_profile(name, cfg.CAMERA_TARGET_CLIP_BYTES)
+
+        for profile in (preset,) if capped is preset else (preset, capped):
+            print('{:10} {:>10} {:4} {:8} {:8.1f} {:9.3f}'.format(
+                    name if profile is preset else '  capped', '{}x{}'.format(*profile.resolution), profile.framerate,
+                    profile.bitrate // 1000, profile.clip_bytes(seconds) / 1e6, profile.bits_per_pixel) +
+                  ''.join(' {:10.1f}'.format(profile.upload_seconds(seconds, uplink)) for _, uplink in uplinks) +
+                  ' {:>6}'.format('yes' if profile.clip_bytes(seconds) <= TELEGRAM_UPLOAD_LIMIT else 'no'))
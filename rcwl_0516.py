@@ -1,10 +1,17 @@
-import RPi.GPIO as GPIO
-import config as cfg
+import time
 import logging
-#from time import sleep
+import threading
+from typing import Callable, List, Tuple, Union
+
+import config as cfg
+import metrics
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(cfg.SENSOR_PIN, GPIO.IN)
+
+#: Edge counters are maintained by the sensor itself and only exported
+SENSOR_EDGES = metrics.counter('surveillance_sensor_edges', 'Raw sensor edges received in the interrupt')
+SENSOR_EDGES_DROPPED = metrics.counter('surveillance_sensor_edges_dropped', 'Sensor edges dropped because the event ring was full')
+SENSOR_MOTION_EVENTS = metrics.counter('surveillance_sensor_motion_events', 'Debounced motion starts and ends reported')
+SENSOR_DISPATCH_LATENCY = metrics.histogram('surveillance_sensor_dispatch_seconds', 'Time from the edge to its processing in the dispatcher thread')
 
 
 #  _____________ 3V3 -> /
@@ -14,33 +21,262 @@ GPIO.setup(cfg.SENSOR_PIN, GPIO.IN)
 #  |________|___ CDS -> /
 #
 
+
+class GPIOBackend():
+    ''' Interface to the GPIO pins
+
+        #: Edge callbacks receive the pin level and the monotonic timestamp of the edge
+    '''
+
+    def setup(self, pin: int) -> None:
+        raise NotImplementedError
+
+    def add_edge_callback(self, pin: int, callback: Callable[[int, float], None]) -> None:
+        raise NotImplementedError
+
+    def read(self, pin: int) -> int:
+        raise NotImplementedError
+
+    def cleanup(self) -> None:
+        pass
+
+
+class RPiGPIOBackend(GPIOBackend):
+    ''' RPi.GPIO backend, RPi.GPIO is imported on first use
+    '''
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+    def setup(self, pin: int) -> None:
+        self.GPIO.setmode(self.GPIO.BCM)
+        self.GPIO.setup(pin, self.GPIO.IN)
+
+    def add_edge_callback(self, pin: int, callback: Callable[[int, float], None]) -> None:
+
+        #: Timestamp and level are captured first thing in the interrupt thread
+        def edge(channel):
+            timestamp = time.monotonic()
+            callback(self.GPIO.input(channel), timestamp)
+
+        self.GPIO.add_event_detect(pin, self.GPIO.BOTH, callback=edge)
+
+    def read(self, pin: int) -> int:
+        return self.GPIO.input(pin)
+
+    def cleanup(self) -> None:
+        self.GPIO.cleanup()
+
+
+class EventRing():
+    ''' Bounded single-producer single-consumer ring buffer
+
+        #: The producer only moves the tail, the consumer only moves the head,
+        #: so neither side needs a lock (index updates are atomic under the GIL)
+        #: If the ring is full, new events are dropped and counted
+    '''
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.dropped = 0
+        self._slots: List[Union[tuple, None]] = [None] * capacity
+        self._head = 0
+        self._tail = 0
+
+    def push(self, item: tuple) -> bool:
+        if self._tail - self._head >= self.capacity:
+            self.dropped += 1
+            return False
+
+        self._slots[self._tail % self.capacity] = item
+        self._tail += 1
+        return True
+
+    def pop(self) -> Union[tuple, None]:
+        if self._head == self._tail:
+            return None
+
+        index = self._head % self.capacity
+        item, self._slots[index] = self._slots[index], None
+        self._head += 1
+        return item
+
+    def __len__(self) -> int:
+        return self._tail - self._head
+
+
 class RCWL_0516():
-    
-    def __init__(self, callback, sensor_pin=cfg.SENSOR_PIN):
+    ''' RCWL-0516 radar motion sensor
+
+        #: Edges are timestamped in the interrupt and queued in a ring buffer,
+        #: a single dispatcher thread debounces them and calls the callback
+        #: debounce - seconds a level has to be stable before it counts
+        #: hold     - motion end is only reported if no motion starts again within hold seconds
+    '''
+
+    def __init__(self, callback: Callable[[bool, float], None], sensor_pin: int = cfg.SENSOR_PIN, backend: GPIOBackend = None,
+                 debounce: float = cfg.SENSOR_DEBOUNCE, hold: float = cfg.SENSOR_HOLD_TIME, capacity: int = cfg.SENSOR_EVENT_BUFFER, clock: Callable[[], float] = time.monotonic):
         self.sensor_pin = sensor_pin
         self.callback = callback
-        
+        self.backend = backend
+        self.debounce = debounce
+        self.hold = hold
+        self.clock = clock
+
+        self.events = EventRing(capacity)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+        #: Dispatcher state
+        self.motion = False
+        self._candidate: Tuple[int, float] = None
+        self._end_deadline: float = None
+        self._ended_at: float = None
+
+        #: Counters
+        self.received = 0
+        self.dispatched = 0
+        self.emitted = 0
+
         #: Init logger
         self.logger = logging.getLogger(__name__)
 
     def detect(self):
+        ''' Sets up the pin and starts dispatching edges
+        '''
+
         self.logger.debug('Started motion detection [callback: {}]'.format(self.callback.__qualname__))
-        GPIO.add_event_detect(self.sensor_pin, GPIO.BOTH, callback=self.forwarder)
 
-    def forwarder(self, channel):
-        value = GPIO.input(self.sensor_pin)
-        self.logger.debug('Motion {} [sensor value: {}]'.format('started' if value else 'ended  ', value))
-        self.callback(value)
-        
+        if self.backend is None:
+            self.backend = RPiGPIOBackend()
+
+        SENSOR_EDGES.set_function(lambda: self.received)
+        SENSOR_EDGES_DROPPED.set_function(lambda: self.events.dropped)
+        SENSOR_MOTION_EVENTS.set_function(lambda: self.emitted)
+
+        self.backend.setup(self.sensor_pin)
+        self.dispatcher = threading.Thread(target=self._dispatch, name='rcwl-dispatcher', daemon=True)
+        self.dispatcher.start()
+        self.backend.add_edge_callback(self.sensor_pin, self.forwarder)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def forwarder(self, value: int, timestamp: float):
+        ''' Edge callback, runs in the interrupt thread and only queues the edge
+        '''
+
+        self.received += 1
+        self.events.push((value, timestamp))
+        self._wakeup.set()
+
+    def _dispatch(self):
+        ''' Dispatcher thread: consumes queued edges and applies debounce and hold time
+        '''
+
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._timeout())
+            self._wakeup.clear()
+
+            event = self.events.pop()
+            while event:
+                self.dispatched += 1
+                SENSOR_DISPATCH_LATENCY.observe(self.clock() - event[1])
+                self._edge(*event)
+                event = self.events.pop()
+
+            self._expire(self.clock())
+
+    def _timeout(self) -> Union[float, None]:
+        ''' Time until the next pending decision, None if nothing is pending
+        '''
+
+        deadlines = []
+        if self._candidate:
+            deadlines.append(self._candidate[1] + self.debounce)
+        if self._end_deadline is not None:
+            deadlines.append(self._end_deadline)
+
+        return max(0.0, min(deadlines) - self.clock()) if deadlines else None
+
+    def _edge(self, value: int, timestamp: float):
+        ''' Processes one raw edge in order of arrival
+        '''
+
+        #: Everything pending before this edge is decided by its timestamp
+        self._expire(timestamp)
+
+        #: A new edge replaces a level that has not been stable long enough
+        self._candidate = (value, timestamp)
+        self._expire(timestamp)
+
+    def _expire(self, now: float):
+        ''' Commits a stable candidate level and reports an expired motion end
+        '''
+
+        if self._candidate and now - self._candidate[1] >= self.debounce:
+            value, timestamp = self._candidate
+            self._candidate = None
+            self._commit(bool(value), timestamp)
+
+        if self._end_deadline is not None and now >= self._end_deadline:
+            self._end_deadline = None
+            self._emit(False, self._ended_at)
+
+    def _commit(self, motion: bool, timestamp: float):
+        ''' Handles a debounced level change
+        '''
+
+        if motion:
+
+            #: Motion started again within the hold time, the end is not reported
+            if self._end_deadline is not None:
+                self._end_deadline = None
+                return
+
+            if not self.motion:
+                self._emit(True, timestamp)
+
+        elif self.motion and self._end_deadline is None:
+            self._ended_at = timestamp
+            self._end_deadline = timestamp + self.hold
+            self._expire(timestamp)
+
+    def _emit(self, motion: bool, timestamp: float):
+        self.motion = motion
+        self.emitted += 1
+        self.logger.debug('Motion {} [at {:.3f}]'.format('started' if motion else 'ended  ', timestamp))
+        self.callback(motion, timestamp)
+
+
 if __name__ == '__main__':
-    
-    def callbackasdfasdf(b):
-        print(b)
-    
-    radar = RCWL_0516(callbackasdfasdf)
-    
-    print(radar.detect.__qualname__)
-    
-    while True:
-        sleep(5)
-        
\ No newline at end of file
+
+    import sys
+    from simulation.gpio import SimulatedGPIO
+
+    #: Stress test: replay 10k edges per second, every edge has to be dispatched exactly once, exits non-zero otherwise
+    emitted = []
+    gpio = SimulatedGPIO()
+    radar = RCWL_0516(lambda motion, timestamp: emitted.append((motion, timestamp)), backend=gpio, debounce=0, hold=0, capacity=cfg.SENSOR_EVENT_BUFFER)
+    radar.detect()
+
+    edges = 10000
+    started = time.monotonic()
+    gpio.replay(radar.sensor_pin, [(i / edges, (i + 1) % 2) for i in range(edges)])
+
+    deadline = time.monotonic() + 10
+    while radar.dispatched + radar.events.dropped < edges and time.monotonic() < deadline:
+        time.sleep(0.01)
+    radar.stop()
+
+    alternating = all(a[0] != b[0] and a[1] < b[1] for a, b in zip(emitted, emitted[1:]))
+    print('{} edges in {:.2f} s: received {}, dispatched {}, dropped {}, emitted {}, alternating and ordered: {}'.format(
+        edges, time.monotonic() - started, radar.received, radar.dispatched, radar.events.dropped, len(emitted), alternating))
+
+    failures = [name for name, ok in (('received', radar.received == edges), ('dropped', radar.events.dropped == 0),
+                                      ('emitted', len(emitted) == edges), ('alternating and ordered', alternating)) if not ok]
+    if failures:
+        print('FAILED: {}'.format(', '.join(failures)))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,192 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
+
+import config as cfg
+from role import Role
+from broadcast import TokenBucket
+
+#: Separates the route of a keyboard from its arguments in callback_data, which is limited to 64 bytes
+SEPARATOR = ':'
+MAX_CALLBACK_DATA = 64
+
+
+class Command(NamedTuple):
+    ''' Entry of the dispatch table
+
+        #: handler - method of the bot, called for the command and for presses on its keyboards
+        #: route   - short prefix of the callback_data of its keyboards, None if it has none
+    '''
+
+    name: str
+    role: Role
+    handler: Callable
+    route: str = None
+
+
+class CommandRegistry():
+    ''' Dispatch table of the bot commands, filled by the command decorator
+
+        #: @registry.command('token', Role.ADMIN, route='t')
+        #: async def admin_create_token_command_callback(self, update, context): ...
+        #:
+        #: Keyboards encode their buttons with encode('token', role), a press is routed back to the command
+        #: by decode, with the arguments as context.args
+    '''
+
+    def __init__(self):
+        self.commands: Dict[str, Command] = {}
+        self.routes: Dict[str, Command] = {}
+
+    def command(self, name: str, role: Role, route: str = None) -> Callable:
+        ''' Decorator declaring a command and the role it requires
+        '''
+
+        def decorator(handler: Callable) -> Callable:
+            if name in self.commands or route in self.routes:
+                raise ValueError('Command {} or route {} is registered twice'.format(name, route))
+
+            command = Command(name, role, handler, route)
+            self.commands[name] = command
+            if route:
+                self.routes[route] = command
+
+            return handler
+
+        return decorator
+
+    def encode(self, name: str, *args) -> str:
+        ''' callback_data of a button of the keyboard of a command
+        '''
+
+        data = SEPARATOR.join((self.commands[name].route, *(str(arg) for arg in args)))
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError('callback_data {} is longer than {} bytes'.format(data, MAX_CALLBACK_DATA))
+
+        return data
+
+    def decode(self, data: str) -> Tuple[Union[Command, None], List[str]]:
+        ''' Command and arguments of a button, no command for unknown routes
+        '''
+
+        route, *args = (data or '').split(SEPARATOR)
+        return (self.routes.get(route), args)
+
+
+class Authorizer():
+    ''' Authorization of chats with a cache of their roles, and a limit on replies to unauthorized chats
+
+        #: The cache holds (banned, role) per chat, the least recently used chats are dropped beyond max_chats
+        #: UserService reports every change of a role or ban, which drops the chat from the cache
+        #: Unauthorized chats get an answer at most every 1 / reply_rate seconds (with a burst of reply_burst),
+        #: and all of them together at most reply_global_rate per second, the rest is dropped silently
+    '''
+
+    def __init__(self, userservice: 'UserService', max_chats: int = cfg.AUTH_CACHE_SIZE, reply_rate: float = cfg.UNAUTHORIZED_REPLY_RATE,
+                 reply_burst: float = cfg.UNAUTHORIZED_REPLY_BURST, reply_global_rate: float = cfg.UNAUTHORIZED_REPLY_GLOBAL_RATE, clock: Callable[[], float] = time.monotonic):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.userservice = userservice
+        self.max_chats = max_chats
+        self.reply_rate = reply_rate
+        self.reply_burst = reply_burst
+        self.clock = clock
+
+        self._roles: 'OrderedDict[int, Tuple[bool, Union[Role, None]]]' = OrderedDict()
+        self._buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        self._global_bucket = TokenBucket(reply_global_rate, max(reply_burst, reply_global_rate), clock)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        userservice.listeners.append(self.invalidate)
+
+    def role_of(self, chat_id: int) -> Tuple[bool, Union[Role, None]]:
+        ''' Whether the chat is banned, and its role if it is registered
+        '''
+
+        with self._lock:
+            if chat_id in self._roles:
+                self._roles.move_to_end(chat_id)
+                return self._roles[chat_id]
+            generation = self._generation
+
+        entry = (self.userservice.is_banned(chat_id), self.userservice.get_role_of(chat_id))
+
+        #: Not cached if a change was reported meanwhile, the entry may be outdated already
+        with self._lock:
+            if generation == self._generation:
+                self._roles[chat_id] = entry
+                if len(self._roles) > self.max_chats:
+                    self._roles.popitem(last=False)
+
+        return entry
+
+    def is_authorized(self, chat_id: int, role: Role) -> bool:
+        ''' Banned chats are never authorized, otherwise the role has to be open or the chat registered with at least the role
+        '''
+
+        banned, user_role = self.role_of(chat_id)
+        if banned:
+            return False
+
+        return role is Role.OPEN or (user_role is not None and user_role >= role)
+
+    def invalidate(self, chat_id: int = None) -> None:
+        ''' Drops the chat from the cache, every chat without chat_id
+        '''
+
+        with self._lock:
+            self._generation += 1
+            if chat_id is None:
+                self._roles.clear()
+            else:
+                self._roles.pop(chat_id, None)
+
+    def may_reply(self, chat_id: int) -> bool:
+        ''' Whether an unauthorized chat gets an answer now
+        '''
+
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.reply_rate, self.reply_burst, self.clock)
+                if len(self._buckets) > self.max_chats:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(chat_id)
+
+        return bucket.try_acquire() and self._global_bucket.try_acquire()
+
+
+if __name__ == '__main__':
+
+    from userservice import UserService
+    from user import User
+
+    #: Benchmark: authorization checks of registered, unknown and banned chats, cached and uncached
+    userservice = UserService()
+    for chat_id in range(100):
+        userservice.users[chat_id] = User(chat_id, 'user{}'.format(chat_id), Role.ADMIN)
+    userservice.banned[1000] = User(1000, 'banned', Role.SUB)
+
+    authorizer = Authorizer(userservice)
+    checks = 10 ** 5
+
+    for name, check in (('uncached', lambda chat_id: (userservice.is_banned(chat_id), userservice.user_has_role(chat_id, Role.ADMIN))),
+                        ('cached', lambda chat_id: authorizer.is_authorized(chat_id, Role.ADMIN))):
+        started = time.perf_counter()
+        for n in range(checks):
+            check((0, 500, 1000)[n % 3])
+        print('{:9} {:.2f} us per check'.format(name, (time.perf_counter() - started) / checks * 1e6))
+
+    #: Flood of one unauthorized chat, one command per millisecond for 10 virtual seconds
+    clock = [0.0]
+    authorizer = Authorizer(userservice, clock=lambda: clock[0])
+    replies = 0
+    for n in range(10000):
+        clock[0] = n / 1000
+        replies += authorizer.may_reply(500)
+    print('flood: {} of 10000 commands of an unauthorized chat answered within 10 s'.format(replies))
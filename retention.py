@@ -0,0 +1,222 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Set, Tuple
+
+import config as cfg
+import metrics
+
+VIDEO_BYTES = metrics.gauge('surveillance_video_bytes', 'Size of all indexed videos')
+VIDEO_FILES = metrics.gauge('surveillance_video_files', 'Number of indexed videos')
+VIDEO_HEADROOM = metrics.gauge('surveillance_video_headroom_bytes', 'Bytes that can be recorded before videos are evicted')
+VIDEO_EVICTIONS = metrics.counter('surveillance_video_evictions', 'Deleted videos by reason', ('reason',))
+
+
+class Retention():
+    ''' Keeps the videos directory within a byte quota, a max age and a min of free disk space
+
+        #: The directory is scanned once at startup, afterwards finished videos are added to the index
+        #: The index is ordered by age, eviction deletes the oldest videos first
+        #: Videos returned by pinned (not delivered yet) are never deleted, on_evict is called for every deleted video
+        #: Eviction runs in its own thread, woken by new videos and every interval for the max age
+    '''
+
+    def __init__(self, directory: str, quota: int = cfg.VIDEO_QUOTA_BYTES, max_age: float = cfg.VIDEO_MAX_AGE, min_free: int = cfg.VIDEO_MIN_FREE_BYTES,
+                 interval: float = cfg.RETENTION_INTERVAL, pinned: Callable[[], Set[str]] = set, on_evict: Callable[[str], None] = None, clock: Callable[[], float] = time.time):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.directory = directory
+        self.quota = quota
+        self.max_age = max_age
+        self.min_free = min_free
+        self.interval = interval
+        self.pinned = pinned
+        self.on_evict = on_evict
+        self.clock = clock
+
+        #: (mtime, size) by path, oldest first
+        self.index: Dict[str, Tuple[float, int]] = OrderedDict()
+        self.total = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+
+        self._scan()
+
+        VIDEO_BYTES.set_function(lambda: self.total)
+        VIDEO_FILES.set_function(lambda: len(self.index))
+        VIDEO_HEADROOM.set_function(self.headroom)
+
+    def _scan(self) -> None:
+        ''' Builds the index from the files in the directory
+        '''
+
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except FileNotFoundError:
+            entries = []
+
+        files = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+
+        with self._lock:
+            for mtime, size, path in files:
+                self.index[path] = (mtime, size)
+                self.total += size
+
+        self.logger.debug('Indexed {} videos, {:.1f} MB'.format(len(files), self.total / 1e6))
+
+    def start(self) -> 'Retention':
+        threading.Thread(target=self._run, name='retention', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._changed.set()
+
+    def add(self, path: str) -> None:
+        ''' Adds a finished video and wakes the eviction thread, returns right away
+        '''
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            if path in self.index:
+                self.total -= self.index.pop(path)[1]
+            self.index[path] = (stat.st_mtime, stat.st_size)
+            self.total += stat.st_size
+
+        self._changed.set()
+
+    def remove(self, path: str) -> None:
+        ''' Removes a video from the index, the file is left alone
+        '''
+
+        with self._lock:
+            if path in self.index:
+                self.total -= self.index.pop(path)[1]
+
+    def free(self) -> int:
+        ''' Free bytes on the disk of the directory
+        '''
+
+        try:
+            return shutil.disk_usage(self.directory).free
+        except FileNotFoundError:
+            return 0
+
+    def headroom(self) -> int:
+        ''' Bytes until the quota or the min of free disk space is reached, whichever comes first
+        '''
+
+        return min(self.quota - self.total, self.free() - self.min_free)
+
+    def enforce(self) -> int:
+        ''' Deletes the oldest unpinned videos until every limit holds
+
+            #: return -> number of deleted videos
+        '''
+
+        cutoff = self.clock() - self.max_age if self.max_age else None
+        free = self.free()
+
+        #: Usually every limit holds, which is decided without walking the index
+        with self._lock:
+            oldest = next(iter(self.index.values()), (float('inf'), 0))[0]
+            if self.total <= self.quota and free >= self.min_free and not (cutoff and oldest < cutoff):
+                return 0
+
+        pinned: Set[str] = self.pinned()
+
+        with self._lock:
+            candidates = [(path, mtime, size) for path, (mtime, size) in self.index.items() if path not in pinned]
+
+        evicted = 0
+        total = self.total
+        for path, mtime, size in candidates:
+            if total > self.quota:
+                reason = 'quota'
+            elif free < self.min_free:
+                reason = 'disk'
+            elif cutoff and mtime < cutoff:
+                reason = 'age'
+            else:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.warning('Could not delete {}: {}'.format(path, e))
+                continue
+
+            self.remove(path)
+            if self.on_evict:
+                self.on_evict(path)
+
+            total -= size
+            free += size
+            evicted += 1
+
+            VIDEO_EVICTIONS.labels(reason).inc()
+            self.logger.debug('Deleted {} [{}]'.format(os.path.basename(path), reason))
+
+        if total > self.quota or free < self.min_free:
+            self.logger.warning('Videos still need {:.1f} MB of {:.1f} MB quota with {:.1f} MB free, the rest is not delivered yet'.format(
+                total / 1e6, self.quota / 1e6, free / 1e6))
+
+        return evicted
+
+    def _run(self) -> None:
+        ''' Eviction thread
+        '''
+
+        while not self._stopped.is_set():
+            try:
+                self.enforce()
+            except Exception:
+                self.logger.exception('Enforcing the video retention failed')
+
+            self._changed.wait(self.interval)
+            self._changed.clear()
+
+
+if __name__ == '__main__':
+
+    import tempfile
+
+    #: Benchmark: enforcing the quota with the index compared to rescanning the directory, 10000 videos
+    directory = tempfile.mkdtemp()
+    now = time.time()
+    for n in range(10000):
+        path = os.path.join(directory, '{:05}.mp4'.format(n))
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1024)
+        os.utime(path, (now - 10000 + n, now - 10000 + n))
+
+    started = time.perf_counter()
+    retention = Retention(directory, quota=10 ** 12, max_age=None, min_free=0)
+    print('startup scan: {:.1f} ms for {} videos'.format((time.perf_counter() - started) * 1000, len(retention.index)))
+
+    started = time.perf_counter()
+    for _ in range(100):
+        retention.enforce()
+    print('enforce with index: {:.2f} ms'.format((time.perf_counter() - started) * 10))
+
+    started = time.perf_counter()
+    for _ in range(100):
+        sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in os.scandir(directory))
+    print('rescan per check:   {:.2f} ms'.format((time.perf_counter() - started) * 10))
+
+    retention.quota = 5000 * 1024
+    started = time.perf_counter()
+    evicted = retention.enforce()
+    print('evicted {} oldest videos in {:.1f} ms, {} left'.format(evicted, (time.perf_counter() - started) * 1000, len(retention.index)))
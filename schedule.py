@@ -0,0 +1,334 @@
+import os
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Callable, FrozenSet, List, NamedTuple, Tuple, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import config as cfg
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+#: Shortcuts for the days of a window
+DAY_GROUPS = {
+    'daily': frozenset(range(7)),
+    'weekdays': frozenset(range(5)),
+    'weekends': frozenset((5, 6)),
+}
+
+
+class Window(NamedTuple):
+    ''' Weekly window, from start to end on every given day, end before start spans midnight
+    '''
+
+    id: int
+    armed: bool
+    days: FrozenSet[int]
+    start: time
+    end: time
+
+
+class Once(NamedTuple):
+    ''' One-off exception from start to end (aware datetimes), takes precedence over the windows
+    '''
+
+    id: int
+    armed: bool
+    start: datetime
+    end: datetime
+
+
+Rule = Union[Window, Once]
+
+
+def local_zone() -> ZoneInfo:
+    ''' Time zone of the schedules, SCHEDULE_TIMEZONE or the time zone of the system
+    '''
+
+    name = cfg.SCHEDULE_TIMEZONE
+    if not name:
+        try:
+            with open('/etc/timezone') as f:
+                name = f.read().strip()
+        except OSError:
+            link = os.path.realpath('/etc/localtime')
+            name = link.split('zoneinfo/', 1)[1] if 'zoneinfo/' in link else 'UTC'
+
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logging.getLogger(__name__).warning('Unknown time zone {}, schedules use UTC'.format(name))
+        return ZoneInfo('UTC')
+
+
+class Schedule():
+    ''' Arms and disarms the surveillance by weekly windows and one-off exceptions
+
+        #: A one-off exception decides while it lasts, the latest one if several overlap
+        #: Otherwise a window decides, armed if an arm and a disarm window overlap
+        #: Outside every rule, the surveillance is disarmed if there are arm windows and armed if not
+        #:
+        #: Times are wall-clock times of the zone: a start in the gap of spring forward is shifted by the gap
+        #: (02:30 becomes 03:30), a time repeated at fall back counts at its first occurrence
+        #:
+        #: The thread only wakes up for the precomputed next transition, when rules change, and at least every max_sleep
+        #: seconds in case the wall clock jumped (the Pi has no real-time clock and is set by ntp after booting)
+        #: on_change is called with the new state at every transition, and at start if there are rules
+        #: In between, /pause and /unpause still change the state until the next transition
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS rules (
+            id    INTEGER PRIMARY KEY AUTOINCREMENT,
+            armed INTEGER NOT NULL,
+            days  INTEGER,
+            start TEXT NOT NULL,
+            end   TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path: str = cfg.SCHEDULE_PATH, on_change: Callable[[bool], None] = None, zone: ZoneInfo = None,
+                 clock: Callable[[], datetime] = None, max_sleep: float = 60):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.on_change = on_change
+        self.zone = zone or local_zone()
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
+        self.max_sleep = max_sleep
+
+        #: Next (time, state), and the state applied last
+        self.transition: Union[Tuple[datetime, bool], None] = None
+        self.applied: Union[bool, None] = None
+
+        #: Without a path the schedule only lives in memory
+        self._connection = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._connection.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+
+        self.rules: List[Rule] = [self._rule(*row) for row in self._connection.execute('SELECT id, armed, days, start, end FROM rules ORDER BY id')]
+
+    def start(self) -> 'Schedule':
+        self._changed.set()
+        threading.Thread(target=self._run, name='schedule', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._changed.set()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def add_window(self, armed: bool, days: FrozenSet[int], start: time, end: time) -> Window:
+        return self._add(Window(None, armed, frozenset(days), start, end))
+
+    def add_once(self, armed: bool, start: datetime, end: datetime) -> Once:
+        return self._add(Once(None, armed, start, end))
+
+    def remove(self, id: int) -> bool:
+        with self._lock, self._connection:
+            removed = self._connection.execute('DELETE FROM rules WHERE id = ?', (id,)).rowcount
+            self.rules = [rule for rule in self.rules if rule.id != id]
+
+        self._changed.set()
+        return bool(removed)
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM rules')
+            self.rules = []
+
+        self._changed.set()
+
+    def state(self, at: datetime) -> Union[bool, None]:
+        ''' Whether the surveillance is armed at the given time, None without rules
+        '''
+
+        with self._lock:
+            rules = list(self.rules)
+
+        return self._state(rules, at)
+
+    def next_transition(self, after: datetime, horizon: timedelta = timedelta(days=8)) -> Union[Tuple[datetime, bool], None]:
+        ''' First change of the state after the given time within the horizon
+
+            #: return -> (time of the change, new state), None if the state does not change
+        '''
+
+        with self._lock:
+            rules = list(self.rules)
+
+        current = self._state(rules, after)
+        edges = sorted({edge for start, end, _ in self._intervals(rules, after, after + horizon) for edge in (start, end) if after < edge <= after + horizon})
+
+        for edge in edges:
+            state = self._state(rules, edge)
+            if state != current:
+                return (edge, state)
+
+        return None
+
+    def describe(self, rule: Rule) -> str:
+        ''' Rule as listed by /schedule
+        '''
+
+        action = 'arm' if rule.armed else 'disarm'
+        if isinstance(rule, Once):
+            return '{} {} {} - {}'.format(rule.id, action, rule.start.astimezone(self.zone).strftime('%Y-%m-%d %H:%M'), rule.end.astimezone(self.zone).strftime('%Y-%m-%d %H:%M'))
+
+        days = next((name for name, group in DAY_GROUPS.items() if group == rule.days), ','.join(DAY_NAMES[day] for day in sorted(rule.days)))
+        return '{} {} {} {}-{}'.format(rule.id, action, days, rule.start.strftime('%H:%M'), rule.end.strftime('%H:%M'))
+
+    def _add(self, rule: Rule) -> Rule:
+        if isinstance(rule, Once):
+            row = (int(rule.armed), None, rule.start.isoformat(), rule.end.isoformat())
+        else:
+            row = (int(rule.armed), sum(1 << day for day in rule.days), rule.start.isoformat('minutes'), rule.end.isoformat('minutes'))
+
+        with self._lock, self._connection:
+            rule = rule._replace(id=self._connection.execute('INSERT INTO rules (armed, days, start, end) VALUES (?, ?, ?, ?)', row).lastrowid)
+            self.rules.append(rule)
+
+        self._changed.set()
+        return rule
+
+    def _rule(self, id: int, armed: int, days: Union[int, None], start: str, end: str) -> Rule:
+        if days is None:
+            return Once(id, bool(armed), datetime.fromisoformat(start), datetime.fromisoformat(end))
+        return Window(id, bool(armed), frozenset(day for day in range(7) if days >> day & 1), time.fromisoformat(start), time.fromisoformat(end))
+
+    def _intervals(self, rules: List[Rule], since: datetime, until: datetime) -> List[Tuple[datetime, datetime, Rule]]:
+        ''' Occurrences of the rules overlapping since to until, in UTC
+        '''
+
+        intervals = []
+        first, last = since.astimezone(self.zone).date() - timedelta(days=1), until.astimezone(self.zone).date()
+
+        for rule in rules:
+            if isinstance(rule, Once):
+                intervals.append((rule.start.astimezone(timezone.utc), rule.end.astimezone(timezone.utc), rule))
+                continue
+
+            day = first
+            while day <= last:
+                if day.weekday() in rule.days:
+                    intervals.append((self._instant(day, rule.start), self._instant(day + timedelta(days=rule.end <= rule.start), rule.end), rule))
+                day += timedelta(days=1)
+
+        return intervals
+
+    def _instant(self, day: date, at: time) -> datetime:
+        ''' Wall-clock time of the zone in UTC, fold 0 shifts times in a gap by the gap and picks the first of repeated times
+        '''
+
+        return datetime.combine(day, at, tzinfo=self.zone).astimezone(timezone.utc)
+
+    def _state(self, rules: List[Rule], at: datetime) -> Union[bool, None]:
+        if not rules:
+            return None
+
+        covering = [rule for start, end, rule in self._intervals(rules, at, at) if start <= at < end]
+
+        once = [rule for rule in covering if isinstance(rule, Once)]
+        if once:
+            return max(once, key=lambda rule: rule.id).armed
+
+        windows = [rule for rule in covering if isinstance(rule, Window)]
+        if windows:
+            return any(rule.armed for rule in windows)
+
+        return not any(rule.armed for rule in rules if isinstance(rule, Window))
+
+    def _step(self, now: datetime) -> float:
+        ''' Applies a due transition or a change of the rules
+
+            #: return -> seconds until the next step
+        '''
+
+        if self._changed.is_set() or (self.transition and now >= self.transition[0]):
+            self._changed.clear()
+
+            #: Expired exceptions are dropped
+            for rule in [rule for rule in self.rules if isinstance(rule, Once) and rule.end <= now]:
+                self.remove(rule.id)
+                self._changed.clear()
+
+            state = self.state(now)
+            if state is not None and state != self.applied:
+                self.applied = state
+                self.logger.info('Surveillance {} by schedule'.format('armed' if state else 'disarmed'))
+                if self.on_change:
+                    self.on_change(state)
+
+            self.transition = self.next_transition(now)
+
+        if self.transition is None:
+            return self.max_sleep
+
+        return max(0.0, min(self.max_sleep, (self.transition[0] - now).total_seconds()))
+
+    def _run(self) -> None:
+        ''' Schedule thread
+        '''
+
+        while not self._stopped.is_set():
+            try:
+                timeout = self._step(self.clock())
+            except Exception:
+                self.logger.exception('Applying the schedule failed')
+                timeout = self.max_sleep
+
+            self._changed.wait(timeout)
+
+
+def parse_rule(args: List[str], zone: ZoneInfo) -> Tuple[bool, Union[Tuple[FrozenSet[int], time, time], Tuple[datetime, datetime]]]:
+    ''' Rule of /schedule, raises ValueError for anything else
+
+        #: ['disarm', 'weekdays', '08:00-17:00']         -> weekly window
+        #: ['arm', 'mon,wed-fri', '22:00-06:00']         -> weekly window spanning midnight
+        #: ['disarm', '2022-12-24', '2022-12-26']        -> both days and every day between
+        #: ['disarm', '2022-12-24T18:00', '2022-12-26T08:00']
+        #: return -> armed and either (days, start, end) or (start, end) of a one-off exception
+    '''
+
+    if len(args) != 3 or args[0].lower() not in ('arm', 'disarm'):
+        raise ValueError('Expected arm or disarm, days and times')
+
+    armed = args[0].lower() == 'arm'
+
+    #: One-off exception, a date without time includes the whole day
+    if args[1][:1].isdigit():
+        start, end = (datetime.fromisoformat(arg) for arg in args[1:])
+        if 'T' not in args[2]:
+            end += timedelta(days=1)
+
+        start, end = start.replace(tzinfo=zone), end.replace(tzinfo=zone)
+        if end <= start:
+            raise ValueError('The end has to be after the start')
+
+        return (armed, (start, end))
+
+    if args[2].count('-') != 1:
+        raise ValueError('Expected times like 08:00-17:00')
+
+    days = set()
+    for part in args[1].lower().split(','):
+        if part in DAY_GROUPS:
+            days |= DAY_GROUPS[part]
+        elif '-' in part:
+            first, last = (DAY_NAMES.index(name[:3]) for name in part.split('-', 1))
+            days |= {day % 7 for day in range(first, last + 1 if last >= first else last + 8)}
+        else:
+            days.add(DAY_NAMES.index(part[:3]))
+
+    start, end = (time.fromisoformat(value) for value in args[2].split('-'))
+    if start == end:
+        raise ValueError('The window is empty')
+
+    return (armed, (frozenset(days), start, end))
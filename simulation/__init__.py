@@ -0,0 +1,4 @@
+''' Hardware-free stand-ins for the Raspberry Pi peripherals
+
+    #: Allows running the camera pipeline off a Pi, e.g. for latency measurements
+'''
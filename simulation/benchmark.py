@@ -0,0 +1,210 @@
+''' End-to-end latency benchmark on simulated hardware
+
+    #: Wires the Controller to FakePiCamera, SimulatedGPIO and the FakeBotAPIServer,
+    #: replays scripted motion traces and reports latency percentiles:
+    #:   motion -> alert            first alert message (or alert photo) received by the api
+    #:   motion -> first image      first alert photo received by the api, the snapshot of the incident
+    #:   motion -> first video      first video of the incident received by the api
+    #:   motion -> first frame      capture time of the first frame in the clip (negative with pre-roll)
+    #:   stop -> mp4 ready          conversion queued until conversion done
+    #:   stop -> video delivered    conversion queued until the video reached the api
+    #:
+    #: python3 -m simulation.benchmark --incidents 10 --trace short --json results.json
+'''
+
+import json
+import time
+import logging
+import argparse
+import tempfile
+from typing import Dict, List
+
+import config as cfg
+import utils
+
+#: (offset in seconds, sensor level) pairs, motion always starts at offset 0
+TRACES = {
+    'short': [(0.0, 1), (0.5, 0)],
+    'long': [(0.0, 1), (3.0, 0)],
+    'flapping': [(0.0, 1), (0.3, 0), (0.35, 1), (0.6, 0), (0.65, 1), (1.0, 0)],
+}
+
+#: Shortened timings, so an incident takes a few seconds
+SIMULATION_CONFIG = {
+    'TELEGRAM_API_TOKEN': '123456:SIMULATION',
+    'DATABASE_PATH': None,
+    'SPOOL_PATH': None,
+    'CATALOG_PATH': None,
+    'SCHEDULE_PATH': None,
+    'TOKEN_REAPER_INTERVAL': None,
+    'CAMERA_PRE_ROLL_SECONDS': 1,
+    'BUFFER_TIME_STEPS': 2,
+    'BUFFER_TIME_STEP_LENGTH': 0.25,
+    'MAX_VIDEO_LENGTH': 2,
+}
+
+OWNER_CHAT_ID = 1000
+
+METRICS = ('motion -> alert', 'motion -> first image', 'motion -> first video', 'motion -> first frame', 'stop -> mp4 ready', 'stop -> video delivered')
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    ''' Nearest-rank percentiles
+    '''
+
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+
+    def rank(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': ordered[-1], 'n': len(ordered)}
+
+
+class Harness():
+    ''' Controller running on simulated hardware against the fake Bot API
+    '''
+
+    def __init__(self, latency: float = 0.05, admins: int = 1):
+
+        #: Imported here, the config has to be patched first
+        from camera import Camera
+        from controller import Controller
+        from role import Role
+        from simulation.camera import FakeCircularIO, FakePiCamera, SimulatedConverter
+        from simulation.gpio import SimulatedGPIO
+        from simulation.server import FakeBotAPIServer
+
+        self.server = FakeBotAPIServer(latency).start()
+        cfg.TELEGRAM_API_URL = self.server.url
+
+        self.fake = FakePiCamera()
+        self.converter = SimulatedConverter(self.fake.frame_size)
+        camera = Camera(self.fake, FakeCircularIO, self.converter)
+        camera.video_dir = tempfile.mkdtemp()
+
+        self.gpio = SimulatedGPIO()
+        self.controller = Controller(camera, self.gpio)
+
+        #: Register the owner and unpause like a user would
+        self.command(OWNER_CHAT_ID, '/activate ' + cfg.OWNER_ACTIVATION_TOKEN, 'Registered')
+        self.command(OWNER_CHAT_ID, '/unpause', 'Surveillance activated.')
+
+        #: Additional admins receive the video by file_id
+        userservice = self.controller.bot.userservice
+        for chat_id in range(OWNER_CHAT_ID + 1, OWNER_CHAT_ID + admins):
+            userservice.activate_token(userservice.generate_token(Role.ADMIN).value, chat_id, 'admin{}'.format(chat_id))
+
+        #: Wait for the encoder to start
+        time.sleep(self.fake.startup_delay)
+
+    def command(self, chat_id: int, text: str, answer: str) -> None:
+        ''' Sends a command through the api and waits for the answer
+        '''
+
+        self.server.push_command(chat_id, text)
+        if not self.server.wait_for(lambda calls: any(c.method == 'sendMessage' and c.params.get('text', '').startswith(answer) for c in calls)):
+            raise RuntimeError('No answer to {}'.format(text))
+
+    def run_incident(self, trace: list, timeout: float = 30) -> Dict[str, List[float]]:
+        ''' Replays one motion trace and waits until every clip was delivered
+
+            #: return -> measured latencies by metric, in seconds
+        '''
+
+        calls = len(self.server.calls)
+        jobs = set(self.converter.jobs)
+
+        motion = time.monotonic()
+        self.gpio.replay(self.controller.rcwl.sensor_pin, trace)
+
+        #: Wait for the recording to end and every new clip to arrive at the api
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            new_jobs = [job for target, job in self.converter.jobs.items() if target not in jobs and not job.profile]
+            if new_jobs and not self.controller.recording_lock.locked() and all(self._delivery(job, calls) for job in new_jobs):
+                break
+            time.sleep(0.02)
+        else:
+            raise RuntimeError('Incident was not delivered within {} s'.format(timeout))
+
+        #: With a snapshot the alert text is the caption of the photo
+        alerts = [c for c in self.server.calls[calls:] if c.method in ('sendMessage', 'sendPhoto') and not c.failed and
+                  (c.params.get('text') or c.params.get('caption') or '').startswith('Motion detected')]
+        results = {metric: [] for metric in METRICS}
+        results['motion -> alert'].append(alerts[0].received - motion)
+
+        photos = [c for c in alerts if c.method == 'sendPhoto']
+        if photos:
+            results['motion -> first image'].append(photos[0].received - motion)
+        results['motion -> first video'].append(min(self._delivery(job, calls).received for job in new_jobs) - motion)
+
+        #: Only the first segment of an incident starts at the motion
+        first = min(new_jobs, key=lambda job: job.submitted)
+        if first.target in self.converter.first_frames:
+            results['motion -> first frame'].append(self.converter.first_frames[first.target] - motion)
+
+        for job in new_jobs:
+            results['stop -> mp4 ready'].append(job.finished - job.submitted)
+            results['stop -> video delivered'].append(self._delivery(job, calls).received - job.submitted)
+
+        return results
+
+    def _delivery(self, job, calls: int):
+        ''' First video upload of the job's clip after the given call index
+        '''
+
+        name = utils.basename(job.target)
+        for call in self.server.calls[calls:]:
+            if call.method == 'sendVideo' and not call.failed and (call.params.get('caption') or '').startswith(name):
+                return call
+        return None
+
+    def stop(self) -> None:
+        self.controller.rcwl.stop()
+        self.controller.bot.stop()
+        self.fake.close()
+        self.server.stop()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='End-to-end latency benchmark on simulated hardware')
+    parser.add_argument('--incidents', type=int, default=10, help='number of replayed incidents')
+    parser.add_argument('--trace', choices=TRACES, default='short', help='motion trace to replay')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of the fake api in seconds')
+    parser.add_argument('--admins', type=int, default=3, help='number of admins receiving videos')
+    parser.add_argument('--pause', type=float, default=2.0, help='seconds between incidents, refills the pre-roll buffer')
+    parser.add_argument('--json', help='write the percentiles to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    for key, value in SIMULATION_CONFIG.items():
+        setattr(cfg, key, value)
+
+    harness = Harness(args.latency, args.admins)
+    results = {metric: [] for metric in METRICS}
+
+    try:
+        for _ in range(args.incidents):
+            time.sleep(args.pause)
+            for metric, values in harness.run_incident(TRACES[args.trace]).items():
+                results[metric] += values
+    finally:
+        harness.stop()
+
+    report = {metric: percentiles(values) for metric, values in results.items()}
+
+    print('{:26} {:>9} {:>9} {:>9} {:>9} {:>4}'.format('[ms]', 'p50', 'p90', 'p99', 'max', 'n'))
+    for metric, values in report.items():
+        if values:
+            print('{:26} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:4}'.format(metric, *(values[p] * 1000 for p in ('p50', 'p90', 'p99', 'max')), values['n']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
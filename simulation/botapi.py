@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import itertools
+from datetime import datetime
+from typing import Dict, Set
+
+from telegram import Chat, Message, PhotoSize, Video
+from telegram.error import NetworkError
+
+
+class FakeBot():
+    ''' In-process stand-in for telegram.Bot
+
+        #: Implements the send methods used by SurveillanceBot and answers with real telegram objects
+        #: Counts calls and uploaded bytes, a file sent by file_id costs no upload
+        #: latency is added to every call, chat_ids in fail_chats raise a NetworkError
+    '''
+
+    def __init__(self, latency: float = 0.0, fail_chats: Set[int] = None):
+        self.latency = latency
+        self.fail_chats = fail_chats or set()
+
+        self.calls: Dict[str, int] = {}
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.sent: Dict[int, list] = {}
+
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> Message:
+        await self._call('send_message', chat_id, text)
+        return self._message(chat_id, text=text)
+
+    async def send_video(self, chat_id: int, video, caption: str = None, **kwargs) -> Message:
+        file_id = await self._call('send_video', chat_id, video)
+        return self._message(chat_id, caption=caption, video=Video(file_id, file_id, 1280, 720, 0))
+
+    async def send_photo(self, chat_id: int, photo, caption: str = None, **kwargs) -> Message:
+        file_id = await self._call('send_photo', chat_id, photo)
+        return self._message(chat_id, caption=caption, photo=[PhotoSize(file_id, file_id, 1280, 720)])
+
+    async def _call(self, method: str, chat_id: int, content) -> str:
+        ''' Simulates a request, uploads are read completely like the real bot does
+
+            #: return -> file_id of the sent content
+        '''
+
+        file_id = content if isinstance(content, str) else None
+
+        if hasattr(content, 'read'):
+            content = content.read()
+
+        await asyncio.sleep(self.latency)
+
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+            if chat_id in self.fail_chats:
+                raise NetworkError('Injected failure for chat {}'.format(chat_id))
+
+            if isinstance(content, bytes):
+                self.uploads += 1
+                self.uploaded_bytes += len(content)
+                file_id = 'file-{}'.format(next(self._file_ids))
+
+            self.sent.setdefault(chat_id, []).append((method, file_id or content))
+
+        return file_id
+
+    def _message(self, chat_id: int, **kwargs) -> Message:
+        with self._lock:
+            message_id = next(self._message_ids)
+        return Message(message_id, datetime.now(), Chat(chat_id, Chat.PRIVATE), **kwargs)
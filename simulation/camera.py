@@ -0,0 +1,337 @@
+import io
+import os
+import time
+import struct
+import threading
+from collections import deque
+from fractions import Fraction
+from typing import Dict, List, Tuple
+
+from converter import ConversionJob, Converter
+
+#: Every simulated frame starts with an Annex B start code,
+#: followed by the nal type and the monotonic capture timestamp
+START_CODE = b'\x00\x00\x00\x01'
+SPS_HEADER = 0x67
+FRAME = 0x41
+FRAME_HEADER = struct.Struct('>4sBd')
+
+
+def encode_frame(keyframe: bool, timestamp: float, frame_size: int) -> bytes:
+    ''' Builds a fake H.264 frame of frame_size bytes carrying its capture timestamp
+    '''
+
+    header = FRAME_HEADER.pack(START_CODE, SPS_HEADER if keyframe else FRAME, timestamp)
+    return header + bytes(max(0, frame_size - len(header)))
+
+
+def frame_timestamps(data: bytes, frame_size: int) -> List[Tuple[bool, float]]:
+    ''' Parses fake frames produced by FakePiCamera
+
+        #: return -> list of (is_keyframe, capture timestamp) tuples
+    '''
+
+    frames = []
+    for offset in range(0, len(data) - FRAME_HEADER.size + 1, frame_size):
+        _, nal, timestamp = FRAME_HEADER.unpack_from(data, offset)
+        frames.append((nal == SPS_HEADER, timestamp))
+    return frames
+
+
+class FakePiCamera():
+    ''' Minimal PiCamera replacement
+
+        #: Implements the recording and capture api used by Camera
+        #: Frames are produced in a dedicated thread at the configured framerate
+        #: startup_delay simulates the time the encoder needs to produce the first frame
+        #: Recordings on other splitter ports stream unencoded frames of scene, a callable
+        #: returning the luma plane of the frame at an index (grey without a scene)
+        #: A motion_output receives the motion vectors of every frame from vectors, a callable
+        #: returning the vectors of the frame at an index (no motion without vectors)
+    '''
+
+    def __init__(self, resolution=(1280, 720), framerate: int = 30, frame_size: int = 4096, startup_delay: float = 1.0, snapshot_size: int = 100 * 1024):
+        self.resolution = resolution
+        self.framerate = Fraction(framerate)
+        self.frame_size = frame_size
+        self.snapshot_size = snapshot_size
+        self.startup_delay = startup_delay
+        self.recording = False
+        self.scene = None
+        self.vectors = None
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._split_done = threading.Event()
+        self._output = None
+        self._split_output = None
+        self._motion_output = None
+        self._thread = None
+        self._ports: Dict[int, threading.Event] = {}
+
+    def start_recording(self, output, format: str = 'h264', intra_period: int = None, splitter_port: int = 1, resize=None, motion_output=None, **options) -> None:
+        ''' Starts the simulated encoder writing into output (path or file-like object)
+        '''
+
+        if splitter_port != 1:
+            self._ports[splitter_port] = threading.Event()
+            threading.Thread(target=self._stream, args=(output, resize or self.resolution, self._ports[splitter_port]), daemon=True).start()
+            return
+
+        self._intra_period = intra_period or int(self.framerate)
+        self._output = self._open(output)
+        self._motion_output = self._open(motion_output) if motion_output is not None else None
+        self._stopped.clear()
+        self.recording = True
+
+        self._thread = threading.Thread(target=self._encode, daemon=True)
+        self._thread.start()
+
+    def split_recording(self, output, **options) -> None:
+        ''' Switches the output at the next keyframe, blocks until the switch happened
+        '''
+
+        with self._lock:
+            self._split_done.clear()
+            self._split_output = self._open(output)
+
+        self._split_done.wait()
+
+    def capture(self, output, format: str = 'jpeg', use_video_port: bool = False, **options) -> None:
+        ''' Writes a fake JPEG of snapshot_size bytes once the next frame is ready
+
+            #: The video port hands out the next frame, the still port first reconfigures the sensor
+        '''
+
+        time.sleep(1 / float(self.framerate) if use_video_port else self.startup_delay)
+
+        stream, owned = self._open(output)
+        stream.write(b'\xff\xd8' + bytes(max(0, self.snapshot_size - 4)) + b'\xff\xd9')
+        self._close((stream, owned))
+
+    def stop_recording(self, splitter_port: int = 1) -> None:
+        ''' Stops the encoder and closes outputs opened from paths
+        '''
+
+        if splitter_port != 1:
+            self._ports.pop(splitter_port).set()
+            return
+
+        self._stopped.set()
+        self._split_done.set()
+        self._thread.join()
+        self.recording = False
+        self._close(self._output)
+        if self._motion_output:
+            self._close(self._motion_output)
+
+        #: A split that did not happen anymore still owns its output
+        if self._split_output:
+            self._close(self._split_output)
+            self._split_output = None
+
+    def close(self) -> None:
+        for splitter_port in list(self._ports):
+            self.stop_recording(splitter_port)
+        if self.recording:
+            self.stop_recording()
+
+    def _open(self, output):
+        if isinstance(output, str):
+            return (open(output, 'wb'), True)
+        return (output, False)
+
+    def _close(self, output) -> None:
+        stream, owned = output
+        if owned:
+            stream.close()
+
+    def _stream(self, output, resolution: Tuple[int, int], stopped: threading.Event) -> None:
+        ''' Writes one unencoded YUV420 frame of the scene per frame interval
+        '''
+
+        width, height = resolution
+        grey = bytes([128]) * (width * height)
+        chroma = grey[:width * height // 2]
+
+        interval = 1 / float(self.framerate)
+        index = 0
+        deadline = time.monotonic()
+        while not stopped.wait(max(0, deadline - time.monotonic())):
+            luma = bytes(self.scene(index)) if self.scene else grey
+            output.write(luma + chroma)
+
+            index += 1
+            deadline += interval
+
+    def _encode(self) -> None:
+        ''' Encoder loop, writes one frame per frame interval
+        '''
+
+        interval = 1 / float(self.framerate)
+
+        #: One vector of 4 bytes per macroblock, plus one column
+        width, height = self.resolution
+        still = bytes(((height + 15) // 16) * ((width + 15) // 16 + 1) * 4)
+
+        #: Simulate encoder spin-up
+        if self._stopped.wait(self.startup_delay):
+            return
+
+        index = 0
+        deadline = time.monotonic()
+        while not self._stopped.is_set():
+            keyframe = index % self._intra_period == 0
+
+            with self._lock:
+
+                #: Splits only happen at keyframes, like on the real encoder
+                if keyframe and self._split_output:
+                    self._close(self._output)
+                    self._output, self._split_output = self._split_output, None
+                    self._split_done.set()
+
+                self._output[0].write(encode_frame(keyframe, time.monotonic(), self.frame_size))
+
+            if self._motion_output:
+                self._motion_output[0].write(bytes(self.vectors(index)) if self.vectors else still)
+
+            index += 1
+            deadline += interval
+            self._stopped.wait(max(0, deadline - time.monotonic()))
+
+
+class FakeCircularIO(io.RawIOBase):
+    ''' PiCameraCircularIO replacement for FakePiCamera
+
+        #: Keeps whole frames up to size bytes, the oldest frames are dropped first
+    '''
+
+    def __init__(self, camera: FakePiCamera, size: int):
+        self.camera = camera
+        self.size = size
+        self._frames = deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        b = bytes(b)
+        with self._lock:
+            self._frames.append(b)
+            self._bytes += len(b)
+            while self._bytes > self.size:
+                self._bytes -= len(self._frames.popleft())
+        return len(b)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
+
+    def copy_to(self, output, size: int = None, seconds: float = None, first_frame=SPS_HEADER) -> None:
+        ''' Copies the buffered frames of the last seconds, starting at a keyframe
+        '''
+
+        with self._lock:
+            frames = list(self._frames)
+
+        if seconds is not None and frames:
+            newest = FRAME_HEADER.unpack_from(frames[-1])[2]
+            frames = [f for f in frames if newest - FRAME_HEADER.unpack_from(f)[2] <= seconds]
+
+        #: Skip to the first keyframe, a clip can not start with a partial group of pictures
+        while frames and FRAME_HEADER.unpack_from(frames[0])[1] != first_frame:
+            frames.pop(0)
+
+        stream, owned = (open(output, 'wb'), True) if isinstance(output, str) else (output, False)
+        try:
+            for frame in frames:
+                stream.write(frame)
+        finally:
+            if owned:
+                stream.close()
+
+
+class SimulatedConverter(Converter):
+    ''' Converter for fake frames, concatenates the recording files instead of running MP4Box
+
+        #: mux_rate (bytes per second) simulates the muxing time of the Pi
+        #: Remembers the capture time of the first frame of every converted clip
+    '''
+
+    def __init__(self, frame_size: int, mux_rate: float = 20 * 2**20, workers: int = 1):
+        super().__init__(workers, 'mp4box')
+        self.frame_size = frame_size
+        self.mux_rate = mux_rate
+        self.first_frames: Dict[str, float] = {}
+        self.jobs: Dict[str, ConversionJob] = {}
+
+    def _run(self, job: ConversionJob) -> str:
+        self.jobs[job.target] = job
+        return super()._run(job)
+
+    def _mux_mp4box(self, job: ConversionJob) -> None:
+        data = b''
+        for part in job.source:
+            with open(part, 'rb') as f:
+                data += f.read()
+            os.remove(part)
+
+        time.sleep(len(data) / self.mux_rate)
+
+        with open(job.target, 'wb') as f:
+            f.write(data)
+
+        frames = frame_timestamps(data, self.frame_size)
+        if frames:
+            self.first_frames[job.target] = frames[0][1]
+
+    def _transcode(self, job: ConversionJob) -> None:
+        ''' Copies the clip, re-encoding is simulated at a tenth of the mux rate
+        '''
+
+        with open(job.source, 'rb') as f:
+            data = f.read()
+
+        time.sleep(len(data) / self.mux_rate * 10)
+
+        with open(job.target, 'wb') as f:
+            f.write(data)
+
+
+if __name__ == '__main__':
+
+    import tempfile
+
+    import config as cfg
+    from camera import Camera
+
+    def first_frame_latency(continuous: bool) -> float:
+        ''' Seconds from motion trigger to the first frame in the clip, negative with pre-roll
+        '''
+
+        cfg.CAMERA_CONTINUOUS_CAPTURE = continuous
+        fake = FakePiCamera(startup_delay=1.0)
+        camera = Camera(fake, FakeCircularIO)
+        camera.video_dir = tempfile.mkdtemp()
+
+        #: Let the ring buffer fill up before the trigger
+        time.sleep(cfg.CAMERA_PRE_ROLL_SECONDS + 1 if continuous else 0)
+
+        triggered = time.monotonic()
+        camera.start_recording()
+        time.sleep(2)
+
+        data = b''
+        for path in camera.outputs:
+            with open(path, 'rb') as f:
+                data += f.read()
+
+        fake.close()
+        return frame_timestamps(data, fake.frame_size)[0][1] - triggered
+
+    print('trigger -> first frame (on demand): {:+.3f} s'.format(first_frame_latency(False)))
+    print('trigger -> first frame (pre-roll):  {:+.3f} s'.format(first_frame_latency(True)))
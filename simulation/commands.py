@@ -0,0 +1,110 @@
+''' Command latency and throughput, long polling compared to the webhook
+
+    #: Starts SurveillanceBot against the FakeBotAPIServer once per mode and measures
+    #:   round trip    time from queuing a command until its answer reached the api
+    #:   throughput    answered commands per second, with many commands from different chats at once
+    #:
+    #: python3 -m simulation.commands --commands 50 --concurrent 200 --latency 0.05
+'''
+
+import time
+import logging
+import argparse
+from contextlib import contextmanager
+
+import config as cfg
+from simulation.benchmark import OWNER_CHAT_ID, SIMULATION_CONFIG, percentiles
+
+#: /activate without a token is answered right away and changes nothing
+COMMAND = '/activate'
+
+
+@contextmanager
+def running_bot(mode: str, latency: float):
+    ''' SurveillanceBot and FakeBotAPIServer in the given mode ('polling' or 'webhook')
+    '''
+
+    from bot import SurveillanceBot
+    from simulation.server import FakeBotAPIServer
+
+    server = FakeBotAPIServer(latency).start()
+    cfg.TELEGRAM_API_URL = server.url
+    cfg.TELEGRAM_WEBHOOK_URL = 'http://127.0.0.1:{}/telegram'.format(cfg.TELEGRAM_WEBHOOK_PORT) if mode == 'webhook' else None
+
+    bot = SurveillanceBot(lambda pause_surveillance: False)
+    try:
+        if mode == 'webhook' and not bot.webhook:
+            raise RuntimeError('Webhook could not be registered')
+        yield server
+
+    finally:
+        bot.stop()
+        server.stop()
+
+
+def answered(server, answers: int, timeout: float = 60) -> None:
+    ''' Waits until there are more than answers sent messages
+    '''
+
+    if not server.wait_for(lambda calls: sum(call.method == 'sendMessage' for call in calls) >= answers, timeout):
+        raise RuntimeError('Commands were not answered within {} s'.format(timeout))
+
+
+def round_trips(mode: str, commands: int, latency: float, pause: float) -> list:
+    ''' Round-trip times of single commands
+    '''
+
+    results = []
+    with running_bot(mode, latency) as server:
+        for _ in range(commands):
+            answers = len(server.calls_to('sendMessage'))
+
+            #: Idle time between commands, polling answers come from a waiting long poll
+            time.sleep(pause)
+
+            pushed = time.monotonic()
+            server.push_command(OWNER_CHAT_ID, COMMAND)
+            answered(server, answers + 1)
+
+            results.append(server.calls_to('sendMessage')[answers].received - pushed)
+
+    return results
+
+
+def throughput(mode: str, commands: int, latency: float) -> float:
+    ''' Commands per second, all commands are queued at once from different chats
+    '''
+
+    with running_bot(mode, latency) as server:
+        pushed = time.monotonic()
+        for chat_id in range(OWNER_CHAT_ID, OWNER_CHAT_ID + commands):
+            server.push_command(chat_id, COMMAND)
+
+        answered(server, commands)
+        return commands / (server.calls_to('sendMessage')[-1].received - pushed)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Command latency and throughput, long polling compared to the webhook')
+    parser.add_argument('--commands', type=int, default=50, help='number of single commands per mode')
+    parser.add_argument('--concurrent', type=int, default=200, help='number of commands queued at once for the throughput')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of the fake api in seconds')
+    parser.add_argument('--pause', type=float, default=0.1, help='seconds between single commands')
+    parser.add_argument('--port', type=int, default=8443, help='port of the local webhook')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    for key, value in SIMULATION_CONFIG.items():
+        setattr(cfg, key, value)
+    cfg.TELEGRAM_WEBHOOK_PORT = args.port
+
+    print('{:10} {:>9} {:>9} {:>9} {:>9} {:>4} {:>12}'.format('[ms]', 'p50', 'p90', 'p99', 'max', 'n', 'commands/s'))
+    for mode in ('polling', 'webhook'):
+        values = percentiles(round_trips(mode, args.commands, args.latency, args.pause))
+        rate = throughput(mode, args.concurrent, args.latency)
+        print('{:10} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:4} {:12.1f}'.format(mode, *(values[p] * 1000 for p in ('p50', 'p90', 'p99', 'max')), values['n'], rate))
+
+
+if __name__ == '__main__':
+    main()
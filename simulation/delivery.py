@@ -0,0 +1,161 @@
+''' Spooled delivery under injected failures
+
+    #: Runs SurveillanceBot against the FakeBotAPIServer while sends fail and checks that
+    #: every recipient received every alert and video exactly once, in the order they were spooled:
+    #:   flaky     a share of all sends fails at random
+    #:   outage    every send fails for a while
+    #:   restart   the bot is stopped during an outage, a new bot sends what is left in the spool
+    #:
+    #: python3 -m simulation.delivery --recipients 3 --items 10 --fail-rate 0.3 --outage 3
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+from typing import List, Tuple
+
+import config as cfg
+from simulation.benchmark import OWNER_CHAT_ID, SIMULATION_CONFIG
+
+#: Short retries and no per-chat limit worth mentioning, so a scenario takes seconds
+DELIVERY_CONFIG = {
+    'SPOOL_RETRY_BASE': 0.1,
+    'SPOOL_RETRY_MAX': 1.0,
+    'SPOOL_MAX_ATTEMPTS': 1000,
+    'BROADCAST_PER_CHAT_RATE': 50,
+    'BROADCAST_GLOBAL_RATE': 200,
+}
+
+
+def start_bot(recipients: List[int]):
+    ''' SurveillanceBot with the given chat_ids registered as admins
+    '''
+
+    from bot import SurveillanceBot
+    from role import Role
+
+    bot = SurveillanceBot(lambda pause_surveillance: False)
+    for chat_id in recipients:
+        bot.userservice.activate_token(bot.userservice.generate_token(Role.ADMIN).value, chat_id, 'admin{}'.format(chat_id))
+
+    return bot
+
+
+def spool_items(bot, items: int, video_dir: str) -> Tuple[List[str], List[str]]:
+    ''' Spools alternating alerts and videos
+
+        #: return -> alert texts and video captions in spooling order
+    '''
+
+    from clip import Clip
+
+    alerts, videos = [], []
+    for n in range(items):
+        alerts.append('Motion detected {}'.format(n))
+        bot.alert(alerts[-1])
+
+        path = os.path.join(video_dir, 'clip-{}.mp4'.format(n))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+
+        clip = Clip(path, 'clip-{}'.format(n))
+        videos.append(clip.caption)
+        bot.send_surveillance_video(clip)
+
+    return alerts, videos
+
+
+def received(calls, chat_id: int) -> Tuple[List[str], List[str]]:
+    ''' Alert texts and video captions successfully sent to chat_id, in order of arrival
+    '''
+
+    alerts = [call.params.get('text') for call in calls if call.method == 'sendMessage' and not call.failed and int(call.params['chat_id']) == chat_id]
+    videos = [call.params.get('caption') for call in calls if call.method == 'sendVideo' and not call.failed and int(call.params['chat_id']) == chat_id]
+    return alerts, videos
+
+
+def run(scenario: str, recipients: int, items: int, fail_rate: float, outage: float, latency: float, timeout: float = 120) -> dict:
+    ''' Runs one scenario
+
+        #: return -> result with whether every recipient got everything in order,
+        #:           and the seconds until then, counted from the end of the outage or from spooling
+    '''
+
+    from simulation.server import FakeBotAPIServer
+
+    server = FakeBotAPIServer(latency).start()
+    cfg.TELEGRAM_API_URL = server.url
+    cfg.SPOOL_PATH = os.path.join(tempfile.mkdtemp(), 'spool.db')
+
+    chat_ids = list(range(OWNER_CHAT_ID, OWNER_CHAT_ID + recipients))
+    video_dir = tempfile.mkdtemp()
+
+    if scenario == 'flaky':
+        server.fail_rate = fail_rate
+    else:
+        server.outage(outage)
+
+    bot = start_bot(chat_ids)
+    expected = spool_items(bot, items, video_dir)
+    spooled = time.monotonic()
+
+    #: Stop while every send fails, the new bot only knows the spool
+    if scenario == 'restart':
+        bot.stop()
+        bot = start_bot([])
+
+    def complete(calls) -> bool:
+        return all(tuple(map(sorted, received(calls, chat_id))) == tuple(map(sorted, expected)) for chat_id in chat_ids)
+
+    try:
+        done = server.wait_for(complete, timeout)
+        finished = time.monotonic()
+    finally:
+        bot.stop()
+        server.stop()
+
+    in_order = all(received(server.calls, chat_id) == expected for chat_id in chat_ids)
+
+    return {
+        'scenario': scenario,
+        'delivered': sum(len(alerts) + len(videos) for alerts, videos in (received(server.calls, chat_id) for chat_id in chat_ids)),
+        'expected': 2 * items * recipients,
+        'complete': done,
+        'in order': in_order,
+        'failed sends': sum(call.failed for call in server.calls),
+        'seconds': finished - max(spooled, server.outage_until),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Spooled delivery under injected failures')
+    parser.add_argument('--recipients', type=int, default=3, help='number of admins')
+    parser.add_argument('--items', type=int, default=10, help='number of alerts and of videos')
+    parser.add_argument('--fail-rate', type=float, default=0.3, help='share of failing sends in the flaky scenario')
+    parser.add_argument('--outage', type=float, default=3.0, help='seconds every send fails in the outage and restart scenario')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency of the fake api in seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    for key, value in dict(SIMULATION_CONFIG, **DELIVERY_CONFIG).items():
+        setattr(cfg, key, value)
+
+    print('{:10} {:>10} {:>9} {:>13} {:>9}'.format('scenario', 'delivered', 'in order', 'failed sends', 'seconds'))
+
+    passed = True
+    for scenario in ('flaky', 'outage', 'restart'):
+        result = run(scenario, args.recipients, args.items, args.fail_rate, args.outage, args.latency)
+        passed = passed and result['complete'] and result['in order']
+
+        print('{:10} {:>10} {:>9} {:13} {:9.2f}'.format(scenario, '{}/{}'.format(result['delivered'], result['expected']),
+                                                       'yes' if result['in order'] else 'no', result['failed sends'], result['seconds']))
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import time
+from typing import Callable, Dict, Iterable, Tuple
+
+from rcwl_0516 import GPIOBackend
+
+
+class SimulatedGPIO(GPIOBackend):
+    ''' Deterministic GPIO backend
+
+        #: Edges are injected with edge() or replayed from a trace,
+        #: the timestamp of an edge can be given explicitly
+    '''
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.levels: Dict[int, int] = {}
+        self.callbacks: Dict[int, Callable[[int, float], None]] = {}
+
+    def setup(self, pin: int) -> None:
+        self.levels[pin] = 0
+
+    def add_edge_callback(self, pin: int, callback: Callable[[int, float], None]) -> None:
+        self.callbacks[pin] = callback
+
+    def read(self, pin: int) -> int:
+        return self.levels[pin]
+
+    def edge(self, pin: int, level: int, timestamp: float = None) -> None:
+        ''' Sets the level of pin and calls its edge callback
+        '''
+
+        self.levels[pin] = level
+
+        if pin in self.callbacks:
+            self.callbacks[pin](level, self.clock() if timestamp is None else timestamp)
+
+    def replay(self, pin: int, trace: Iterable[Tuple[float, int]]) -> None:
+        ''' Replays (offset in seconds, level) pairs in real time, blocks until the trace is done
+        '''
+
+        started = self.clock()
+        for offset, level in trace:
+            delay = started + offset - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+            self.edge(pin, level)
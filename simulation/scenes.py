@@ -0,0 +1,120 @@
+''' Luma frame fixtures for the motion verification
+
+    #: A fixture is a sequence of low resolution luma frames, the index of the radar trigger
+    #: and whether or not a person moved after it. Fixtures are stored as .npz files
+    #: (frames: uint8 array of shape (n, height, width), trigger: int, motion: bool),
+    #: frames recorded on the Pi can be saved in the same format
+    #: The frames before the trigger warm up the background model, on the Pi the verifier runs from startup
+    #:
+    #: The synthetic scenes cover the false triggers of the radar:
+    #:   empty     nothing but sensor noise, the radar triggered through a wall
+    #:   curtain   a curtain sways the whole time
+    #:   lights    the light is switched on at the trigger
+    #:   person    a person walks through the picture
+'''
+
+from typing import Callable, Dict, NamedTuple, Tuple
+
+import numpy as np
+
+
+class Fixture(NamedTuple):
+
+    name: str
+    frames: np.ndarray
+    trigger: int
+    motion: bool
+
+    def frame(self, index: int) -> np.ndarray:
+        ''' Frame at index, the last frame is held
+        '''
+
+        return self.frames[min(index, len(self.frames) - 1)]
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, frames=self.frames, trigger=self.trigger, motion=self.motion)
+
+
+def load(path: str, name: str = None) -> Fixture:
+    with np.load(path) as data:
+        return Fixture(name or path, data['frames'], int(data['trigger']), bool(data['motion']))
+
+
+def _background(resolution: Tuple[int, int], rng: np.random.Generator) -> np.ndarray:
+    ''' Smooth random texture between 30 and 170
+    '''
+
+    width, height = resolution
+    coarse = rng.uniform(30, 170, (height // 8 + 2, width // 8 + 2))
+    texture = np.repeat(np.repeat(coarse, 8, axis=0), 8, axis=1)
+
+    #: Box blur, so edges are soft like in a real picture
+    for axis in (0, 1):
+        texture = sum(np.roll(texture, shift, axis=axis) for shift in range(-3, 4)) / 7
+
+    return texture[:height, :width]
+
+
+def scene(name: str, resolution: Tuple[int, int] = (160, 96), framerate: int = 10, warm_up: float = 10.0, seconds: float = 5.0, seed: int = 0) -> Fixture:
+    ''' Synthetic fixture, warm_up seconds before the trigger and seconds after it
+    '''
+
+    if name not in SCENES:
+        raise ValueError('Unknown scene {}, choose one of {}'.format(name, ', '.join(SCENES)))
+
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    background = _background(resolution, rng)
+    trigger = int(warm_up * framerate)
+    count = trigger + int(seconds * framerate)
+
+    frames = np.empty((count, height, width), np.float32)
+    for index in range(count):
+        frames[index] = SCENES[name](background, index - trigger, framerate)
+
+    frames += rng.normal(0, 3, frames.shape)
+    return Fixture(name, np.clip(frames, 0, 255).astype(np.uint8), trigger, name == 'person')
+
+
+def _empty(background: np.ndarray, index: int, framerate: int) -> np.ndarray:
+    return background
+
+
+def _curtain(background: np.ndarray, index: int, framerate: int) -> np.ndarray:
+    ''' Folds of a curtain on the left fifth of the picture, swaying by up to 3 pixels
+    '''
+
+    frame = background.copy()
+    width = background.shape[1] // 5
+    columns = np.arange(width) + 3 * np.sin(2 * np.pi * 0.5 * index / framerate)
+    frame[:, :width] = 100 + 40 * np.sin(2 * np.pi * columns / 12)
+    return frame
+
+
+def _lights(background: np.ndarray, index: int, framerate: int) -> np.ndarray:
+    ''' The picture gets 40 % brighter within three frames
+    '''
+
+    return background * (1 + 0.4 * min(max(index, 0), 3) / 3)
+
+
+def _person(background: np.ndarray, index: int, framerate: int) -> np.ndarray:
+    ''' A dark figure of an eighth of the width and half the height, crossing the picture in 3 seconds
+    '''
+
+    frame = background.copy()
+    height, width = background.shape
+    if index < 0:
+        return frame
+
+    left = int(-width / 8 + index * width / (3 * framerate))
+    frame[height // 3:height // 3 + height // 2, max(0, left):max(0, left + width // 8)] = 20
+    return frame
+
+
+SCENES: Dict[str, Callable[[np.ndarray, int, int], np.ndarray]] = {
+    'empty': _empty,
+    'curtain': _curtain,
+    'lights': _lights,
+    'person': _person,
+}
@@ -0,0 +1,150 @@
+''' Schedule on a virtual clock across daylight saving time changes
+
+    #: Runs the schedule thread's steps on a virtual clock over the days around both changes of a year
+    #: in several time zones and checks the applied states:
+    #:   - every minute, against the state by the wall clock of the zone, except from 01:00 to 04:00 on the day of the change
+    #:   - the night of the change: a disarm window from 02:30 to 06:00 starts at 03:30 if 02:30 falls into the gap
+    #:     of spring forward, and at the first 02:30 if it is repeated at fall back
+    #: Also reports how often the thread woke up, once per transition and max_sleep
+    #:
+    #: python3 -m simulation.schedule --year 2022
+'''
+
+import sys
+import logging
+import argparse
+from datetime import date, datetime, time, timedelta, timezone
+from typing import List, Tuple
+from zoneinfo import ZoneInfo
+
+from schedule import Schedule, Window, Once
+
+ZONES = ('Europe/Berlin', 'America/New_York', 'Australia/Sydney')
+
+
+def changes(zone: ZoneInfo, year: int) -> List[date]:
+    ''' Days on which the utc offset of the zone changes
+    '''
+
+    days = []
+    day = date(year, 1, 1)
+    while day.year == year:
+        offsets = {datetime.combine(day, time(hour), tzinfo=zone).utcoffset() for hour in (0, 12)}
+        if len(offsets) > 1:
+            days.append(day)
+        day += timedelta(days=1)
+
+    return days
+
+
+def reference(schedule: Schedule, at: datetime) -> bool:
+    ''' State by the wall clock of the zone, evaluated independently of the schedule
+    '''
+
+    local = at.astimezone(schedule.zone)
+    wall, weekday = local.time(), local.weekday()
+
+    once = [rule for rule in schedule.rules if isinstance(rule, Once) and rule.start <= at < rule.end]
+    if once:
+        return once[-1].armed
+
+    covering = []
+    for rule in schedule.rules:
+        if not isinstance(rule, Window):
+            continue
+        if rule.start < rule.end:
+            inside = weekday in rule.days and rule.start <= wall < rule.end
+        else:
+            inside = (weekday in rule.days and wall >= rule.start) or ((weekday - 1) % 7 in rule.days and wall < rule.end)
+        if inside:
+            covering.append(rule)
+
+    if covering:
+        return any(rule.armed for rule in covering)
+    return not any(rule.armed for rule in schedule.rules if isinstance(rule, Window))
+
+
+def simulate(zone: ZoneInfo, change: date) -> Tuple[List[str], int]:
+    ''' Runs the schedule from two days before to two days after the change
+
+        #: return -> failed checks, wake-ups
+    '''
+
+    applied: List[Tuple[datetime, bool]] = []
+    schedule = Schedule(None, lambda armed: applied.append((now, armed)), zone=zone)
+    schedule.add_window(False, range(7), time(2, 30), time(6))
+    schedule.add_window(False, range(5), time(8), time(17))
+
+    #: Armed on the morning after the change, although it is a weekday
+    morning = datetime.combine(change + timedelta(days=1), time(10), tzinfo=zone)
+    schedule.add_once(True, morning, morning + timedelta(hours=1))
+    expected = list(schedule.rules)
+
+    start = datetime.combine(change - timedelta(days=2), time(0), tzinfo=zone).astimezone(timezone.utc)
+    end = start + timedelta(days=4)
+    now, wakeups = start, 0
+
+    while now < end:
+        wait = schedule._step(now)
+        now += timedelta(seconds=max(wait, 0.001))
+        wakeups += 1
+
+    failed = []
+
+    #: The exception expired and was dropped
+    schedule.rules = expected
+
+    minute, index = start, 0
+    while minute < end:
+        while index + 1 < len(applied) and applied[index + 1][0] <= minute:
+            index += 1
+        local = minute.astimezone(zone)
+        if not (local.date() == change and 1 <= local.hour < 4) and applied[index][1] != reference(schedule, minute):
+            failed.append('{} applied {}'.format(local.strftime('%a %H:%M%z'), 'armed' if applied[index][1] else 'disarmed'))
+        minute += timedelta(minutes=1)
+
+    #: Occurrences of the wall-clock times 02:30 and 06:00 on the day of the change
+    walls = {'02:30': [], '06:00': []}
+    minute = datetime.combine(change, time(0), tzinfo=zone).astimezone(timezone.utc)
+    while minute.astimezone(zone).date() == change:
+        wall = minute.astimezone(zone).strftime('%H:%M')
+        if wall in walls:
+            walls[wall].append(minute)
+        minute += timedelta(minutes=1)
+
+    #: 02:30 in the gap is shifted by the gap, a repeated 02:30 counts once
+    night = [(at, armed) for at, armed in applied if at.astimezone(zone).date() == change]
+    disarmed = next((at for at, armed in night if not armed), None)
+    armed = next((at for at, armed in night if armed and disarmed and at > disarmed), None)
+    start = walls['02:30'][0] if walls['02:30'] else datetime.combine(change, time(2, 30), tzinfo=zone).astimezone(timezone.utc)
+
+    if (disarmed, armed) != (start, walls['06:00'][0]):
+        failed.append('night of the change: disarmed at {} for {} h'.format(disarmed and disarmed.astimezone(zone).strftime('%H:%M%z'),
+                                                                          disarmed and armed and (armed - disarmed).total_seconds() / 3600))
+
+    return failed, wakeups
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Schedule on a virtual clock across daylight saving time changes')
+    parser.add_argument('--year', type=int, default=2022, help='year of the changes')
+    parser.add_argument('--zones', nargs='*', default=ZONES, help='IANA time zones')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    failures = 0
+
+    print('{:20} {:12} {:>8} {:>8}  {}'.format('zone', 'change', 'wake-ups', 'failed', 'result'))
+    for name in args.zones:
+        zone = ZoneInfo(name)
+        for change in changes(zone, args.year):
+            failed, wakeups = simulate(zone, change)
+            failures += len(failed)
+            print('{:20} {:12} {:8} {:8}  {}'.format(name, change.isoformat(), wakeups, len(failed), '; '.join(failed[:3]) or 'ok'))
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+import json
+import time
+import queue
+import random
+import itertools
+import threading
+import urllib.request
+from urllib.parse import parse_qsl
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, NamedTuple
+
+
+class Call(NamedTuple):
+    ''' Request received by the fake Bot API
+    '''
+
+    method: str
+    params: dict
+    received: float
+    uploaded_bytes: int
+
+    #: answered with an injected error
+    failed: bool = False
+
+
+class APIError(Exception):
+    ''' Error answer of the fake Bot API
+    '''
+
+    def __init__(self, error_code: int, description: str):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+
+
+class FakeBotAPIServer():
+    ''' Local HTTP server speaking enough of the Telegram Bot API for SurveillanceBot
+
+        #: Serves http://127.0.0.1:<port>/bot<token>/<method>, point TELEGRAM_API_URL to url
+        #: Updates queued with push_update are delivered by long polling getUpdates,
+        #: or, once a webhook was set, POSTed to the webhook over up to webhook_connections connections
+        #: Every call is recorded with its monotonic arrival time, latency is added to every answer
+        #: reject_webhook makes setWebhook fail, e.g. to test the fallback to polling
+        #: Sends fail with 502 Bad Gateway during an outage(), for chats in fail_chats and at fail_rate
+    '''
+
+    #: Methods affected by injected failures, receiving updates keeps working
+    FAILING_METHODS = ('sendMessage', 'sendVideo', 'sendPhoto')
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Simulation', 'username': 'simulation_bot'}
+
+    def __init__(self, latency: float = 0.0, port: int = 0, clock: Callable[[], float] = time.monotonic, webhook_connections: int = 40):
+        self.latency = latency
+        self.webhook_connections = webhook_connections
+        self.clock = clock
+
+        self.calls: List[Call] = []
+        self.messages: List[dict] = []
+        self.uploaded_bytes = 0
+        self._updates: List[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._changed = threading.Condition()
+
+        #: (url, secret token) of the registered webhook
+        self.webhook = None
+        self.reject_webhook = False
+        self._deliveries = queue.Queue()
+
+        #: Failure injection
+        self.outage_until = 0.0
+        self.fail_chats = set()
+        self.fail_rate = 0.0
+        self._random = random.Random(0)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/bot'.format(self.httpd.server_address[1])
+
+    def start(self) -> 'FakeBotAPIServer':
+        threading.Thread(target=self.httpd.serve_forever, name='fake-bot-api', daemon=True).start()
+        for _ in range(self.webhook_connections):
+            threading.Thread(target=self._deliver_webhook_updates, name='fake-bot-api-webhook', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        with self._changed:
+            self._changed.notify_all()
+        for _ in range(self.webhook_connections):
+            self._deliveries.put(None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_update(self, update: dict) -> dict:
+        ''' Queues an update for getUpdates, the update_id is assigned here
+        '''
+
+        with self._changed:
+            update['update_id'] = next(self._update_ids)
+
+            if self.webhook:
+                self._deliveries.put((update, self.webhook))
+            else:
+                self._updates.append(update)
+                self._changed.notify_all()
+
+        return update
+
+    def _deliver_webhook_updates(self) -> None:
+        ''' Webhook connection: POSTs queued updates one after another
+        '''
+
+        for delivery in iter(self._deliveries.get, None):
+            update, (url, secret_token) = delivery
+            time.sleep(self.latency)
+            request = urllib.request.Request(url, json.dumps(update).encode(), {'Content-Type': 'application/json'})
+            if secret_token:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', secret_token)
+
+            #: Telegram retries updates the webhook did not accept
+            try:
+                urllib.request.urlopen(request, timeout=10).close()
+            except OSError:
+                time.sleep(0.1)
+                self._deliveries.put(delivery)
+
+    def push_command(self, chat_id: int, text: str, username: str = 'simulation') -> dict:
+        ''' Queues a private message with a bot command, e.g. '/activate TOKEN'
+        '''
+
+        command = text.split(' ', 1)[0]
+        return self.push_update({'message': {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }})
+
+    def push_callback_query(self, chat_id: int, message_id: int, data: str, username: str = 'simulation') -> dict:
+        ''' Queues a press on an inline keyboard button of the message with message_id
+        '''
+
+        user = {'id': chat_id, 'is_bot': False, 'first_name': username, 'username': username}
+        return self.push_update({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': user,
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'from': self.BOT_USER, 'text': ''},
+        }})
+
+    def calls_to(self, method: str, failed: bool = False) -> List[Call]:
+        ''' Calls of a method, only the successful ones unless failed is set
+        '''
+
+        with self._changed:
+            return [call for call in self.calls if call.method == method and (failed or not call.failed)]
+
+    def outage(self, seconds: float) -> None:
+        ''' Lets every send fail for the given seconds
+        '''
+
+        self.outage_until = self.clock() + seconds
+
+    def _fails(self, method: str, params: dict) -> bool:
+        ''' Whether or not the call gets an injected error
+        '''
+
+        if method not in self.FAILING_METHODS:
+            return False
+
+        chat_id = params.get('chat_id')
+        return self.clock() < self.outage_until or (chat_id is not None and int(chat_id) in self.fail_chats) or self._random.random() < self.fail_rate
+
+    def wait_for(self, predicate: Callable[[List[Call]], bool], timeout: float = 10) -> bool:
+        ''' Blocks until predicate is true for the recorded calls
+        '''
+
+        deadline = self.clock() + timeout
+        with self._changed:
+            while not predicate(self.calls):
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
+
+    def _record(self, method: str, params: dict, uploaded_bytes: int, failed: bool = False) -> None:
+        with self._changed:
+            self.calls.append(Call(method, params, self.clock(), uploaded_bytes, failed))
+            self.uploaded_bytes += uploaded_bytes
+            self._changed.notify_all()
+
+    def _get_updates(self, params: dict) -> List[dict]:
+        ''' Long polling: answers as soon as there are updates newer than offset, or after timeout
+        '''
+
+        offset = int(params.get('offset') or 0)
+        deadline = self.clock() + min(float(params.get('timeout') or 0), 1.0)
+
+        with self._changed:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and self.clock() < deadline:
+                self._changed.wait(deadline - self.clock())
+            return list(self._updates)
+
+    def _message(self, params: dict, **content) -> dict:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': {'id': int(params['chat_id']), 'type': 'private'}}
+        message.update({key: value for key, value in content.items() if value is not None})
+        self.messages.append(message)
+        return message
+
+    def _file(self, params: dict, key: str) -> dict:
+        value = params.get(key)
+        file_id = value if isinstance(value, str) else 'file-{}'.format(next(self._file_ids))
+        return {'file_id': file_id, 'file_unique_id': file_id}
+
+    def _answer(self, method: str, params: dict):
+        ''' Result of a Bot API method
+        '''
+
+        if method == 'getMe':
+            return self.BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'sendMessage':
+            return self._message(params, text=params.get('text'))
+        if method == 'sendVideo':
+            return self._message(params, caption=params.get('caption'), video=dict(self._file(params, 'video'), width=1280, height=720, duration=0))
+        if method == 'sendPhoto':
+            return self._message(params, caption=params.get('caption'), photo=[dict(self._file(params, 'photo'), width=1280, height=720)])
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            return self._message(params, text=params.get('text'))
+        if method == 'setWebhook':
+            if self.reject_webhook:
+                raise APIError(400, 'Bad Request: bad webhook: simulated failure')
+            with self._changed:
+                self.webhook = (params['url'], params.get('secret_token')) if params.get('url') else None
+            return True
+        if method == 'deleteWebhook':
+            with self._changed:
+                self.webhook = None
+            return True
+
+        #: answerCallbackQuery, ...
+        return True
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                params, uploaded_bytes = self._parse(body)
+
+                failed = server._fails(method, params)
+
+                if method != 'getUpdates':
+                    server._record(method, params, uploaded_bytes, failed)
+                    time.sleep(server.latency)
+
+                try:
+                    if failed:
+                        raise APIError(502, 'Bad Gateway')
+
+                    answer = server._answer(method, params)
+
+                    #: Updates returned by a long poll travel back over the network as well
+                    if method == 'getUpdates' and answer:
+                        time.sleep(server.latency)
+
+                    self._reply({'ok': True, 'result': answer})
+                except APIError as e:
+                    self._reply({'ok': False, 'error_code': e.error_code, 'description': e.description}, e.error_code)
+
+            do_GET = do_POST
+
+            def _parse(self, body: bytes):
+                ''' Parses json, form and multipart bodies, file contents are only counted
+                '''
+
+                content_type = self.headers.get('Content-Type') or ''
+
+                if content_type.startswith('multipart/form-data'):
+                    message = BytesParser(policy=policy.HTTP).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+                    params, uploaded_bytes = {}, 0
+                    for part in message.iter_parts():
+                        name = part.get_param('name', header='content-disposition')
+                        payload = part.get_payload(decode=True)
+                        if part.get_filename():
+                            params[name] = None
+                            uploaded_bytes += len(payload)
+                        else:
+                            params[name] = payload.decode()
+                    return params, uploaded_bytes
+
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    return dict(parse_qsl(body.decode())), 0
+
+                return (json.loads(body) if body else {}), 0
+
+            def _reply(self, answer: dict, status: int = 200):
+                data = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+
+                #: Clients may close a pending long poll on shutdown
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
@@ -0,0 +1,213 @@
+''' Startup time on simulated hardware
+
+    #: Measures
+    #:   import           time to import controller in a fresh interpreter, camera and bot are imported by their stages
+    #:   stages           when camera, sensor and bot were ready, and when motion was armed, compared to
+    #:                    the sum of the stages, which a sequential startup would take
+    #:   late network     telegram is reachable only some seconds after the start, with SURVEILLANCE_ACTIVE_ON_START
+    #:                    motion is recorded right away and its alert is delivered once the bot connected
+    #:
+    #: camera_delay simulates the time PiCamera needs to open the camera
+    #:
+    #: python3 -m simulation.startup --camera-delay 1.5 --network-delay 5
+'''
+
+import sys
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import Dict
+
+import config as cfg
+from simulation.benchmark import OWNER_CHAT_ID, SIMULATION_CONFIG, TRACES
+
+IMPORTS = {
+    'controller': 'import controller',
+    'controller, camera and bot': 'import controller, camera, bot',
+}
+
+
+def import_time(statement: str) -> float:
+    ''' Seconds a fresh interpreter needs for statement
+    '''
+
+    code = 'import time; started = time.perf_counter(); {}; print(time.perf_counter() - started)'.format(statement)
+    return float(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Harness():
+    ''' Controller starting on simulated hardware, optionally before the fake Bot API is reachable
+    '''
+
+    def __init__(self, camera_delay: float, latency: float):
+
+        from simulation.camera import FakePiCamera
+        from simulation.gpio import SimulatedGPIO
+
+        self.camera_delay = camera_delay
+        self.latency = latency
+        self.fake = FakePiCamera()
+        self.gpio = SimulatedGPIO()
+        self.server = None
+        self.controller = None
+
+    def camera(self):
+        ''' Camera stage, PiCamera takes a while to open the camera
+        '''
+
+        from camera import Camera
+        from simulation.camera import FakeCircularIO, SimulatedConverter
+
+        time.sleep(self.camera_delay)
+        camera = Camera(self.fake, FakeCircularIO, SimulatedConverter(self.fake.frame_size))
+        camera.video_dir = tempfile.mkdtemp()
+        return camera
+
+    def start(self, network_delay: float = 0) -> float:
+        ''' Starts the controller in a thread, the fake api comes up after network_delay
+
+            #: return -> monotonic time of the start
+        '''
+
+        from controller import Controller
+        from simulation.server import FakeBotAPIServer
+
+        port = free_port()
+        cfg.TELEGRAM_API_URL = 'http://127.0.0.1:{}/bot'.format(port)
+
+        def network():
+            time.sleep(network_delay)
+            self.server = FakeBotAPIServer(self.latency, port).start()
+
+        if not network_delay:
+            network()
+
+        def controller():
+            self.controller = Controller(self.camera, self.gpio)
+
+        started = time.monotonic()
+        if network_delay:
+            threading.Thread(target=network, daemon=True).start()
+        self.thread = threading.Thread(target=controller, daemon=True)
+        self.thread.start()
+        return started
+
+    def armed(self, timeout: float = 30) -> float:
+        ''' Waits until the sensor dispatches edges
+
+            #: return -> monotonic time it was armed
+        '''
+
+        deadline = time.monotonic() + timeout
+        while cfg.SENSOR_PIN not in self.gpio.callbacks:
+            if time.monotonic() > deadline:
+                raise RuntimeError('Motion detection not armed within {} s'.format(timeout))
+            time.sleep(0.005)
+        return time.monotonic()
+
+    def stop(self) -> None:
+        self.thread.join()
+        self.controller.rcwl.stop()
+        self.controller.bot.stop()
+        self.fake.close()
+        self.server.stop()
+
+
+def register_owner(path: str) -> None:
+    ''' Database with the owner registered, so alerts have a recipient from the start
+    '''
+
+    from role import Role
+    from storage import Storage
+    from user import User
+
+    storage = Storage(path)
+    storage.save_user(User(OWNER_CHAT_ID, 'owner', Role.OWNER))
+    storage.set_owner(OWNER_CHAT_ID)
+    storage.close()
+
+
+def stages(args) -> Dict[str, float]:
+    ''' Startup with telegram reachable right away
+    '''
+
+    startup = Harness(args.camera_delay, args.latency)
+    startup.start()
+    startup.thread.join()
+    timings = startup.controller.startup.timings
+    startup.stop()
+
+    #: The bot stage also waits for the camera, on its own it took until it connected
+    sequential = timings['camera'] + timings['sensor'] + timings['connected']
+    return dict(timings, sequential=sequential)
+
+
+def late_network(args) -> Dict[str, float]:
+    ''' Startup with telegram reachable only after network_delay, motion right after it was armed
+    '''
+
+    cfg.SURVEILLANCE_ACTIVE_ON_START = True
+    startup = Harness(args.camera_delay, args.latency)
+    started = startup.start(args.network_delay)
+    armed = startup.armed()
+
+    startup.gpio.replay(cfg.SENSOR_PIN, TRACES['short'])
+    startup.thread.join()
+    recording = startup.controller.startup.timings
+
+    deadline = time.monotonic() + 30
+    alerts = []
+    while not alerts and time.monotonic() < deadline:
+        alerts = [c for c in startup.server.calls if c.method in ('sendMessage', 'sendPhoto') and
+                  (c.params.get('text') or c.params.get('caption') or '').startswith('Motion detected')]
+        time.sleep(0.02)
+    startup.stop()
+
+    if not alerts:
+        raise RuntimeError('Alert of the motion before the network came up was not delivered')
+
+    return {'armed, motion': armed - started, 'connected': recording['connected'], 'alert delivered': alerts[0].received - started}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Startup time on simulated hardware')
+    parser.add_argument('--camera-delay', type=float, default=1.5, help='seconds PiCamera takes to open the camera')
+    parser.add_argument('--network-delay', type=float, default=5.0, help='seconds until telegram is reachable in the late network run')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of the fake api in seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    for key, value in SIMULATION_CONFIG.items():
+        setattr(cfg, key, value)
+    cfg.BOT_CONNECT_BACKOFF_MAX = 1
+
+    #: Set before storage is imported, it is the default of Storage
+    cfg.DATABASE_PATH = '{}/{}'.format(tempfile.mkdtemp(), 'users.db')
+    register_owner(cfg.DATABASE_PATH)
+
+    print('{:36} {:>9}'.format('import [ms]', ''))
+    for name, statement in IMPORTS.items():
+        print('{:36} {:9.1f}'.format(name, import_time(statement) * 1000))
+
+    print('\n{:36} {:>9}'.format('stages [s]', ''))
+    for stage, elapsed in sorted(stages(args).items(), key=lambda item: item[1]):
+        print('{:36} {:9.2f}'.format(stage, elapsed))
+
+    print('\n{:36} {:>9}'.format('late network [s], up after {:.1f} s'.format(args.network_delay), ''))
+    for event, elapsed in late_network(args).items():
+        print('{:36} {:9.2f}'.format(event, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+''' Motion vector analysis throughput on vector dumps
+
+    #: A dump is what PiCamera writes to a motion_output file, the vectors of every frame back to back
+    #: (start_recording('video.h264', motion_output='motion.data')), read with the resolution of the recording
+    #: The synthetic dumps:
+    #:   still    encoder noise only
+    #:   walk     a person crosses the picture within 3 seconds after 1 second
+    #:   leaves   leaves in the wind in a corner of the picture
+    #:
+    #: Reports per dump the activity timeline, the analysis throughput by batch size and the time
+    #: the encoder callback spends in write, which has to stay far below the frame interval
+    #: Dumps are replayed at speed times the framerate, frames are dropped if the worker can not keep up
+    #:
+    #: python3 -m simulation.vectors --save dumps/
+    #: python3 -m simulation.vectors --dumps dumps/*.data --resolution 1280x720 --framerate 30
+'''
+
+import os
+import time
+import logging
+import argparse
+from typing import Dict, Tuple
+
+import numpy as np
+
+import utils
+from motion import VECTOR_DTYPE, MotionVectorAnalysis, vector_shape
+from simulation.benchmark import percentiles
+
+
+def dump(name: str, resolution: Tuple[int, int] = (1280, 720), framerate: int = 30, seconds: float = 5.0, seed: int = 0) -> np.ndarray:
+    ''' Synthetic dump, array of VECTOR_DTYPE with shape (frames, rows, columns)
+    '''
+
+    rng = np.random.default_rng(seed)
+    rows, columns = vector_shape(resolution)
+    frames = int(seconds * framerate)
+
+    vectors = np.zeros((frames, rows, columns), VECTOR_DTYPE)
+    vectors['x'] = rng.integers(-1, 2, vectors.shape)
+    vectors['y'] = rng.integers(-1, 2, vectors.shape)
+    vectors['sad'] = rng.integers(0, 256, vectors.shape)
+
+    if name == 'walk':
+        width = (columns - 1) // 10
+        for index in range(framerate, min(frames, 4 * framerate)):
+            left = int((index - framerate) * (columns - 1) / (3 * framerate)) - width
+            figure = vectors[index, rows // 4:rows // 4 + rows // 2, max(0, left):max(0, left + width)]
+            figure['x'] = rng.integers(6, 12, figure.shape)
+            figure['y'] = rng.integers(-2, 3, figure.shape)
+
+    elif name == 'leaves':
+        corner = vectors[:, :rows // 6, -(columns // 8) - 1:-1]
+        shaking = rng.random(corner.shape) < 0.1
+        corner['x'] = np.where(shaking, rng.integers(-8, 9, corner.shape), corner['x'])
+        corner['y'] = np.where(shaking, rng.integers(-8, 9, corner.shape), corner['y'])
+
+    elif name != 'still':
+        raise ValueError('Unknown dump {}, choose one of still, walk, leaves'.format(name))
+
+    return vectors
+
+
+def throughput(vectors: np.ndarray, resolution: Tuple[int, int], framerate: int, batch: int) -> float:
+    ''' Frames analysed per second in batches of the given size
+    '''
+
+    analysis = MotionVectorAnalysis(resolution, framerate, batch=batch)
+    buffers = [frame.tobytes() for frame in vectors]
+
+    started = time.perf_counter()
+    for offset in range(0, len(buffers), batch):
+        analysis._analyse_frames([(0.0, buf) for buf in buffers[offset:offset + batch]])
+
+    return len(buffers) / (time.perf_counter() - started)
+
+
+def replay(vectors: np.ndarray, resolution: Tuple[int, int], framerate: int, speed: float) -> Dict[str, object]:
+    ''' Feeds a dump through write like the encoder callback does, timestamps follow the framerate
+
+        #: return -> timeline, share of active frames, seconds per write and dropped frames
+    '''
+
+    clock = [0.0]
+    analysis = MotionVectorAnalysis(resolution, framerate, clock=lambda: clock[0])
+    writes = []
+    deadline = time.perf_counter()
+
+    for index, frame in enumerate(vectors):
+        clock[0] = index / framerate
+        buf = frame.tobytes()
+
+        deadline += 1 / (framerate * speed)
+        time.sleep(max(0, deadline - time.perf_counter()))
+
+        started = time.perf_counter()
+        analysis.write(buf)
+        writes.append(time.perf_counter() - started)
+
+    #: Wait for the worker
+    analysis._batches.join()
+    timeline = analysis.timeline(0.0, len(vectors) / framerate)
+
+    return {
+        'timeline': timeline,
+        'active': sum(activity >= analysis.active for activity in analysis.activities) / len(vectors),
+        'writes': writes,
+        'dropped': len(vectors) - len(analysis.activities),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Motion vector analysis throughput on vector dumps')
+    parser.add_argument('--dumps', nargs='*', help='motion_output files, the synthetic dumps without')
+    parser.add_argument('--resolution', default='1280x720', help='resolution of the recording of the dumps')
+    parser.add_argument('--framerate', type=int, default=30, help='framerate of the recording of the dumps')
+    parser.add_argument('--speed', type=float, default=10, help='replay speed relative to the framerate')
+    parser.add_argument('--save', help='directory to save the synthetic dumps to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    resolution = tuple(int(value) for value in args.resolution.split('x'))
+    rows, columns = vector_shape(resolution)
+
+    if args.dumps:
+        dumps = {os.path.basename(path): np.fromfile(path, VECTOR_DTYPE).reshape(-1, rows, columns) for path in args.dumps}
+    else:
+        dumps = {name: dump(name, resolution, args.framerate) for name in ('still', 'walk', 'leaves')}
+
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for name, vectors in dumps.items():
+            vectors.tofile(os.path.join(args.save, name + '.data'))
+
+    print('{} dumps, {}x{} at {} fps, {} macroblocks per frame, numpy {}'.format(len(dumps), *resolution, args.framerate, rows * columns, np.__version__))
+    print()
+    print('{:10} {:>7} {:>8}  {}'.format('dump', 'active', 'dropped', 'timeline [1 bar per s]'))
+    replays = {}
+    for name, vectors in dumps.items():
+        replays[name] = replay(vectors, resolution, args.framerate, args.speed)
+        print('{:10} {:6.0f}% {:8}  {}'.format(name, replays[name]['active'] * 100, replays[name]['dropped'], utils.sparkline(replays[name]['timeline'])))
+
+    vectors = np.concatenate(list(dumps.values()))
+    writes = percentiles([value for result in replays.values() for value in result['writes']])
+
+    print()
+    print('write (encoder callback): p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us, frame interval {:.0f} us'.format(
+        writes['p50'] * 1e6, writes['p99'] * 1e6, writes['max'] * 1e6, 1e6 / args.framerate))
+    print('{:>6} {:>12} {:>12}'.format('batch', 'frames/s', 'cpu at fps'))
+    for batch in (1, 5, 10, 30):
+        fps = throughput(vectors, resolution, args.framerate, batch)
+        print('{:6} {:12.0f} {:11.2f}%'.format(batch, fps, args.framerate / fps * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+''' Motion verification on frame fixtures
+
+    #: Feeds every fixture through MotionVerifier at the configured resolution, arms it at the radar trigger
+    #: and reports whether the motion was confirmed, after how many seconds, and the time per frame
+    #: The verifier has to keep up with VERIFY_FRAMERATE, the budget column is the share of the frame interval
+    #: used at the 99th percentile, measured on one core; numpy runs single-threaded for these sizes
+    #:
+    #: python3 -m simulation.verification --save fixtures/
+    #: python3 -m simulation.verification --fixtures fixtures/*.npz
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+from typing import List
+
+import numpy as np
+
+import config as cfg
+from simulation import scenes
+from simulation.benchmark import percentiles
+
+
+def run(fixture: scenes.Fixture, framerate: float) -> dict:
+    ''' Replays a fixture on a virtual clock
+    '''
+
+    from verification import MotionVerifier
+
+    clock = [0.0]
+    verifier = MotionVerifier(resolution=fixture.frames.shape[:0:-1], framerate=framerate, clock=lambda: clock[0])
+    times: List[float] = []
+    confirmed = None
+
+    for index, frame in enumerate(fixture.frames):
+        if index == fixture.trigger:
+            verifier.arm()
+
+        clock[0] = index / framerate
+        buf = frame.tobytes() + bytes(frame.size // 2)
+
+        started = time.perf_counter()
+        verifier.write(buf)
+        times.append(time.perf_counter() - started)
+
+        if confirmed is None and verifier.verified.is_set():
+            confirmed = (index - fixture.trigger + 1) / framerate
+
+    verifier.disarm()
+    return {'confirmed': confirmed, 'times': times}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Motion verification on frame fixtures')
+    parser.add_argument('--fixtures', nargs='*', help='.npz fixtures, the synthetic scenes without')
+    parser.add_argument('--save', help='directory to save the synthetic scenes to')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic scenes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    framerate = cfg.VERIFY_FRAMERATE
+
+    if args.fixtures:
+        fixtures = [scenes.load(path, os.path.basename(path)) for path in args.fixtures]
+    else:
+        fixtures = [scenes.scene(name, cfg.VERIFY_RESOLUTION, framerate, seed=args.seed) for name in scenes.SCENES]
+
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for fixture in fixtures:
+            fixture.save(os.path.join(args.save, fixture.name))
+
+    print('{} fixtures at {}x{}, {} fps, numpy {}'.format(len(fixtures), *fixtures[0].frames.shape[:0:-1], framerate, np.__version__))
+    print('{:12} {:>7} {:>10} {:>11} {:>8} {:>8} {:>9} {:>7}'.format('fixture', 'motion', 'confirmed', 'after [s]', 'p50 ms', 'p99 ms', 'max fps', 'budget'))
+
+    passed = True
+    for fixture in fixtures:
+        result = run(fixture, framerate)
+        times = percentiles(result['times'])
+        correct = (result['confirmed'] is not None) == fixture.motion
+        passed = passed and correct
+
+        print('{:12} {:>7} {:>10} {:>11} {:8.3f} {:8.3f} {:9.0f} {:6.1f}%{}'.format(
+            fixture.name, 'yes' if fixture.motion else 'no', 'yes' if result['confirmed'] is not None else 'no',
+            '{:.1f}'.format(result['confirmed']) if result['confirmed'] is not None else '-',
+            times['p50'] * 1000, times['p99'] * 1000, 1 / times['p50'], times['p99'] * framerate * 100, '' if correct else '  WRONG'))
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
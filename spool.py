@@ -0,0 +1,286 @@
+import time
+import random
+import logging
+import sqlite3
+import threading
+from typing import Iterable, List, NamedTuple, Set, Tuple, Union
+
+import config as cfg
+import metrics
+
+SPOOL_ENQUEUED = metrics.counter('surveillance_spool_enqueued', 'Items added to the upload spool by kind', ('kind',))
+SPOOL_DELIVERIES = metrics.counter('surveillance_spool_deliveries', 'Finished spooled deliveries by result', ('result',))
+SPOOL_PENDING = metrics.gauge('surveillance_spool_pending', 'Deliveries waiting in the upload spool')
+
+#: Kinds of spooled items, each kind is delivered in order for every recipient
+ALERT = 'alert'
+VIDEO = 'video'
+
+
+class Delivery(NamedTuple):
+    ''' Pending delivery of a spooled item to one recipient
+
+        #: text is the message of an alert or the caption of a video
+    '''
+
+    item: int
+    chat_id: int
+    kind: str
+    text: str
+    path: Union[str, None]
+    created: float
+    attempts: int
+
+
+class Spool():
+    ''' Persistent queue of alerts and videos waiting for delivery
+
+        #: Every item has one delivery per recipient, delivered deliveries are deleted
+        #: Each recipient has a cursor per kind, its oldest pending item, later items wait behind it,
+        #: so a recipient gets alerts and videos in order while alerts never wait for an upload
+        #: Failed deliveries are retried with exponential backoff and jitter, until max_attempts
+        #: Only due cursors are loaded, the spool itself stays on disk and holds at most max_items
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS items (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind    TEXT NOT NULL,
+            text    TEXT,
+            path    TEXT,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS deliveries (
+            chat_id      INTEGER NOT NULL,
+            kind         TEXT NOT NULL,
+            item         INTEGER NOT NULL,
+            attempts     INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            PRIMARY KEY (chat_id, kind, item)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS deliveries_item ON deliveries (item);
+    '''
+
+    #: Oldest pending item of every recipient and kind
+    _CURSORS = 'SELECT chat_id, kind, MIN(item) AS item FROM deliveries GROUP BY chat_id, kind'
+
+    def __init__(self, path: str = cfg.SPOOL_PATH, base_delay: float = cfg.SPOOL_RETRY_BASE, max_delay: float = cfg.SPOOL_RETRY_MAX,
+                 max_attempts: int = cfg.SPOOL_MAX_ATTEMPTS, max_items: int = cfg.SPOOL_MAX_ITEMS, clock = time.time):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_items = max_items
+
+        #: Wall clock, retry times have to survive a restart
+        self.clock = clock
+
+        #: Without a path the spool only lives in memory
+        self._connection = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+        #: Deliveries left over from the last run are due right away
+        with self._lock, self._connection:
+            recovered = self._connection.execute('UPDATE deliveries SET next_attempt = MIN(next_attempt, ?)', (self.clock(),)).rowcount
+
+        if recovered:
+            self.logger.info('Recovered {} pending deliveries from the spool'.format(recovered))
+
+        SPOOL_PENDING.set_function(self.pending)
+
+    def enqueue(self, kind: str, chat_ids: Iterable[int], text: str, path: str = None) -> Union[int, None]:
+        ''' Adds an item for the given recipients, committed before returning
+
+            #: return -> id of the item, None without recipients
+        '''
+
+        chat_ids = list(dict.fromkeys(chat_ids))
+        if not chat_ids:
+            return None
+
+        now = self.clock()
+        with self._lock, self._connection:
+            item = self._connection.execute('INSERT INTO items (kind, text, path, created) VALUES (?, ?, ?, ?)', (kind, text, path, now)).lastrowid
+            self._connection.executemany('INSERT INTO deliveries (chat_id, kind, item, next_attempt) VALUES (?, ?, ?, ?)',
+                                         ((chat_id, kind, item, now) for chat_id in chat_ids))
+
+            dropped = self._drop_oldest()
+
+        SPOOL_ENQUEUED.labels(kind).inc()
+        if dropped:
+            SPOOL_DELIVERIES.labels('dropped').inc(dropped)
+            self.logger.warning('Spool is full, dropped {} deliveries of the oldest items'.format(dropped))
+
+        return item
+
+    def due(self, busy: Iterable[Tuple[int, str]] = (), limit: int = cfg.SPOOL_BATCH) -> List[Delivery]:
+        ''' Cursors whose next attempt is due, oldest items first
+
+            #: busy - cursors (chat_id, kind) that are being delivered and are left out,
+            #: so an item with more than limit recipients does not fill every batch with them
+        '''
+
+        busy = set(busy)
+        deliveries = []
+
+        with self._lock:
+            rows = self._connection.execute('''
+                SELECT d.item, d.chat_id, d.kind, i.text, i.path, i.created, d.attempts
+                FROM ({}) c
+                JOIN deliveries d ON d.chat_id = c.chat_id AND d.kind = c.kind AND d.item = c.item
+                JOIN items i ON i.id = d.item
+                WHERE d.next_attempt <= ?
+                ORDER BY d.item'''.format(self._CURSORS), (self.clock(),))
+
+            #: Rows are fetched as they are needed, only up to limit cursors that are not busy
+            for row in rows:
+                if (row[1], row[2]) not in busy:
+                    deliveries.append(Delivery(*row))
+                    if len(deliveries) >= limit:
+                        break
+            rows.close()
+
+        return deliveries
+
+    def next_attempt(self, busy: Iterable[Tuple[int, str]] = ()) -> Union[float, None]:
+        ''' Seconds until the next cursor is due, None if there is none
+
+            #: busy - cursors (chat_id, kind) that are being delivered and are left out
+        '''
+
+        busy = set(busy)
+        with self._lock:
+            rows = self._connection.execute('''
+                SELECT d.chat_id, d.kind, d.next_attempt FROM ({}) c
+                JOIN deliveries d ON d.chat_id = c.chat_id AND d.kind = c.kind AND d.item = c.item'''.format(self._CURSORS)).fetchall()
+
+        times = [next_attempt for chat_id, kind, next_attempt in rows if (chat_id, kind) not in busy]
+        return max(0.0, min(times) - self.clock()) if times else None
+
+    def delivered(self, delivery: Delivery) -> None:
+        ''' Removes a delivery, which moves the recipient's cursor to the next item
+        '''
+
+        with self._lock, self._connection:
+            self._delete(delivery)
+
+        SPOOL_DELIVERIES.labels('delivered').inc()
+
+    def failed(self, delivery: Delivery) -> bool:
+        ''' Schedules the next attempt, gives up after max_attempts
+
+            #: return -> whether or not the delivery is retried
+        '''
+
+        attempts = delivery.attempts + 1
+        if attempts >= self.max_attempts:
+            with self._lock, self._connection:
+                self._delete(delivery)
+
+            SPOOL_DELIVERIES.labels('given_up').inc()
+            self.logger.error('Giving up {} {} for {} after {} attempts'.format(delivery.kind, delivery.item, delivery.chat_id, attempts))
+            return False
+
+        delay = self.backoff(attempts)
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE deliveries SET attempts = ?, next_attempt = ? WHERE chat_id = ? AND kind = ? AND item = ?',
+                                     (attempts, self.clock() + delay, delivery.chat_id, delivery.kind, delivery.item))
+
+        SPOOL_DELIVERIES.labels('retried').inc()
+        self.logger.debug('{} {} for {} failed, retry {} in {:.1f} s'.format(delivery.kind, delivery.item, delivery.chat_id, attempts, delay))
+        return True
+
+    def backoff(self, attempts: int) -> float:
+        ''' Delay before the given attempt, doubled per attempt up to max_delay, with full jitter of the upper half
+        '''
+
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def pending_paths(self) -> Set[str]:
+        ''' Paths of the items that are not delivered to every recipient yet
+        '''
+
+        with self._lock:
+            return {path for (path,) in self._connection.execute('SELECT path FROM items WHERE path IS NOT NULL')}
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM deliveries').fetchone()[0]
+
+    def stats(self) -> dict:
+        ''' Snapshot of the spool for /queue
+        '''
+
+        with self._lock:
+            kinds = dict(self._connection.execute('SELECT kind, COUNT(*) FROM deliveries GROUP BY kind').fetchall())
+            recipients, retrying = self._connection.execute('SELECT COUNT(DISTINCT chat_id), COUNT(CASE WHEN attempts > 0 THEN 1 END) FROM deliveries').fetchone()
+            items, oldest = self._connection.execute('SELECT COUNT(*), MIN(created) FROM items').fetchone()
+
+        return {
+            'items': items,
+            'alerts': kinds.get(ALERT, 0),
+            'videos': kinds.get(VIDEO, 0),
+            'recipients': recipients,
+            'retrying': retrying,
+            'oldest': self.clock() - oldest if oldest else 0.0,
+            'next_attempt': self.next_attempt(),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _delete(self, delivery: Delivery) -> None:
+        ''' Deletes a delivery and its item once nobody is waiting for it anymore, lock held by the caller
+        '''
+
+        self._connection.execute('DELETE FROM deliveries WHERE chat_id = ? AND kind = ? AND item = ?', (delivery.chat_id, delivery.kind, delivery.item))
+        self._connection.execute('DELETE FROM items WHERE id = ? AND NOT EXISTS (SELECT 1 FROM deliveries WHERE item = ?)', (delivery.item, delivery.item))
+
+    def _drop_oldest(self) -> int:
+        ''' Deletes the oldest items above max_items, lock held by the caller
+
+            #: return -> number of dropped deliveries
+        '''
+
+        row = self._connection.execute('SELECT id FROM items ORDER BY id DESC LIMIT 1 OFFSET ?', (self.max_items,)).fetchone()
+        if not row:
+            return 0
+
+        dropped = self._connection.execute('DELETE FROM deliveries WHERE item <= ?', row).rowcount
+        self._connection.execute('DELETE FROM items WHERE id <= ?', row)
+        return dropped
+
+
+if __name__ == '__main__':
+
+    import os
+    import tempfile
+
+    #: Benchmark: enqueue and drain 10000 alerts for 10 recipients on disk
+    path = os.path.join(tempfile.mkdtemp(), 'spool.db')
+    spool = Spool(path, max_items=100000)
+
+    started = time.perf_counter()
+    for n in range(10000):
+        spool.enqueue(ALERT, range(10), 'alert {}'.format(n))
+    enqueued = time.perf_counter() - started
+
+    started = time.perf_counter()
+    drained = 0
+    while True:
+        deliveries = spool.due(limit=100)
+        if not deliveries:
+            break
+        for delivery in deliveries:
+            spool.delivered(delivery)
+        drained += len(deliveries)
+
+    print('enqueue: {:.3f} ms per item | drain: {:.3f} ms per delivery ({} deliveries)'.format(enqueued / 10 ** 4 * 1000, (time.perf_counter() - started) / drained * 1000, drained))
@@ -0,0 +1,68 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import metrics
+
+STARTUP_SECONDS = metrics.gauge('surveillance_startup_seconds', 'Seconds from the start until a startup stage finished', ('stage',))
+
+
+class Startup():
+    ''' Runs the stages of the startup in parallel threads and records when each finished
+
+        #: Timings are seconds since the Startup was created, stages run by run() are marked when they finish,
+        #: milestones in between with mark()
+    '''
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.clock = clock
+        self.started = clock()
+        self.timings: Dict[str, float] = {}
+        self._stages: Dict[str, Future] = {}
+
+    def run(self, name: str, function: Callable, *args) -> Future:
+        ''' Calls function in a thread of its own
+
+            #: return -> future of the result
+        '''
+
+        future = Future()
+
+        def stage():
+            try:
+                result = function(*args)
+            except BaseException as e:
+                self.logger.error('Startup stage {} failed: {}'.format(name, e))
+                future.set_exception(e)
+            else:
+                self.mark(name)
+                future.set_result(result)
+
+        self._stages[name] = future
+        threading.Thread(target=stage, name='startup-{}'.format(name), daemon=True).start()
+        return future
+
+    def wait(self, *names: str) -> List:
+        ''' Results of the stages, raises the exception of a failed one
+        '''
+
+        return [self._stages[name].result() for name in names]
+
+    def mark(self, name: str) -> float:
+        ''' Records that the startup reached a stage or milestone
+        '''
+
+        elapsed = self.clock() - self.started
+        self.timings[name] = elapsed
+        STARTUP_SECONDS.labels(name).set(elapsed)
+        self.logger.info('Startup: {} after {:.2f} s'.format(name, elapsed))
+        return elapsed
+
+    def summary(self) -> str:
+        return ', '.join('{} {:.2f} s'.format(name, elapsed) for name, elapsed in sorted(self.timings.items(), key=lambda item: item[1]))
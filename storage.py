@@ -0,0 +1,203 @@
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import List, NamedTuple, Union
+
+import config as cfg
+from role import Role
+from user import User
+from usertoken import Token
+
+
+class Snapshot(NamedTuple):
+    ''' Everything stored, as loaded at startup
+    '''
+
+    users: List[User]
+    banned: List[User]
+    tokens: List[Token]
+    owner: Union[int, None]
+
+
+class Storage():
+    ''' SQLite persistence for the UserService
+
+        #: The database runs in WAL mode, writes are queued and committed by a writer thread
+        #: in one transaction per FLUSH_INTERVAL, so callers never wait for the disk
+        #: On a crash, at most the writes of the last flush interval are lost
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            name    TEXT,
+            role    INTEGER NOT NULL,
+            banned  INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS users_rank ON users (banned, role);
+        CREATE TABLE IF NOT EXISTS tokens (
+            value       TEXT PRIMARY KEY,
+            role        INTEGER NOT NULL,
+            valid_until TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value
+        ) WITHOUT ROWID;
+    '''
+
+    #: Marks the end of the write queue
+    _STOP = None
+
+    def __init__(self, path: str = cfg.DATABASE_PATH, flush_interval: float = cfg.DATABASE_FLUSH_INTERVAL, batch: int = cfg.DATABASE_BATCH):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch = batch
+
+        #: Create schema before anything is queued
+        with self._connect() as connection:
+            connection.executescript(self.SCHEMA)
+
+        self._queue: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='storage-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+
+        #: In WAL mode, NORMAL only risks the last transactions on power loss, never corruption
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def load(self, now: datetime = None) -> Snapshot:
+        ''' Reads everything stored, expired tokens are left out
+        '''
+
+        now = now or datetime.today()
+        connection = self._connect()
+
+        try:
+            users, banned = [], []
+            for chat_id, name, role, is_banned in connection.execute('SELECT chat_id, name, role, banned FROM users ORDER BY banned, role'):
+                (banned if is_banned else users).append(User(chat_id, name, Role(role)))
+
+            tokens = []
+            for value, role, valid_until in connection.execute('SELECT value, role, valid_until FROM tokens WHERE valid_until > ?', (now.isoformat(),)):
+                token = Token(Role(role), 0, value)
+                token.valid_until = datetime.fromisoformat(valid_until)
+                tokens.append(token)
+
+            row = connection.execute("SELECT value FROM meta WHERE key = 'owner'").fetchone()
+            return Snapshot(users, banned, tokens, row[0] if row else None)
+
+        finally:
+            connection.close()
+
+    def save_user(self, user: User, banned: bool = False) -> None:
+        self._enqueue('INSERT OR REPLACE INTO users (chat_id, name, role, banned) VALUES (?, ?, ?, ?)', (user.chat_id, user.name, user.role.value, int(banned)))
+
+    def delete_user(self, chat_id: int) -> None:
+        self._enqueue('DELETE FROM users WHERE chat_id = ?', (chat_id,))
+
+    def clear_users(self, keep: int = None) -> None:
+        ''' Deletes all users which are not banned, except keep
+        '''
+
+        self._enqueue('DELETE FROM users WHERE banned = 0 AND chat_id IS NOT ?', (keep,))
+
+    def set_owner(self, chat_id: int) -> None:
+        self._enqueue("INSERT OR REPLACE INTO meta (key, value) VALUES ('owner', ?)", (chat_id,))
+
+    def save_token(self, token: Token) -> None:
+        self._enqueue('INSERT OR REPLACE INTO tokens (value, role, valid_until) VALUES (?, ?, ?)', (token.value, token.role.value, token.valid_until.isoformat()))
+
+    def delete_token(self, value: str) -> None:
+        self._enqueue('DELETE FROM tokens WHERE value = ?', (value,))
+
+    def expire_tokens(self, now: datetime) -> None:
+        self._enqueue('DELETE FROM tokens WHERE valid_until <= ?', (now.isoformat(),))
+
+    def clear_tokens(self) -> None:
+        self._enqueue('DELETE FROM tokens', ())
+
+    def flush(self) -> None:
+        ''' Blocks until every queued write is committed
+        '''
+
+        self._queue.join()
+
+    def close(self) -> None:
+        ''' Commits the queued writes and stops the writer
+        '''
+
+        self._queue.put(self._STOP)
+        self._writer.join()
+
+    def _enqueue(self, sql: str, params: tuple) -> None:
+        self._queue.put((sql, params))
+
+    def _write(self) -> None:
+        ''' Writer thread: commits everything queued within a flush interval in one transaction
+        '''
+
+        connection = self._connect()
+        stopped = False
+
+        while not stopped:
+            ops = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(ops) < self.batch and ops[-1] is not self._STOP:
+                try:
+                    ops.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stopped = ops[-1] is self._STOP
+            writes = [op for op in ops if op is not self._STOP]
+
+            try:
+                with connection:
+                    for sql, params in writes:
+                        connection.execute(sql, params)
+
+            except sqlite3.Error:
+                self.logger.exception('Writing {} changes failed'.format(len(writes)))
+
+            for _ in ops:
+                self._queue.task_done()
+
+        connection.close()
+
+
+if __name__ == '__main__':
+
+    import os
+    import tempfile
+
+    from userservice import UserService
+
+    #: Benchmark: warm start with 100k stored users
+    path = os.path.join(tempfile.mkdtemp(), 'bot.db')
+    storage = Storage(path)
+
+    started = time.perf_counter()
+    roles = list(Role)[1:-1]
+    for chat_id in range(100000):
+        storage.save_user(User(chat_id, 'user{}'.format(chat_id), roles[chat_id % len(roles)]), banned = chat_id % 50 == 0)
+    storage.close()
+    print('write-behind of 100000 users: {:.2f} s, database: {:.1f} MiB'.format(time.perf_counter() - started, os.path.getsize(path) / 2**20))
+
+    started = time.perf_counter()
+    service = UserService(Storage(path))
+    constructed = time.perf_counter() - started
+    users = len(service.users)
+    print('startup: {:.3f} s until UserService is ready, {:.3f} s until {} users are loaded'.format(constructed, time.perf_counter() - started, users))
@@ -1,18 +1,107 @@
 import string
 import operator
-from typing import Dict, Type, TypeVar, Union
+import threading
+from datetime import datetime
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Type, TypeVar, Union
 
 import utils
+import config as cfg
 from role import Role
 from user import User
-from usertoken import Token
+from usertoken import Token, TokenReaper, TokenStore
 
 T = TypeVar('T', bound='UserDict')
 
+#: Sentinel for pop without default
+_MISSING = object()
+
+class UserView(Mapping):
+    ''' Read-only snapshot of the users within a rank range
+
+        #: Returned by the role queries of UserDict, stays valid while the UserDict changes
+    '''
+
+    __slots__ = ('_users',)
+
+    def __init__(self, users: Dict[int, User]):
+        self._users = users
+
+    def __getitem__(self, key: int) -> User: return self._users[key]
+    def __iter__(self) -> Iterator[int]: return iter(self._users)
+    def __len__(self) -> int: return len(self._users)
+    def __contains__(self, key) -> bool: return key in self._users
+    def __repr__(self) -> str: return 'UserView({!r})'.format(self._users)
+
+    def _filter(self, operator: Callable, role: Role) -> 'UserView':
+        return UserView({ k:v for k,v in self._users.items() if operator(v.role, role) })
+
+    def with_min_role(self, role: Role) -> 'UserView': return self._filter(operator.ge, role)
+    def with_max_role(self, role: Role) -> 'UserView': return self._filter(operator.le, role)
+    def with_lower_role(self, role: Role) -> 'UserView': return self._filter(operator.lt, role)
+    def with_higher_role(self, role: Role) -> 'UserView': return self._filter(operator.gt, role)
+
+
 class UserDict(dict):
+    ''' Dict of users by chat_id, additionally indexed by role
+
+        #: Role queries merge the matching role buckets into a UserView
+        #: Views are cached until the next mutation, so repeated queries cost O(1)
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(UserDict, self).__init__()
+        self._lock = threading.RLock()
+        self._buckets: Dict[Role, Dict[int, User]] = { role: {} for role in Role }
+        self._views: Dict[tuple, UserView] = {}
+        self.update(*args, **kwargs)
 
     def __setitem__(self, key: int, value: User):
-        super(UserDict, self).__setitem__(key, value)
+        with self._lock:
+            if key in self:
+                del self._buckets[self[key].role][key]
+            super(UserDict, self).__setitem__(key, value)
+            self._buckets[value.role][key] = value
+            self._views.clear()
+
+    def __delitem__(self, key: int):
+        with self._lock:
+            del self._buckets[self[key].role][key]
+            super(UserDict, self).__delitem__(key)
+            self._views.clear()
+
+    def pop(self, key: int, default = _MISSING) -> User:
+        with self._lock:
+            if key not in self:
+                if default is _MISSING:
+                    raise KeyError(key)
+                return default
+            user = self[key]
+            del self[key]
+            return user
+
+    def popitem(self) -> tuple:
+        with self._lock:
+            key = next(reversed(self))
+            return (key, self.pop(key))
+
+    def setdefault(self, key: int, default: User = None) -> User:
+        with self._lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def update(self, *args, **kwargs) -> None:
+        with self._lock:
+            for key, value in dict(*args, **kwargs).items():
+                self[key] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            super(UserDict, self).clear()
+            for bucket in self._buckets.values():
+                bucket.clear()
+            self._views.clear()
 
     @classmethod
     def from_dict(cls: Type[T], d: dict) -> T:
@@ -21,13 +110,26 @@ class UserDict(dict):
 
         return userdict
 
-    def _filter(self, operator: operator, role: Role) -> T:
-        return self.from_dict(dict(filter(lambda kv: operator(kv[1].role, role), self.items())))
+    def _filter(self, operator: Callable, role: Role) -> UserView:
+        ''' Gets the cached view of all users whose role matches, builds it from the role buckets if needed
+        '''
+
+        with self._lock:
+            key = (operator, role)
+
+            if key not in self._views:
+                users = {}
+                for bucket_role, bucket in self._buckets.items():
+                    if operator(bucket_role, role):
+                        users.update(bucket)
+                self._views[key] = UserView(users)
 
-    def with_min_role(self, role: Role) -> T: return self._filter(operator.ge, role)
-    def with_max_role(self, role: Role) -> T: return self._filter(operator.le, role)
-    def with_lower_role(self, role: Role) -> T: return self._filter(operator.lt, role)
-    def with_higher_role(self, role: Role) -> T: return self._filter(operator.gt, role)
+            return self._views[key]
+
+    def with_min_role(self, role: Role) -> UserView: return self._filter(operator.ge, role)
+    def with_max_role(self, role: Role) -> UserView: return self._filter(operator.le, role)
+    def with_lower_role(self, role: Role) -> UserView: return self._filter(operator.lt, role)
+    def with_higher_role(self, role: Role) -> UserView: return self._filter(operator.gt, role)
 
 
 class UserService():
@@ -35,23 +137,119 @@ class UserService():
     '''
 
 
-    def __init__(self):
+    def __init__(self, storage: 'Storage' = None, clock: Callable[[], datetime] = datetime.today):
         ''' Init
 
-            #: initialising user and token dicts
+            #: initialising user dicts and token store
             #: creates owner token
+            #: storage - optional persistence, stored data is loaded in the background
+            #:           and the first access waits until it is available
+            #: clock   - source of the current time for token validity
+
+        '''
 
+        #: Init users, banned and token store
+        self.clock = clock
+        self.storage = storage
+        self._users: UserDict = UserDict()
+        self._banned: UserDict = UserDict()
+        self._tokens: TokenStore = TokenStore(clock)
+        self._owner: User = None
+        self._loaded = threading.Event()
+
+        #: Called with the chat_id whose role or ban changed, None if any may have changed
+        self.listeners: List[Callable[[Union[int, None]], None]] = []
+
+        #: Load stored data, creates owner token if no owner is stored
+        if storage:
+            threading.Thread(target=self._load, name='userservice-loader', daemon=True).start()
+        else:
+            self._add_owner_token()
+
+        #: Remove expired tokens in the background
+        if cfg.TOKEN_REAPER_INTERVAL:
+            self.token_reaper = TokenReaper(self._tokens)
+            self.token_reaper.start()
+
+    def _add_owner_token(self) -> None:
+        ''' Create owner token, marks service as loaded
         '''
 
-        #: Init users, banned and token dict
-        self.users: UserDict = UserDict()
-        self.banned: UserDict = UserDict()
-        self.tokens: Dict[str, Token] = {}
+        #: The owner token is only created once per process
+        owner_token: Token = Token.owner_token(self.clock())
+        if owner_token:
+            self._tokens.add(owner_token)
+        self._loaded.set()
+
+    def _load(self) -> None:
+        ''' Loader thread: fills users, banned and tokens from storage
+        '''
+
+        try:
+            snapshot = self.storage.load(self.clock())
+
+            self._users.update((user.chat_id, user) for user in snapshot.users)
+            self._banned.update((user.chat_id, user) for user in snapshot.banned)
+            for token in snapshot.tokens:
+                self._tokens.add(token)
+
+            self._owner = self._users.get(snapshot.owner)
+
+        finally:
+            if self._owner:
+                self._loaded.set()
+            else:
+                self._add_owner_token()
+
+            self._changed()
 
-        # Create owner token
-        owner_token: Token = Token.owner_token()
-        self.tokens[owner_token.value] = owner_token
-        self.owner: User = None
+    #: Accessors wait until stored data is loaded
+
+    @property
+    def loaded(self) -> bool:
+        ''' Whether the accessors return right away
+        '''
+
+        return self._loaded.is_set()
+
+    @property
+    def users(self) -> UserDict:
+        self._loaded.wait()
+        return self._users
+
+    @property
+    def banned(self) -> UserDict:
+        self._loaded.wait()
+        return self._banned
+
+    @property
+    def tokens(self) -> TokenStore:
+        self._loaded.wait()
+        return self._tokens
+
+    @property
+    def owner(self) -> Union[User, None]:
+        self._loaded.wait()
+        return self._owner
+
+    @owner.setter
+    def owner(self, user: User) -> None:
+        self._owner = user
+        self._persist('set_owner', user.chat_id)
+
+    def _changed(self, chat_id: int = None) -> None:
+        ''' Informs the listeners about a changed role or ban
+        '''
+
+        for listener in self.listeners:
+            listener(chat_id)
+
+    def _persist(self, action: str, *args) -> None:
+        ''' Queues a write in the storage, if there is one
+        '''
+
+        if self.storage:
+            getattr(self.storage, action)(*args)
 
     def get_user(self, chat_id: int, default = None) -> Union[User, None]:
         ''' Get user with chat_id, return default if not present
@@ -91,8 +289,9 @@ class UserService():
             #: return -> generated token
         '''
 
-        token = Token(role, valid_for)
-        self.tokens[token.value] = token
+        token = Token(role, valid_for, issued=self.clock())
+        self.tokens.add(token)
+        self._persist('save_token', token)
 
         return token
 
@@ -104,6 +303,8 @@ class UserService():
 
         if chat_id in self.users:
             del self.users[chat_id]
+            self._persist('delete_user', chat_id)
+            self._changed(chat_id)
             return True
 
         return False
@@ -114,25 +315,24 @@ class UserService():
             #: return -> whether or not the token existed before it eventually was removed
         '''
 
-        if token_id in self.tokens:
-
-            del self.tokens[token_id]
-            return True
-
-        return False
+        self._persist('delete_token', token_id)
+        return self.tokens.remove(token_id)
 
     def clear_tokens(self) -> None:
         ''' Removes all tokens
         '''
 
         self.tokens.clear()
+        self._persist('clear_tokens')
     
     def remove_expired_tokens(self) -> None:
         ''' Removes all expired tokens 
+
+            #: Only expired tokens are visited, in order of their expiry
         '''
 
-        #: Remove expired tokens in dict comprehension filter
-        self.tokens = { k:v for k,v in self.tokens.items() if v.is_valid() }
+        if self.tokens.expire():
+            self._persist('expire_tokens', self.clock())
 
     def activate_token(self, token_id: str, chat_id: int, username: str) -> Union[User, None]:
         ''' Activates token for user with given chat_id and username
@@ -146,12 +346,16 @@ class UserService():
         #: remove expired tokens
         self.remove_expired_tokens()
 
-        #: check if token is valid
-        if token_id not in self.tokens:
+        #: invalidate/remove token, pop only returns valid tokens
+        token: Token = self.tokens.pop(token_id)
+
+        #: check if token is valid, unknown tokens cost no write, expired ones were just removed above
+        if not token:
             return None
 
-        #: invalidate/remove token and create user
-        token: Token = self.tokens.pop(token_id)
+        self._persist('delete_token', token_id)
+
+        #: create user
         user: User = User(chat_id, username, token.role)
 
         if user.role is Role.OWNER:
@@ -165,6 +369,8 @@ class UserService():
 
         #: save to user dict
         self.users[chat_id] = user
+        self._persist('save_user', user)
+        self._changed(chat_id)
 
         return user
 
@@ -173,14 +379,17 @@ class UserService():
         ''' Cleans everything except the owner
         '''
 
-        owner = self.get_owner
+        owner = self.get_owner()
 
         self.tokens.clear()
+        self._persist('clear_tokens')
         
         self.users.clear()
         self.users[owner.chat_id] = owner
+        self._persist('clear_users', owner.chat_id)
+        self._changed()
 
-    def ban_user(self, chat_id: str) -> bool:
+    def ban_user(self, chat_id: int) -> bool:
         ''' Moves user from users to banned
 
             #: return -> whether or not the user was present and moved
@@ -189,12 +398,14 @@ class UserService():
         if chat_id in self.users:
             user: User = self.users.pop(chat_id)
             self.banned[user.chat_id] = user
+            self._persist('save_user', user, True)
+            self._changed(chat_id)
 
             return True
         
         return False
 
-    def unban_user(self, chat_id: str) -> bool:
+    def unban_user(self, chat_id: int) -> bool:
         ''' Moves user from banned to users
 
             #: return -> whether or not the user was present and moved
@@ -203,6 +414,8 @@ class UserService():
         if chat_id in self.banned:
             user: User = self.banned.pop(chat_id)
             self.users[user.chat_id] = user
+            self._persist('save_user', user, False)
+            self._changed(chat_id)
 
             return True
         
@@ -266,8 +479,29 @@ class UserService():
 
 if __name__=='__main__':
 
+    import time
+    import tracemalloc
+
     us = UserService()
     users = us.get_users().with_max_role(Role.MOD).with_max_role(Role.SUB).with_min_role(Role.SUB)
 
     print(users)
 
+    #: Benchmark: role queries against the former copying filter
+    def copying_filter(d: dict, operator: Callable, role: Role) -> dict:
+        return dict(filter(lambda kv: operator(kv[1].role, role), d.items()))
+
+    for count in (10000, 100000):
+        roles = list(Role)
+        d = UserDict({ i: User(i, 'user{}'.format(i), roles[i % len(roles)]) for i in range(count) })
+
+        for name, query in (('copying', lambda: copying_filter(d, operator.ge, Role.ADMIN)), ('indexed', lambda: d.with_min_role(Role.ADMIN))):
+            tracemalloc.start()
+            started = time.perf_counter()
+            for _ in range(100):
+                query()
+            elapsed = (time.perf_counter() - started) / 100
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print('{:6} users, {}: {:9.1f} us per query, {:7.1f} KiB peak'.format(count, name, elapsed * 1e6, peak / 1024))
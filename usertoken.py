@@ -1,50 +1,248 @@
+import heapq
+import threading
+import itertools
 from datetime import datetime, timedelta
 from dataclasses import dataclass, InitVar, field
-from typing import ClassVar
+from typing import Callable, ClassVar, Dict, Iterator, List, Tuple, Union
 from role import Role
 from utils import randomstr
 import config as cfg
 
 @dataclass
 class Token():
-    ''' #TODO
+    ''' Activation token for a role, valid for a number of days
+
+        #: issued defaults to now, passing it allows a controllable clock
     '''
 
     #: let class keep track if owner-token was already created
     owner_token_created: ClassVar[bool] = False
 
-    #: init params, value has randomstr as default
+    #: init params, value has a fresh randomstr as default
     role: Role
     valid_for: InitVar[int]
-    value: str = randomstr(cfg.ACTIVATION_TOKEN_LENGTH)
+    value: str = field(default_factory=lambda: randomstr(cfg.ACTIVATION_TOKEN_LENGTH))
+    issued: InitVar[datetime] = None
 
-    #: prepare timestamp field 
+    #: prepare timestamp field
     valid_until: datetime = field(init=False)
-    
-    def __post_init__(self, valid_for):
+
+    def __post_init__(self, valid_for, issued):
         ''' #TODO
         '''
 
-        #: compute validity timestamp with valid_for value 
-        self.valid_until = datetime.today() + timedelta(days=valid_for)
+        #: compute validity timestamp with valid_for value
+        self.valid_until = (issued or datetime.today()) + timedelta(days=valid_for)
 
     @classmethod
-    def owner_token(cls):
+    def owner_token(cls, issued: datetime = None):
         ''' #TODO
         '''
 
         if not cls.owner_token_created:
             cls.owner_token_created = True
-            return cls(Role.OWNER, 1, cfg.OWNER_ACTIVATION_TOKEN)
-    
-    def is_valid(self):
-        ''' #TODO 
+            return cls(Role.OWNER, 1, cfg.OWNER_ACTIVATION_TOKEN, issued)
+
+    def is_valid(self, now: datetime = None):
+        ''' #TODO
+        '''
+
+        return (now or datetime.today()) < self.valid_until
+
+
+class TokenStore():
+    ''' Tokens by value, with a min-heap on valid_until for expiry
+
+        #: Lookups are O(1) and never return expired tokens
+        #: Expired tokens are removed lazily in O(log n) each, removed tokens leave stale heap entries
+        #: which are skipped on expiry and compacted once they make up half of the heap
+    '''
+
+    def __init__(self, clock: Callable[[], datetime] = datetime.today):
+        self.clock = clock
+        self._tokens: Dict[str, Token] = {}
+        self._expiry: List[Tuple[datetime, int, str]] = []
+        self._sequence = itertools.count()
+        self._stale = 0
+        self._lock = threading.Lock()
+
+    def add(self, token: Token) -> None:
+        with self._lock:
+            if token.value in self._tokens:
+                self._stale += 1
+
+            self._tokens[token.value] = token
+            heapq.heappush(self._expiry, (token.valid_until, next(self._sequence), token.value))
+
+    def get(self, value: str, default = None) -> Union[Token, None]:
+        ''' Gets the token with given value if it is still valid
+        '''
+
+        token = self._tokens.get(value)
+        if token is None or not token.is_valid(self.clock()):
+            return default
+        return token
+
+    def pop(self, value: str, default = None) -> Union[Token, None]:
+        ''' Removes the token with given value
+
+            #: return -> the token if it was present and valid, else default
+        '''
+
+        with self._lock:
+            token = self._tokens.pop(value, None)
+            if token is None:
+                return default
+
+            self._stale += 1
+            self._compact()
+
+        return token if token.is_valid(self.clock()) else default
+
+    def remove(self, value: str) -> bool:
+        ''' Removes the token with given value
+
+            #: return -> whether or not the token existed before
+        '''
+
+        with self._lock:
+            if value not in self._tokens:
+                return False
+
+            del self._tokens[value]
+            self._stale += 1
+            self._compact()
+            return True
+
+    def expire(self, limit: int = None) -> int:
+        ''' Removes expired tokens, oldest first
+
+            #: limit - max number of heap entries to process, keeps the lock short
+            #: return -> number of removed tokens
+        '''
+
+        now = self.clock()
+        removed = 0
+
+        with self._lock:
+            processed = 0
+            while self._expiry and self._expiry[0][0] <= now and (limit is None or processed < limit):
+                valid_until, _, value = heapq.heappop(self._expiry)
+                processed += 1
+
+                #: entry of a removed or replaced token
+                token = self._tokens.get(value)
+                if token is None or token.valid_until != valid_until:
+                    self._stale -= 1
+                    continue
+
+                del self._tokens[value]
+                removed += 1
+
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+            self._expiry.clear()
+            self._stale = 0
+
+    def values(self) -> List[Token]:
+        now = self.clock()
+        return [token for token in list(self._tokens.values()) if token.is_valid(now)]
+
+    def _compact(self) -> None:
+        ''' Rebuilds the heap without stale entries once they make up half of it, lock must be held
         '''
-        
-        return datetime.today() < self.valid_until
+
+        if self._stale > len(self._expiry) // 2:
+            self._expiry = [entry for entry in self._expiry if self._tokens.get(entry[2]) is not None and self._tokens[entry[2]].valid_until == entry[0]]
+            heapq.heapify(self._expiry)
+            self._stale = 0
+
+    def __contains__(self, value: str) -> bool:
+        return self.get(value) is not None
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._tokens))
+
+
+class TokenReaper(threading.Thread):
+    ''' Background thread removing expired tokens in small batches
+    '''
+
+    def __init__(self, store: TokenStore, interval: float = cfg.TOKEN_REAPER_INTERVAL, batch: int = cfg.TOKEN_REAPER_BATCH):
+        super().__init__(name='token-reaper', daemon=True)
+        self.store = store
+        self.interval = interval
+        self.batch = batch
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+
+            #: Release the lock between batches
+            while self.store.expire(self.batch):
+                pass
+
+    def stop(self) -> None:
+        self.stopped.set()
+
 
 if __name__ == '__main__':
 
-    t = Token.owner_token()
+    import sys
+    import time
+
+    #: Expiry on a virtual clock, exits non-zero if a token is found or removed at the wrong time
+    failures = []
+
+    def check(name: str, result, expected) -> None:
+        if result != expected:
+            failures.append('{}: {!r}, expected {!r}'.format(name, result, expected))
+        print('{:40} {}'.format(name, 'ok' if result == expected else 'FAILED'))
+
+    start = datetime(2022, 1, 1)
+    now = [start]
+    store = TokenStore(clock=lambda: now[0])
+
+    tokens = {days: Token(Role.SUB, days, 'token{}'.format(days), issued=start) for days in (1, 3, 5, 10)}
+    for token in tokens.values():
+        store.add(token)
+
+    #: Replaced by a token valid longer, the entry of the old one is stale
+    store.add(Token(Role.SUB, 20, 'token3', issued=start))
+
+    for offset, left in ((0, {'token1', 'token3', 'token5', 'token10'}), (2, {'token3', 'token5', 'token10'}),
+                         (6, {'token3', 'token10'}), (11, {'token3'}), (21, set())):
+        now[0] = start + timedelta(days=offset)
+
+        #: Lookups never return expired tokens, even before they were removed
+        check('day {:2}: valid'.format(offset), {value for value in list(store) if value in store}, left)
+        store.expire()
+        check('day {:2}: left after expire'.format(offset), set(store), left)
+
+    #: Expired tokens can not be activated
+    now[0] = start
+    store.add(Token(Role.ADMIN, 1, 'admin', issued=start))
+    now[0] = start + timedelta(days=2)
+    check('pop of an expired token', store.pop('admin'), None)
+
+    #: The reaper removes expired tokens in batches
+    now[0] = start
+    for n in range(100):
+        store.add(Token(Role.SUB, 1 + n % 2, 'batch{}'.format(n), issued=start))
+    now[0] = start + timedelta(days=1, hours=12)
+
+    reaper = TokenReaper(store, interval=0.01, batch=7)
+    reaper.start()
+    deadline = time.monotonic() + 5
+    while len(store) > 50 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    reaper.stop()
+    check('reaped in batches', sorted(store, key=lambda value: int(value[5:])), ['batch{}'.format(n) for n in range(1, 100, 2)])
 
-    print(t)
\ No newline at end of file
+    sys.exit(1 if failures else 0)
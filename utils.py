@@ -9,12 +9,20 @@ def randomstr(length=8, charset=string.ascii_uppercase + string.digits) -> str:
 
 def shell_cmd(cmd) -> None:
     subprocess.call(cmd, shell=True) #, stdout=subprocess.DEVNULL)
+
+def run_cmd(args) -> int:
+    return subprocess.call(args, stdout=subprocess.DEVNULL)
     
 def timestring() -> str:
     return time.strftime('%Y-%m-%d-%Z-%H-%M-%S')
 
 def basename(path) -> str:
     return os.path.basename(os.path.normpath(path))
+
+def sparkline(levels) -> str:
+    ''' Bars for levels from 0 to 1
+    '''
+    return ''.join('▁▂▃▄▅▆▇█'[min(7, int(level * 8))] for level in levels)
     
 if __name__ == '__main__':
     #convert = 'MP4Box -add {before} {after}'.format(before = 'video.h264', after = 'videos/video.mp4')
@@ -23,4 +31,6 @@ if __name__ == '__main__':
     #print(timestring())
     print(basename('/ajksdf/aksjfdh/jkasdfhiuva///askjdfh/82343789345u&%%/(5/file.txt/'))
 
-    print(randomstr(10, string.digits))
\ No newline at end of file
+    print(randomstr(10, string.digits))
+
+    print(sparkline([0, 0.1, 0.3, 0.6, 1.0, 0.2]))
\ No newline at end of file
@@ -0,0 +1,185 @@
+import time
+import logging
+import threading
+from typing import Callable, Tuple
+
+import numpy as np
+
+import config as cfg
+import metrics
+
+VERIFICATIONS = metrics.counter('surveillance_verifications', 'Radar triggers by camera verdict', ('result',))
+VERIFY_LATENCY = metrics.histogram('surveillance_verify_seconds', 'Time from the radar trigger until the camera confirmed the motion')
+FRAME_TIME = metrics.histogram('surveillance_verify_frame_seconds', 'Time to score one verification frame',
+                               buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1))
+
+
+class MotionVerifier():
+    ''' Confirms radar motion with the camera, the radar also triggers through walls and on moving curtains
+
+        #: Receives unencoded YUV frames of a splitter port (PiCamera output interface), only the luma plane is used
+        #: Every frame is compared with a background model, a running mean and variance per pixel:
+        #: a pixel counts if it deviates from the mean by more than deviations * its standard deviation
+        #: and changed since the previous frame, so swaying pixels (curtains, leaves) and lasting changes are ignored
+        #: The frame is scaled to the brightness of the background first, light switches and exposure changes do not count
+        #: While armed, motion is confirmed after frames consecutive frames with a share of counting pixels above threshold
+        #: Frames above framerate are skipped, the encoder callback never waits for the analysis
+    '''
+
+    def __init__(self, on_verified: Callable[[object], None] = None, resolution: Tuple[int, int] = cfg.VERIFY_RESOLUTION, framerate: float = cfg.VERIFY_FRAMERATE,
+                 threshold: float = cfg.VERIFY_THRESHOLD, frames: int = cfg.VERIFY_FRAMES, pixel_threshold: float = cfg.VERIFY_PIXEL_THRESHOLD,
+                 deviations: float = cfg.VERIFY_DEVIATIONS, learning_rate: float = cfg.VERIFY_LEARNING_RATE, clock: Callable[[], float] = time.monotonic):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.on_verified = on_verified
+        self.resolution = resolution
+        self.interval = 1 / framerate if framerate else 0
+        self.threshold = threshold
+        self.frames = frames
+        self.pixel_threshold = pixel_threshold
+        self.deviations = deviations
+        self.learning_rate = learning_rate
+        self.clock = clock
+
+        #: YUV420 frames are padded to a width of 32 and a height of 16 pixels
+        width, height = resolution
+        self._stride = (width + 31) // 32 * 32
+        self._rows = (height + 15) // 16 * 16
+
+        #: Background model, initialized with the first frame
+        self.mean: np.ndarray = None
+        self.variance = np.zeros((height, width), np.float32)
+        self.score = 0.0
+
+        #: Buffers reused for every frame
+        self._frame = np.empty((height, width), np.float32)
+        self._previous = np.empty((height, width), np.float32)
+        self._diff = np.empty((height, width), np.float32)
+        self._work = np.empty((height, width), np.float32)
+        self._limit = np.empty((height, width), np.float32)
+        self._foreground = np.empty((height, width), bool)
+        self._moving = np.empty((height, width), bool)
+
+        self._analysed = float('-inf')
+        self._armed: float = None
+        self._incident: object = None
+        self._hits = 0
+        self._lock = threading.Lock()
+        self.verified = threading.Event()
+
+    def arm(self, incident: object = None) -> None:
+        ''' Starts verifying a radar trigger, on_verified is called with incident once it is confirmed
+        '''
+
+        with self._lock:
+            self._armed = self.clock()
+            self._incident = incident
+            self._hits = 0
+            self.verified.clear()
+
+    def disarm(self) -> bool:
+        ''' Stops verifying
+
+            #: return -> whether or not the motion was confirmed since arm
+        '''
+
+        with self._lock:
+            armed, self._armed = self._armed, None
+
+        if armed is not None and not self.verified.is_set():
+            VERIFICATIONS.labels('rejected').inc()
+            self.logger.info('Radar trigger not confirmed by the camera')
+
+        return self.verified.is_set()
+
+    def write(self, buf) -> int:
+        ''' PiCamera output, receives one frame per call
+        '''
+
+        now = self.clock()
+
+        #: Some slack for frame jitter, at 30 fps and a framerate of 10 every third frame is analysed
+        if now - self._analysed < self.interval * 0.75 or len(buf) < self._stride * self._rows:
+            return len(buf)
+
+        self._analysed = now
+        width, height = self.resolution
+        luma = np.frombuffer(buf, np.uint8, count=self._stride * self._rows).reshape(self._rows, self._stride)[:height, :width]
+
+        started = time.perf_counter()
+        score = self.analyse(luma)
+        FRAME_TIME.observe(time.perf_counter() - started)
+
+        self._count(score)
+        return len(buf)
+
+    def flush(self) -> None:
+        pass
+
+    def analyse(self, luma: np.ndarray) -> float:
+        ''' Scores a luma frame and updates the background model
+
+            #: return -> share of pixels that moved and deviate from the background
+        '''
+
+        frame, diff, work, limit = self._frame, self._diff, self._work, self._limit
+        np.copyto(frame, luma, casting='unsafe')
+
+        if self.mean is None:
+            self.mean = frame.copy()
+            np.copyto(self._previous, frame)
+            return 0.0
+
+        #: Scale to the brightness of the background
+        frame *= self.mean.mean() / max(frame.mean(), 1.0)
+
+        #: Deviation from the background, beyond the pixel noise and beyond the usual swing of the pixel
+        np.subtract(frame, self.mean, out=diff)
+        np.square(diff, out=work)
+        np.multiply(self.variance, self.deviations ** 2, out=limit)
+        np.maximum(limit, self.pixel_threshold ** 2, out=limit)
+        np.greater(work, limit, out=self._foreground)
+
+        #: Frame differencing, only what changed since the previous frame counts
+        np.subtract(frame, self._previous, out=limit)
+        np.abs(limit, out=limit)
+        np.greater(limit, self.pixel_threshold, out=self._moving)
+        self._moving &= self._foreground
+        self.score = np.count_nonzero(self._moving) / self._moving.size
+
+        #: Foreground pixels are learned ten times slower, so a person does not fade into the background
+        np.multiply(self._foreground, -0.9 * self.learning_rate, out=limit)
+        limit += self.learning_rate
+        work -= self.variance
+        work *= limit
+        self.variance += work
+        diff *= limit
+        self.mean += diff
+
+        np.copyto(self._previous, frame)
+        return self.score
+
+    def _count(self, score: float) -> None:
+        ''' Confirms the motion after enough consecutive frames above threshold
+        '''
+
+        with self._lock:
+            if self._armed is None or self.verified.is_set():
+                return
+
+            self._hits = self._hits + 1 if score >= self.threshold else 0
+            if self._hits < self.frames:
+                return
+
+            self.verified.set()
+            latency = self.clock() - self._armed
+            incident = self._incident
+
+        VERIFICATIONS.labels('confirmed').inc()
+        VERIFY_LATENCY.observe(latency)
+        self.logger.info('Motion confirmed by the camera after {:.2f} s [score {:.3f}]'.format(latency, score))
+
+        if self.on_verified:
+            self.on_verified(incident)
@@ -0,0 +1,103 @@
+import hmac
+import json
+import ssl
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import metrics
+
+WEBHOOK_UPDATES = metrics.counter('surveillance_webhook_updates', 'Requests received by the webhook by result', ('result',))
+
+#: Header telegram sends the secret_token of set_webhook in
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ListenerHTTPServer(ThreadingHTTPServer):
+    ''' Threading server accepting as many pending connections as telegram opens (max_connections defaults to 40)
+    '''
+
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class WebhookServer():
+    ''' Receives updates pushed by telegram
+
+        #: Listens on http://listen:port/path, or https with cert and key,
+        #: use plain http behind a reverse proxy terminating tls
+        #: Requests without the secret token are rejected, every accepted update is handed to on_update as parsed json
+    '''
+
+    def __init__(self, on_update: Callable[[dict], None], secret_token: str, path: str = '/', listen: str = '127.0.0.1', port: int = 8443, cert: str = None, key: str = None):
+
+        #: Init logger
+        self.logger = logging.getLogger(__name__)
+
+        self.on_update = on_update
+        self.secret_token = secret_token
+        self.path = path
+
+        self.httpd = ListenerHTTPServer((listen, port), self._handler())
+
+        if cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+
+        self.scheme = 'https' if cert else 'http'
+
+    @property
+    def url(self) -> str:
+        ''' Local url of the webhook
+        '''
+
+        host, port = self.httpd.server_address[:2]
+        return '{}://{}:{}{}'.format(self.scheme, host, port, self.path)
+
+    def start(self) -> 'WebhookServer':
+        threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True).start()
+        self.logger.debug('Listening for updates at {}'.format(self.url))
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+
+                if self.path.split('?', 1)[0] != server.path:
+                    self._reply(404, 'not_found')
+                    return
+
+                #: Constant time comparison, the token is the only authentication
+                #: Compared as bytes, compare_digest rejects str with non-ascii characters
+                if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, '').encode('utf-8'), server.secret_token.encode('utf-8')):
+                    self._reply(403, 'forbidden')
+                    return
+
+                try:
+                    update = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+                except ValueError:
+                    self._reply(400, 'invalid')
+                    return
+
+                server.on_update(update)
+                self._reply(200, 'accepted')
+
+            def _reply(self, status: int, result: str):
+                WEBHOOK_UPDATES.labels(result).inc()
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return Handler